@@ -5,14 +5,20 @@ It relies on Flask
 
 
 import os
-from flask import Flask, render_template, request, redirect, abort, flash, send_from_directory, session
+import io
+import csv
+import time
+from json import dumps
+from flask import Flask, render_template, request, redirect, abort, flash, send_from_directory, session, jsonify, Response
 from flask_session import Session
 from werkzeug.utils import secure_filename
 import random
 from datetime import datetime
 from string import ascii_lowercase
-from fuzzyspreadsheets import generate_spreadsheet, generate_spreadsheets
-from helpers import do_backend, write_errorlog, read_errorlog
+from fuzzyspreadsheets import generate_spreadsheet, generate_spreadsheets, detect_duplicate_rows, merge_tables
+from fuzzyspreadsheets.utils import csv_extension, read_csv_source, SourceTooLarge
+from helpers import write_errorlog, read_errorlog
+from jobs import submit_job, read_job, JobRejected
 from operator import attrgetter
 
 
@@ -43,10 +49,31 @@ Session(app)
 app.config['DOWNLOAD_FOLDER'] = "downloads"
 app.config['UPLOAD_FOLDER'] = "uploads"
 app.config['MAX_CONTENT_PATH'] = 1024 * 1024 * 3  # 3 megabytes
-app.config['UPLOAD_EXTENSIONS'] = ['csv',]
+app.config['UPLOAD_EXTENSIONS'] = ['csv', 'csv.gz', 'csv.bz2', 'csv.xz']   # compressed uploads are read on the fly
+app.config['DOWNLOAD_COMPRESSION'] = None   # 'gz', 'bz2' or 'xz' to compress the result files (None = plain csv)
+app.config['CACHE_FOLDER'] = "cache"   # prepared (preprocessed) tables keyed by file content (None = no caching)
+app.config['CACHE_SIZE'] = 1024 * 1024 * 256   # 256 megabytes
+app.config['SCORE_CACHE'] = os.path.join("cache", "scores.sqlite")   # scores of value pairs shared by all jobs (None = no caching)
+app.config['RESULT_CACHE_FOLDER'] = os.path.join("cache", "results")   # results of uploaded files keyed by content (None = no caching)
+app.config['RESULT_CACHE_SIZE'] = 1024 * 1024 * 512   # 512 megabytes: size limit of the cached results (the least recently used results go first)
+app.config['API_MAX_BYTES'] = 1024 * 1024   # 1 megabyte: larger uploads to /api/detect and /api/merge are rejected (use the job queue)
+app.config['API_MAX_CSV_BYTES'] = 1024 * 1024 * 8   # 8 megabytes: limit of each spreadsheet after decompression (compressed uploads)
+app.config['PROFILE'] = None   # 'cprofile' or 'sample' to save a profile of every job into its downloads folder (or set FUZZYSPREADSHEETS_PROFILE)
+app.config['STATS_LOG'] = "statslog"   # timings and counters of each job, one json per line like the errorlog (None = no instrumentation)
+
+# Background jobs configurations
+app.config['JOB_FOLDER'] = "jobs"   # one json record per job
+app.config['JOB_EVENTS_SECONDS'] = 60   # maximum duration of an event stream (the page then falls back to polling)
+app.config['JOB_WORKERS'] = 2   # maximum number of concurrently running small jobs (worker processes)
+app.config['JOB_LARGE_WORKERS'] = 1   # maximum number of concurrently running large jobs (they queue up separately)
+app.config['JOB_LARGE_SECONDS'] = 60   # jobs estimated to run longer are large jobs
+app.config['JOB_EXHAUSTIVE_SECONDS'] = 60   # jobs estimated to run longer are run with blocking
+app.config['JOB_MAX_PAIRS'] = None   # budgets per job (None = no limit). Jobs exceeding them are rejected
+app.config['JOB_MAX_MEMORY'] = 1024 * 1024 * 1024   # 1 gigabyte
+app.config['JOB_MAX_SECONDS'] = 60 * 30   # 30 minutes
 
 # Create uploads and downloads folders if not exist
-for dirpath in (app.config['DOWNLOAD_FOLDER'], app.config['UPLOAD_FOLDER']):
+for dirpath in (app.config['DOWNLOAD_FOLDER'], app.config['UPLOAD_FOLDER'], app.config['JOB_FOLDER']):
     if not os.path.exists(dirpath):
         os.makedirs(dirpath)
 
@@ -119,7 +146,19 @@ def generate():
 @app.route("/merge", methods=['GET'])
 def detect_or_merge():
     path = str(request.path).lstrip('/')
-    rs = render_template(path + ".html")    # path = request.path   # "/detect"
+
+    # If a job is pending, show its status until it is finished
+    job = read_job(session["job_id"], app.config['JOB_FOLDER']) if session.get("job_id") else None
+    if job and job['status'] in ("done", "failed"):
+        del session["job_id"]
+        if job['status'] == "failed":
+            abort(500, job['error'])
+        session["download_files"] = job['files']
+        job = None
+    elif session.get("job_id") and job is None:
+        del session["job_id"]
+
+    rs = render_template(path + ".html", job=job)    # path = request.path   # "/detect"
 
     # Delete the list of download_files so that the merge page loads normally the next time
     if session.get("download_files", None):
@@ -146,10 +185,7 @@ def upload(subroute=None):
 
     # Case: user clicked "Generate spreadsheet(s)"
     if None in files:
-        try:
-            session["download_files"] = do_backend(operation=subroute)
-        except Exception as err:
-            abort(500, err)
+        session["job_id"] = submit_job(operation=subroute, config=app.config)
 
     # Case: the user didn't select file(s)
     elif any(f.filename == '' for f in files):
@@ -164,8 +200,8 @@ def upload(subroute=None):
         flash("You must provide two different csv files")
 
     # Case: not a csv file
-    elif not all(os.path.splitext(f.filename)[-1][1:] in app.config['UPLOAD_EXTENSIONS'] for f in files):
-        flash("{k1:} input file{k2:} must have a csv extension.".format(
+    elif not all((csv_extension(f.filename) or '')[1:] in app.config['UPLOAD_EXTENSIONS'] for f in files):
+        flash("{k1:} input file{k2:} must have a csv extension (optionally compressed: .csv.gz, .csv.bz2, .csv.xz).".format(
             k1=("The" if subroute == 'detect' else "Both"),
             k2=('' if subroute == 'detect' else 's')))
 
@@ -179,15 +215,115 @@ def upload(subroute=None):
             f.save(path)
             f.close()
             filepaths.append(path)
-        # Try backend operation
-        try: session["download_files"] = do_backend(filepaths, operation=subroute)
-        except Exception as err: abort(500, err)
+        # Enqueue the backend operation (the page polls the job status)
+        try: session["job_id"] = submit_job(filepaths, operation=subroute, config=app.config)
+        except JobRejected as err: flash(str(err))
 
     # In any case
     return redirect("/" + subroute)
 
 
 
+@app.route("/api/<operation>", methods=['POST'])
+def api(operation):
+    """
+    In-memory detect/merge of small spreadsheets (nothing is written to disk): the upload streams are passed straight through.
+    Form fields: file1 (and file2 for merge), optionally threshold. Query string: format=json (default) or format=csv
+    """
+    if operation not in ("detect", "merge"):
+        abort(404)
+    if request.content_length is None:
+        return jsonify(error="The request must have a Content-Length"), 411
+    if request.content_length > app.config['API_MAX_BYTES']:
+        return jsonify(error="The spreadsheets are too large for the in-memory API (max. {} bytes)".format(app.config['API_MAX_BYTES'])), 413
+    files = [request.files.get(k) for k in (('file1',) if operation == "detect" else ('file1', 'file2'))]
+    if not all(files):
+        return jsonify(error="Expected the form field{} {}".format('' if operation == "detect" else 's',
+                                                                   "file1" if operation == "detect" else "file1 and file2")), 400
+    threshold = request.form.get("threshold", type=float)
+
+    try:
+        # The (compressed) uploads are inflated up to API_MAX_CSV_BYTES only
+        sources = [read_csv_source(f.stream, max_size=app.config['API_MAX_CSV_BYTES']) for f in files]
+        if operation == "detect":
+            result = detect_duplicate_rows(sources[0], threshold=threshold)
+        else:
+            result = merge_tables(sources[0], sources[1], threshold=threshold)
+    except SourceTooLarge:
+        return jsonify(error="The spreadsheets are too large for the in-memory API (max. {} bytes uncompressed)".format(app.config['API_MAX_CSV_BYTES'])), 413
+    except (ValueError, IndexError, UnicodeDecodeError) as err:
+        return jsonify(error="Could not read the spreadsheet{}: {}".format('' if operation == "detect" else 's', err)), 400
+
+    # The result as a csv file
+    if request.args.get("format") == "csv":
+        def stream():
+            buffer = io.StringIO()
+            wr = csv.writer(buffer)
+            for row in [result['header']] + result['rows']:
+                wr.writerow(row)
+                yield buffer.getvalue()
+                buffer.seek(0); buffer.truncate()
+        filename = "sorted_duplicates.csv" if operation == "detect" else "merged_spreadsheet.csv"
+        return Response(stream(), mimetype="text/csv", headers={'Content-Disposition': "attachment; filename=" + filename})
+    return jsonify(result)
+
+
+
+@app.route("/jobs/<job_id>", methods=['GET'])
+def job_status(job_id):
+    job = read_job(job_id, app.config['JOB_FOLDER'])
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+
+
+@app.route("/jobs/<job_id>/events", methods=['GET'])
+def job_events(job_id):
+    """
+    Server-sent events with the status and the progress of a job (the stream ends when the job is done or failed).
+    The stream holds a worker, so it ends after JOB_EVENTS_SECONDS with a 'timeout' event: the page then polls the job status
+    """
+    folder = app.config['JOB_FOLDER']
+    if read_job(job_id, folder) is None:
+        abort(404)
+    deadline = time.monotonic() + (app.config.get('JOB_EVENTS_SECONDS') or 60)
+
+    def stream():
+        last = None
+        while True:
+            if time.monotonic() >= deadline:
+                yield "event: timeout\ndata: {}\n\n"
+                break
+            job = read_job(job_id, folder)
+            if job is None:
+                break
+            message = dumps({k: job.get(k) for k in ("status", "progress", "error")})
+            if message != last:
+                yield "data: {}\n\n".format(message)
+                last = message
+            if job['status'] in ("done", "failed"):
+                break
+            time.sleep(0.5)
+    return Response(stream(), mimetype="text/event-stream", headers={'Cache-Control': "no-cache", 'X-Accel-Buffering': "no"})
+
+
+
+@app.route("/jobs/<job_id>/files/<filename>", methods=['GET'])
+def job_file(job_id, filename):
+    job = read_job(job_id, app.config['JOB_FOLDER'])
+    if job is None or job['status'] != "done":
+        abort(404)
+    paths = [path for path in job['files'] if os.path.basename(path) == filename]
+    if not paths:
+        abort(404)
+    directory = os.path.join(app.root_path, os.path.dirname(paths[0]))
+    #EITHER of these two lines should work (Flask version issues)
+    return send_from_directory(directory=directory, filename=filename)
+    #return send_from_directory(directory=directory, path=filename)
+
+
+
 @app.route("/downloads/<directory>/<filename>", methods=['GET', 'POST'])
 def download(directory, filename):
     # Special case to download the README.md of fuzzyspreadsheets package
@@ -1,3 +1,5 @@
 __version__ = "1.0.0"
 from .generate import generate_spreadsheet, generate_spreadsheets
-from .model import merge_spreadsheets, detect_duplicates
+from .model import merge_spreadsheets, detect_duplicates, build_reference_index, detect_duplicate_rows, merge_tables
+from .streams import duplicate_groups, merge_groups, write_stream
+from .multimerge import merge_many_spreadsheets
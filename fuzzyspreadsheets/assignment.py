@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+Assignment of the left rows to the right rows from sparse candidate lists (used by model.match_rows).
+During the scoring only the top k candidates of each left row and the running sum of its similarity ratios are kept
+(memory O(m*k) instead of the m x n matrix).
+The greedy assignment takes the rankings (row, most similar row, ratio) in descending order of the ratio
+and matches a pair if it passes the rule and its rows are still free - the one implementation used by
+detect_duplicates, merge_spreadsheets and their variants (incremental, streamed, multi-way, graph sweep, out of core).
+The heap assignment pops the most similar (left row, right row) pair from a priority queue;
+if the right row is already taken, the next best candidate of the left row is pushed instead
+(the greedy assignment leaves such a left row unmatched).
+"""
+
+
+import heapq
+
+
+# Default number of candidates kept per left row
+DEFAULT_TOP_K = 5
+
+# Defaults of the offset rule: a ratio of at least OFFSET_FLOOR that stands out by at least OFFSET_RATIO is a match
+OFFSET_RATIO = 0.49
+OFFSET_FLOOR = 0.25
+
+
+
+def offset_ratio(r, total, n):
+    """How much the ratio r stands out from the other ratios of the row (total = sum of the ratios of the row, n = length of the row)"""
+    return 1 - ((total - r)/max(n-1, 1) / r) if r else 0   # r == 0 if no row was similar (e.g. when blocking)
+
+
+
+def is_match(r, o, threshold, offset=None, floor=None):
+    """The rule of a match: a high ratio, or a fair ratio that stands out from the row (o = offset ratio)"""
+    offset = OFFSET_RATIO if offset is None else offset
+    floor = OFFSET_FLOOR if floor is None else floor
+    return (o >= offset and r >= floor) or r >= threshold   # arbitrary threshold values
+
+
+
+def greedy_assignment(rankings, threshold, duplicates=False, free=None, size=None, offset=None, floor=None):
+    """
+    The greedy assignment over the rankings taken in the given order (descending order of the ratio)
+
+    Parameters
+    ----------
+    rankings : an iterable of tuples (row, most similar row, ratio) - with the offset ratio as a fourth item for merges
+    threshold : similarity probability threshold
+    duplicates : bool, optional
+        True for the rows of one table (detect): a pair matches if its ratio is at least the threshold and both rows are free.
+        False for the rows of two tables (merge): a pair matches by is_match (offset, floor) and if the right row is free
+        (each left row has one ranking). The default is False.
+    free : a set, optional
+        duplicates only - the rows that may be matched (e.g. the unmatched rows of an incremental run). The default is None (all)
+    size : int, optional
+        the number of (right) rows: the taken rows are then flags in a bytearray instead of a set. The default is None.
+
+    Returns
+    -------
+    a generator of tuples (row, matched row, ratio) in the order of assignment
+    """
+    if size is not None:
+        flags = bytearray(size)
+        is_taken, take = flags.__getitem__, (lambda k: flags.__setitem__(k, 1))
+    else:
+        taken = set()
+        is_taken, take = taken.__contains__, taken.add
+    for t in rankings:
+        (i, j, r) = t[:3]
+        if duplicates:
+            if r >= threshold and i != j and not is_taken(i) and not is_taken(j) and (free is None or (i in free and j in free)):
+                take(i)
+                take(j)   # prevent double matching
+                yield (i, j, r)
+        elif is_match(r, t[3], threshold, offset=offset, floor=floor) and not is_taken(j):
+            take(j)   # prevent double matching
+            yield (i, j, r)
+
+
+
+def top_candidates(scores, k=None):
+    """The k best (ratio, right row) pairs of a row in descending order of the ratio (ties: the smaller row first)"""
+    return heapq.nlargest(k or DEFAULT_TOP_K, scores, key=lambda t: (t[0], -t[1]))
+
+
+
+def heap_assignment(candidates, totals, n, threshold, counts=None):
+    """
+    One-to-one assignment from the candidate lists
+
+    Parameters
+    ----------
+    candidates : a list with one list per left row of (ratio, right row) pairs in descending order (see top_candidates)
+    totals : a list of the sums of the ratios of each left row
+    n : number of the right rows
+    threshold : similarity probability threshold (see is_match)
+    counts : a list of the numbers of the scored right rows of each left row (with screening), n for each row if None
+
+    Returns
+    -------
+    a list of tuples (left row, right row, ratio) in the order of assignment
+    """
+    heap = [(-c[0][0], i, 0) for (i, c) in enumerate(candidates) if c]
+    heapq.heapify(heap)
+    taken = set()
+    matchings = list()
+    while heap:
+        (r, i, k) = heapq.heappop(heap)
+        r = -r
+        if not is_match(r, offset_ratio(r, totals[i], counts[i] if counts is not None else n), threshold):
+            continue   # the next candidates of the row have lower ratios and would not match either
+        j = candidates[i][k][1]
+        if j not in taken:
+            taken.add(j)
+            matchings.append((i, j, r))
+        elif k + 1 < len(candidates[i]):
+            heapq.heappush(heap, (-candidates[i][k+1][0], i, k+1))
+    return matchings
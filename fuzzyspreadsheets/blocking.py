@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""
+Blocking keys and the candidate index.
+Instead of comparing every row against every other row, only rows sharing at least one blocking key are compared.
+A blocking key is a pair (column index, token), for example (1, "LUDE") for the last name "Lüdermann".
+The functions expect normalized rows (see model.normalize_rows)
+"""
+
+
+from .metrics import cologne_phonetics, soundex
+
+
+# Blocks (posting lists) larger than this are too common to be informative and are ignored
+DEFAULT_MAX_BLOCK_SIZE = 500
+
+
+
+def blocking_tokens(value, column_type):
+    """
+    Returns a set of tokens for a normalized value, depending on the column type:
+        0 (word) and 1 (set of words): the first four letters of each word
+        2 (digits+alpha): the last four digits (e.g. the end of a telephone number)
+        3 (telephone, see canonical.py): the last six digits
+        4 (date): the ISO date and the date with the day and month swapped
+        5 (number): the number
+        6 and 7 (words with phonetic codes): the Kölner Phonetik / Soundex codes of the words (see metrics.py)
+    Values of the typed columns 3-5 that were not canonicalized get the tokens of the type 2
+    """
+    value = str(value).strip()
+    if not value:
+        return set()
+    if column_type == 3 and value.isdigit():
+        return {value[-6:]}
+    if column_type == 4 and len(value) == 10 and value[4] == '-':
+        return {value, value[:5] + value[8:] + value[4:7]}
+    if column_type == 5 and value.replace('.', '', 1).lstrip('-').isdigit():
+        return {value}
+    if column_type in (6, 7):
+        encoder = cologne_phonetics if column_type == 6 else soundex
+        return {encoder(s) for s in value.replace(',', ' ').replace('.', ' ').split(' ') if len(s) >= 2} - {''}
+    if column_type >= 2:
+        digits = ''.join(c for c in value if c.isdigit())
+        return {digits[-4:]} if len(digits) >= 4 else {value.replace(' ', '')}
+    words = [s for s in value.replace(',', ' ').replace('.', ' ').split(' ') if len(s) >= 2]
+    return {s[:4] for s in words}
+
+
+
+def row_keys(row, columns, includes_id_column=True):
+    """
+    Blocking keys of a row
+
+    Parameters
+    ----------
+    row : a tuple representing a normalized row
+    columns : a sequence of tuples (ix_row, ix_key, column_type)
+        ix_row is the column index in this row (zero-based not counting the id column),
+        ix_key is the column index used in the key (i.e. the column of the indexed table)
+    includes_id_column : bool, optional
+        The default is True.
+
+    Returns
+    -------
+    a set of tuples (ix_key, token)
+    """
+    ix = int(includes_id_column)
+    return {(ix_key, token) for (ix_row, ix_key, column_type) in columns
+                            for token in blocking_tokens(row[ix_row + ix], column_type)}
+
+
+
+def build_candidate_index(rows, column_types, includes_id_column=True):
+    """
+    Builds an inverted index:  blocking key -> list of row indices (the rows must be normalized)
+    column_types : a sequence of int's, one for each column (not counting the id column)
+    """
+    columns = [(i, i, t) for (i, t) in enumerate(column_types)]
+    index = dict()
+    for (i, row) in enumerate(rows):
+        for key in row_keys(row, columns, includes_id_column=includes_id_column):
+            index.setdefault(key, []).append(i)
+    return index
+
+
+
+def candidate_rows(index, keys, max_block_size=None):
+    """Returns the set of row indices sharing at least one of the keys (blocks larger than max_block_size are skipped)"""
+    max_block_size = max_block_size or DEFAULT_MAX_BLOCK_SIZE
+    candidates = set()
+    for key in keys:
+        block = index.get(key, ())
+        if len(block) <= max_block_size:
+            candidates.update(block)
+    return candidates
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+On-disk cache for prepared (preprocessed) tables.
+A prepared table holds everything computed from a spreadsheet before the rows are compared:
+the rows, normalized cells, column types, column vectors and the candidate index (see model.prepare_table)
+Entries are keyed by the SHA-256 of the file content plus the preprocessing version
+and evicted in least-recently-used order when the cache directory exceeds its size limit.
+"""
+
+
+import os
+import pickle
+import hashlib
+
+
+# Increment whenever the content of a prepared table changes (invalidates old cache entries)
+# 2: typed columns (typed_columns=True) are detected by the format of their values only
+# 3: the phonetic codes of the name columns are stored in the table (phonetic=...)
+PREPROCESSING_VERSION = 3
+
+# Default size limit of the cache directory
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 256   # 256 megabytes
+
+CACHE_EXTENSION = ".pickle"
+
+
+
+def file_hash(filepath, chunk_size=1024 * 1024):
+    """SHA-256 of the file content (the raw bytes, i.e. a compressed file is hashed as it is stored)"""
+    h = hashlib.sha256()
+    with open(filepath, mode='rb') as fr:
+        for chunk in iter(lambda: fr.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+
+def cache_key(filepath, **options):
+    """Key of a cache entry: content hash + preprocessing version + preprocessing options (e.g. includes_header)"""
+    options = ','.join("{}={}".format(k, options[k]) for k in sorted(options))
+    s = "{}|v{}|{}".format(file_hash(filepath), PREPROCESSING_VERSION, options)
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+
+
+def load_prepared(key, cache_dir):
+    """Returns the cached prepared table or None if not cached (or if the entry is invalid)"""
+    path = os.path.join(str(cache_dir), key + CACHE_EXTENSION)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, mode='rb') as fr:
+            table = pickle.load(fr)
+    except Exception:
+        table = None
+
+    # Validate the entry
+    if not (isinstance(table, dict) and table.get("key") == key and table.get("version") == PREPROCESSING_VERSION):
+        try: os.remove(path)
+        except OSError: pass
+        return None
+
+    # Mark as recently used
+    try: os.utime(path)
+    except OSError: pass
+    return table
+
+
+
+def save_prepared(key, table, cache_dir, cache_size=None):
+    """Saves the prepared table into the cache directory and evicts the least recently used entries if necessary"""
+    cache_dir = str(cache_dir)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    table = dict(table, key=key, version=PREPROCESSING_VERSION)
+    path = os.path.join(cache_dir, key + CACHE_EXTENSION)
+    temp = path + ".{}.tmp".format(os.getpid())
+
+    # Write to a temp file first so that a concurrent reader never sees a half written entry
+    with open(temp, mode='wb') as fw:
+        pickle.dump(table, fw, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp, path)
+
+    evict(cache_dir, cache_size=cache_size)
+    return path
+
+
+
+def evict(cache_dir, cache_size=None):
+    """Deletes the least recently used entries until the total size of the cache is within cache_size (bytes)"""
+    cache_size = DEFAULT_CACHE_SIZE if cache_size is None else cache_size
+    entries = []
+    for filename in os.listdir(str(cache_dir)):
+        if not filename.endswith(CACHE_EXTENSION): continue
+        path = os.path.join(str(cache_dir), filename)
+        try: st = os.stat(path)
+        except OSError: continue
+        entries.append((st.st_mtime, st.st_size, path))
+
+    total = sum(t[1] for t in entries)
+    for (_, size, path) in sorted(entries):   # oldest first
+        if total <= cache_size: break
+        try: os.remove(path)
+        except OSError: continue
+        total -= size
+    return total
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+"""
+Typed columns: telephone numbers, dates and numbers.
+determine_column_types lumps them into type 2 (digits+alpha), compared as strings with n_grams_ratio,
+so that format variants like "(0714) 15-18-19" vs "0714/15 18 19" or "09.06.2010" vs "Jun 09, 2010" look dissimilar.
+With typed columns (prepare_table(..., typed_columns=True)) such columns get their own types
+and their values are canonicalized once while preparing the table:
+    3 = telephone : the digits only, e.g. "07141518 19"  ->  "0714151819"
+    4 = date : ISO date, e.g. "JUN 09, 2010"  ->  "2010-06-09"
+    5 = number : the float as a string, e.g. "$82.90"  ->  "82.9"
+A column gets a type if at least TYPED_COLUMN_SHARE of its non-empty values can be canonicalized
+(the other values are kept as they are). Telephone numbers and numbers are recognized by their format only:
+plain digit strings are codes (postcodes, customer numbers of a fixed width) and keep the column a digits+alpha column.
+The canonical values are compared in constant time (see metrics.phone_ratio, date_ratio, number_ratio)
+and serve as blocking keys (see blocking.blocking_tokens).
+"""
+
+
+from datetime import datetime
+
+
+# Column types (see model.SIMILARITY_FUNCTIONS)
+PHONE, DATE, NUMBER = 3, 4, 5
+
+# Share of the non-empty values of a column that must be canonicalized for the column to get a type
+TYPED_COLUMN_SHARE = 0.9
+
+# Telephone numbers: the characters allowed besides the digits and the minimum number of digits
+PHONE_CHARACTERS = frozenset("0123456789+-/() .")
+PHONE_MIN_DIGITS = 6
+
+# Date formats tried in this order (the values are normalized, i.e. upper case - strptime ignores the case of month names)
+DATE_FORMATS = ("%Y-%m-%d", "%m/%d/%Y", "%m/%d/%y", "%m/%d %Y", "%Y %m/%d", "%d.%m.%Y", "%d.%m.%y",
+                "%B %d, %Y", "%b %d, %Y", "%b. %d, %Y", "%d-%m-%y", "%d-%m-%Y", "%d-%b-%Y", "%d %b %Y", "%d %B %Y", "%d%b%Y")
+
+# Currency symbols stripped from numbers
+CURRENCY_SYMBOLS = "$€£¥"
+
+# Marks of a number: a decimal (or thousands) separator, a currency symbol or a minus sign
+NUMBER_MARKS = frozenset(".,-" + CURRENCY_SYMBOLS)
+
+
+
+def canonical_phone(value):
+    """The digits of a telephone number, or None if the value is not a telephone number"""
+    value = str(value).strip()
+    if not value or not PHONE_CHARACTERS.issuperset(value):
+        return None
+    digits = ''.join(c for c in value if c.isdigit())
+    return digits if len(digits) >= PHONE_MIN_DIGITS else None
+
+
+
+def canonical_date(value):
+    """The ISO date (YYYY-MM-DD), or None if the value is not a date in one of the DATE_FORMATS"""
+    value = ' '.join(str(value).split())
+    if not value or not any(c.isdigit() for c in value):
+        return None
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+
+def canonical_number(value):
+    """The number as a string (repr of the float), or None if the value is not a number"""
+    value = str(value).strip().strip(CURRENCY_SYMBOLS).strip()
+    if ',' in value and '.' in value:   # thousands separators: the one that comes first
+        value = value.replace(',' if value.index(',') < value.index('.') else '.', '').replace(',', '.')
+    elif ',' in value:   # decimal comma
+        value = value.replace(',', '.')
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    return repr(number) if number == number and abs(number) != float("inf") else None
+
+
+
+CANONICALIZERS = {PHONE: canonical_phone, DATE: canonical_date, NUMBER: canonical_number}
+
+
+
+def has_type_marks(typ, value):
+    """
+    True if the format of the value marks it as of the type: a telephone number is not a plain digit string,
+    a number carries one of the NUMBER_MARKS (so that plain digit codes don't count towards either type)
+    """
+    value = str(value).strip()
+    if typ == PHONE:
+        return not value.isdigit()
+    if typ == NUMBER:
+        return any(c in NUMBER_MARKS for c in value)
+    return True
+
+
+
+def refine_column_types(normalized, column_types, includes_id_column=True):
+    """
+    The column types with the typed columns (see the module docstring), given the normalized rows.
+    Every column may be a date column, only digits+alpha columns (type 2) may be telephone or number columns
+    (in this order: e.g. "09/22/05" is a date, "0714 151819" a telephone number, "82.90" a number).
+    Only the values with the marks of the type count (see has_type_marks): a column of codes like "70173" stays type 2
+    """
+    ix = int(includes_id_column)
+    refined = list(column_types)
+    for (c, t) in enumerate(column_types):
+        values = [row[c + ix] for row in normalized if str(row[c + ix]).strip()]
+        if not values:
+            continue
+        for typ in ((DATE, PHONE, NUMBER) if t == 2 else (DATE,)):
+            canonicalize = CANONICALIZERS[typ]
+            if sum(canonicalize(v) is not None and has_type_marks(typ, v) for v in values) >= TYPED_COLUMN_SHARE * len(values):
+                refined[c] = typ
+                break
+    return tuple(refined)
+
+
+
+def canonicalize_rows(normalized, column_types, includes_id_column=True):
+    """The normalized rows with the values of the typed columns canonicalized (the values that fail are kept as they are)"""
+    ix = int(includes_id_column)
+    typed = [(c + ix, CANONICALIZERS[t]) for (c, t) in enumerate(column_types) if t in CANONICALIZERS]
+    if not typed:
+        return normalized
+    rows = list()
+    for row in normalized:
+        row = list(row)
+        for (c, canonicalize) in typed:
+            v = canonicalize(row[c])
+            if v is not None:
+                row[c] = v
+        rows.append(tuple(row))
+    return rows
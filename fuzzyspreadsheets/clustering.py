@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""
+Clusters of duplicates built from a sparse list of edges (pairs of similar rows) with a disjoint-set (union-find) structure.
+Unlike the greedy pairing of detect_duplicates (each row matched at most once), triplicates and larger groups stay together.
+The work grows near-linearly with the number of edges (no matrix of all the pairs is needed).
+An optional maximum diameter (the number of edges on the longest shortest path between two rows of a cluster)
+prevents long chains of rows each similar only to the next one:
+the edges are then added from the most similar pair down and an edge that would exceed the diameter is dropped.
+"""
+
+
+from collections import deque
+
+
+
+class DisjointSet:
+    """Union-find over the nodes 0..n-1 (with path halving and union by size)"""
+
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.size = [1,] * n
+
+    def find(self, a):
+        parent = self.parent
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    def union(self, a, b):
+        """Joins the sets of a and b. Returns the root of the joined set"""
+        ra, rb = self.find(a), self.find(b)
+        if ra == rb:
+            return ra
+        if self.size[ra] < self.size[rb]:
+            ra, rb = rb, ra
+        self.parent[rb] = ra
+        self.size[ra] += self.size[rb]
+        return ra
+
+    def groups(self):
+        """The sets as lists of nodes in ascending order, ordered by their smallest node"""
+        groups = dict()
+        for a in range(len(self.parent)):
+            groups.setdefault(self.find(a), []).append(a)
+        return list(groups.values())
+
+
+
+def components(n, edges):
+    """
+    Connected components of a graph with the nodes 0..n-1
+    edges : an iterable of pairs (a, b) (any further items, e.g. the similarity ratio, are ignored)
+    Returns a list of components (lists of nodes in ascending order) ordered by their smallest node
+    """
+    ds = DisjointSet(n)
+    for edge in edges:
+        ds.union(edge[0], edge[1])
+    return ds.groups()
+
+
+
+def cluster_edges(n, edges, max_diameter=None, presorted=False):
+    """
+    Clusters of the nodes 0..n-1 linked by the edges
+
+    Parameters
+    ----------
+    n : int
+        number of nodes (rows)
+    edges : an iterable of tuples (i, j, similarity ratio)
+    max_diameter : int, optional
+        maximum number of edges between any two nodes of a cluster (None = no limit). The default is None.
+    presorted : bool, optional
+        True if the edges are already in descending order of the ratio (e.g. merged back from spilled runs, see spilling.py),
+        so that they are not sorted in memory. The default is False.
+
+    Returns
+    -------
+    a list of clusters (lists of nodes in ascending order, single nodes included) ordered by their smallest node
+    """
+    if not max_diameter:
+        return components(n, edges)
+
+    ds = DisjointSet(n)
+    members = dict()     # root -> nodes of the cluster (only clusters with more than one node)
+    adjacency = dict()   # node -> set of nodes (the accepted edges)
+    for (i, j, _) in (edges if presorted else sorted(edges, key=lambda t: t[2], reverse=True)):   # the most similar pairs first
+        ri, rj = ds.find(i), ds.find(j)
+        adjacency.setdefault(i, set()).add(j)
+        adjacency.setdefault(j, set()).add(i)
+        if ri == rj:
+            continue   # an edge within a cluster can only shorten its paths
+        nodes = members.get(ri, [i]) + members.get(rj, [j])
+        if diameter(nodes, adjacency) > max_diameter:
+            adjacency[i].discard(j)
+            adjacency[j].discard(i)
+            continue
+        members.pop(ri, None)
+        members.pop(rj, None)
+        members[ds.union(i, j)] = nodes
+    return ds.groups()
+
+
+
+def diameter(nodes, adjacency):
+    """Longest shortest path (number of edges) between two of the nodes of a connected cluster (breadth-first search)"""
+    longest = 0
+    for start in nodes:
+        distances = {start: 0}
+        queue = deque([start])
+        while queue:
+            a = queue.popleft()
+            for b in adjacency.get(a, ()):
+                if b not in distances:
+                    distances[b] = distances[a] + 1
+                    queue.append(b)
+        longest = max(longest, max(distances.values()))
+    return longest
+
+
+
+def cluster_matchings(clusters):
+    """The matchings of the clusters (see cluster_edges): a tuple per cluster of several rows, followed by (i,None) for the single rows"""
+    return [tuple(c) for c in clusters if len(c) > 1] + [(c[0], None) for c in clusters if len(c) == 1]
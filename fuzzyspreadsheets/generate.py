@@ -12,7 +12,7 @@ import os
 import random
 import csv
 from datetime import date
-from .utils import construct_filepath
+from .utils import construct_filepath, open_csv, strip_csv_extension
 
 
 
@@ -98,8 +98,8 @@ def generate_spreadsheet(n_rows=10, filename=None, directory=None, debugging=Fal
     # Construct file path
     filepath = construct_filepath(filename or "duplicates.csv", directory)
     
-    # Write to file
-    with open(filepath, mode='wt', encoding='utf-8') as fw:
+    # Write to file (compressed if the file name ends with .gz, .bz2 or .xz)
+    with open_csv(filepath, mode='wt') as fw:
         wr = csv.writer(fw)
         wr.writerow(header)
         for row,d in zip(rows,dummy):
@@ -107,7 +107,7 @@ def generate_spreadsheet(n_rows=10, filename=None, directory=None, debugging=Fal
 
     # Write the log file to disc
     if debugging:
-        filename = os.path.split(filepath)[-1].replace(".csv",'') + "_log.csv"
+        filename = strip_csv_extension(os.path.split(filepath)[-1]) + "_log.csv"
         path = construct_filepath(filename, directory)
         with open(path, mode='wt', encoding='utf-8') as fw:
             wr = csv.writer(fw)
@@ -172,20 +172,20 @@ def generate_spreadsheets(n_rows=10, filename1=None, filename2=None, directory=N
     filepath1 = construct_filepath(filename1 or "spreadsheet1.csv", directory)
     filepath2 = construct_filepath(filename2 or "spreadsheet2.csv", directory)
     
-    # Write csv files to dics
-    with open(filepath1, mode='wt', encoding='utf-8') as fw:
+    # Write csv files to dics (compressed if the file names end with .gz, .bz2 or .xz)
+    with open_csv(filepath1, mode='wt') as fw:
         wr = csv.writer(fw)
         for row in left:
             wr.writerow(row)
     
-    with open(filepath2, mode='wt', encoding='utf-8') as fw:
+    with open_csv(filepath2, mode='wt') as fw:
         wr = csv.writer(fw)
         for row,d in zip(right,dummy):
             wr.writerow(row + (d,))
     
     # Write the log file to disc
     if debugging:
-        filename1, filename2 = (os.path.split(s)[-1].replace(".csv",'') for s in (filepath1,filepath2))
+        filename1, filename2 = (strip_csv_extension(os.path.split(s)[-1]) for s in (filepath1,filepath2))
         filename = "{}_{}_log.csv".format(filename1, filename2)
         filepath = construct_filepath(filename, directory)
         with open(filepath, mode='wt', encoding='utf-8') as fw:
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+"""
+The scored candidate graph of a detect / merge run and the threshold sweep.
+Scoring is by far the most expensive step; the assignment of the matches is cheap.
+score_graph scores the pairs once (every pair, or the candidate pairs with blocking) and keeps the graph:
+    left, right : row indeces of the scored pairs (array of unsigned int, zero-based not counting the header)
+    scores : the similarity ratios (array of float32), pairs with a zero ratio are left out
+    totals : merges only - the sum of the ratios of each left row (for the offset ratio, see assignment.py)
+The graph can be saved into a compact binary file (save_graph / load_graph) and swept:
+sweep re-runs only the assignment (the same greedy rules as detect_duplicates / merge_spreadsheets) for many thresholds
+and returns the number of matches per threshold, and the precision and recall if a log file of the generated spreadsheets is given.
+Usage:
+    graph = score_graph("spreadsheet1.csv", "spreadsheet2.csv", graph_file="scores.graph")
+    sweep("scores.graph", [0.4, 0.45, 0.5, 0.55], log_file="spreadsheet1_spreadsheet2_log.csv")
+    # [{'threshold': 0.4, 'matched': 65, 'unmatched': 15, 'precision': 1.0, 'recall': 1.0}, ...]
+"""
+
+
+import os
+import sys
+import csv
+import struct
+from array import array
+from .model import prepare_table, match_prepared_columns, row_similarity, tile_keys
+from .blocking import candidate_rows, row_keys
+from .scorecache import open_score_cache
+from .progress import progress_reporter
+from .assignment import offset_ratio, greedy_assignment
+
+
+# File format: magic, version, byte order, kind (0 = detect, 1 = merge), swapped, m, n, number of pairs
+GRAPH_MAGIC = b"FSGRAPH"
+GRAPH_VERSION = 1
+GRAPH_HEADER = struct.Struct("<7sBBBBIIQ")
+
+
+
+class ScoredGraph:
+    """
+    The scored pairs of one table (kind 'detect', pairs i < j) or of two tables (kind 'merge', left row i, right row j).
+    swapped : merges only - True if the left table is the second spreadsheet (see model.match_prepared_columns)
+    """
+
+    def __init__(self, kind, m, n, left=None, right=None, scores=None, totals=None, swapped=False):
+        self.kind = kind
+        self.m, self.n = m, n
+        self.left = left if left is not None else array('I')
+        self.right = right if right is not None else array('I')
+        self.scores = scores if scores is not None else array('f')
+        self.totals = totals if totals is not None else array('d')
+        self.swapped = swapped
+
+    def __len__(self):
+        return len(self.scores)
+
+    def add(self, i, j, r):
+        self.left.append(i)
+        self.right.append(j)
+        self.scores.append(r)
+
+
+
+def score_graph(filepath1, filepath2=None, includes_header=True, includes_id_column=True, columns_matching=None,
+                blocking=False, cache_dir=None, cache_size=None, score_cache=None, progress=None, graph_file=None):
+    """
+    Scores the pairs of rows of one spreadsheet (duplicates) or two spreadsheets (merge) and returns the ScoredGraph
+    (saved into graph_file if given). The arguments are the same as in detect_duplicates / merge_spreadsheets
+    """
+    tables = [prepare_table(filepath, includes_header=includes_header, includes_id_column=includes_id_column,
+                            cache_dir=cache_dir, cache_size=cache_size, progress=progress)
+              for filepath in (filepath1, filepath2) if filepath is not None]
+    score_cache, opened = open_score_cache(score_cache)
+    try:
+        if len(tables) == 1:
+            graph = score_duplicates(tables[0], blocking=blocking, score_cache=score_cache, progress=progress)
+        else:
+            graph = score_merge(tables[0], tables[1], columns_matching=columns_matching, blocking=blocking,
+                                score_cache=score_cache, progress=progress)
+    finally:
+        if opened: score_cache.close()
+    if graph_file:
+        save_graph(graph, graph_file)
+    return graph
+
+
+
+def score_duplicates(table, blocking=False, score_cache=None, progress=None):
+    """ScoredGraph of the pairs of rows of a prepared table (see model.match_duplicates)"""
+    normalized, column_types = table["normalized"], table["column_types"]
+    n = len(normalized)
+    graph = ScoredGraph("detect", n, n)
+    columns = [(i, i, t) for (i, t) in enumerate(column_types)]
+    report = progress_reporter(progress, "scoring", n)
+    for i in range(n):
+        if report: report(i)
+        js = sorted(j for j in candidate_rows(table["index"], row_keys(normalized[i], columns)) if j > i) if blocking else range(i+1, n)
+        if score_cache:
+            score_cache.prefetch(tile_keys(normalized[i], normalized, js, column_types=column_types))
+        for j in js:
+            r = row_similarity(normalized[i], normalized[j], column_types=column_types, normalized=True, score_cache=score_cache)
+            if r: graph.add(i, j, r)
+        if score_cache:
+            score_cache.flush()
+    if report: report.done()
+    return graph
+
+
+
+def score_merge(table1, table2, columns_matching=None, blocking=False, score_cache=None, progress=None):
+    """ScoredGraph of the pairs of rows of two prepared tables (see model.match_rows)"""
+    table_left, table_right, column_matchings, column_types = match_prepared_columns(table1, table2,
+                                                proportion_of_column_names_similarity=columns_matching)
+    rows_left, rows_right = table_left["normalized"], table_right["normalized"]
+    m, n = len(rows_left), len(rows_right)
+    graph = ScoredGraph("merge", m, n, swapped=table_left is not table1)
+    columns = [(ix_left, ix_right, t) for ((ix_left, ix_right), t) in zip([t for t in column_matchings if None not in t], column_types)]
+    report = progress_reporter(progress, "scoring", m)
+    for (i, row) in enumerate(rows_left):
+        if report: report(i)
+        js = sorted(candidate_rows(table_right["index"], row_keys(row, columns))) if blocking else range(n)
+        if score_cache:
+            score_cache.prefetch(tile_keys(row, rows_right, js, column_matchings, column_types))
+        total = 0
+        for j in js:
+            r = row_similarity(row, rows_right[j], column_matchings=column_matchings, column_types=column_types,
+                               normalized=True, score_cache=score_cache)
+            total += r
+            if r: graph.add(i, j, r)
+        graph.totals.append(total)
+        if score_cache:
+            score_cache.flush()
+    if report: report.done()
+    return graph
+
+
+
+def save_graph(graph, graph_file):
+    """Saves a ScoredGraph into a binary file (written to a temp file first)"""
+    directory = os.path.dirname(str(graph_file))
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    temp = str(graph_file) + ".{}.tmp".format(os.getpid())
+    with open(temp, mode='wb') as fw:
+        fw.write(GRAPH_HEADER.pack(GRAPH_MAGIC, GRAPH_VERSION, int(sys.byteorder == "little"), int(graph.kind == "merge"),
+                                   int(graph.swapped), graph.m, graph.n, len(graph)))
+        for a in (graph.left, graph.right, graph.scores, graph.totals):
+            a.tofile(fw)
+    os.replace(temp, graph_file)
+    return graph_file
+
+
+
+def load_graph(graph_file):
+    """Loads a ScoredGraph saved by save_graph"""
+    with open(graph_file, mode='rb') as fr:
+        magic, version, little, merge, swapped, m, n, count = GRAPH_HEADER.unpack(fr.read(GRAPH_HEADER.size))
+        if magic != GRAPH_MAGIC or version != GRAPH_VERSION:
+            raise ValueError(f"incompatible graph file: {graph_file}")
+        graph = ScoredGraph("merge" if merge else "detect", m, n, swapped=bool(swapped))
+        for (a, k) in ((graph.left, count), (graph.right, count), (graph.scores, count), (graph.totals, m if merge else 0)):
+            a.fromfile(fr, k)
+            if bool(little) != (sys.byteorder == "little"):
+                a.byteswap()
+    return graph
+
+
+
+def rankings(graph):
+    """
+    The rankings of the assignment (independent of the threshold): (row, most similar row, ratio, offset ratio)
+    in descending order of the ratio (see model.match_duplicates and model.match_rows)
+    """
+    best = [(0.0, 0)] * graph.m   # row -> (ratio, index of the most similar row) - ties go to the smaller index
+    for (i, j, r) in zip(graph.left, graph.right, graph.scores):
+        if r > best[i][0] or (r == best[i][0] and j < best[i][1]): best[i] = (r, j)
+        if graph.kind == "detect" and (r > best[j][0] or (r == best[j][0] and i < best[j][1])): best[j] = (r, i)
+    if graph.kind == "detect":
+        ranked = [(i, j, r, 0) for (i, (r, j)) in enumerate(best)]
+    else:
+        ranked = [(i, j, r, offset_ratio(r, graph.totals[i], graph.n)) for (i, (r, j)) in enumerate(best)]
+    return sorted(ranked, reverse=True, key=lambda t: t[2])
+
+
+
+def assign(graph, threshold=None, offset=None, floor=None, ranked=None):
+    """
+    The matched pairs of the graph for a threshold (the default thresholds are those of detect_duplicates and match_rows).
+    offset, floor : merges only - the offset rule (see assignment.is_match)
+    Returns a set of pairs of row indeces: (i, j) with i < j for duplicates, (row of spreadsheet 1, row of spreadsheet 2) for merges
+    """
+    ranked = ranked if ranked is not None else rankings(graph)
+    matched = set()
+    if graph.kind == "detect":
+        for (i, j, _) in greedy_assignment(ranked, threshold or 0.45, duplicates=True, size=graph.m):
+            matched.add((min(i,j), max(i,j)))
+    else:
+        for (i, j, _) in greedy_assignment(ranked, threshold or 0.49, size=graph.n, offset=offset, floor=floor):
+            matched.add((j, i) if graph.swapped else (i, j))
+    return matched
+
+
+
+def read_log(log_file):
+    """The true pairs of a log file written by generate_spreadsheet(s)(debugging=True): a set of pairs of row indeces"""
+    with open(log_file, mode='rt', encoding='utf_8') as fr:
+        log = [tuple(None if v in ('', None) else int(v) for v in t) for t in csv.reader(fr) if t]
+    return {t for t in log if len(t) == 2 and None not in t}
+
+
+
+def sweep(graph, thresholds, log_file=None, offset=None, floor=None):
+    """
+    Re-runs the assignment of a ScoredGraph (or a graph file) for each threshold
+    (offset, floor : merges only - the offset rule, see assignment.is_match)
+
+    Returns
+    -------
+    a list of dicts, one per threshold:
+        threshold, matched (number of matched pairs), unmatched (number of unmatched rows)
+        precision, recall (only with a log file: the share of the matched pairs that are true pairs,
+                           and the share of the true pairs that were matched)
+    """
+    graph = load_graph(graph) if isinstance(graph, (str, os.PathLike)) else graph
+    truth = read_log(log_file) if log_file else None
+    if truth is not None and graph.kind == "detect":
+        truth = {(min(t), max(t)) for t in truth}
+    ranked = rankings(graph)
+    rows = graph.m if graph.kind == "detect" else graph.m + graph.n
+    results = list()
+    for threshold in thresholds:
+        matched = assign(graph, threshold, offset=offset, floor=floor, ranked=ranked)
+        result = dict(threshold=threshold, matched=len(matched), unmatched=rows - 2 * len(matched))
+        if truth is not None:
+            correct = len(matched & truth)
+            result.update(precision=round(correct / len(matched), 4) if matched else None,
+                          recall=round(correct / len(truth), 4) if truth else None)
+        results.append(result)
+    return results
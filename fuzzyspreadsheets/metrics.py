@@ -2,11 +2,41 @@
 
 """
 metric functions for fuzzy matching
+The Levenshtein distances (with the substitution cost 2, i.e. the InDel distance) are computed by a backend:
+    python : the pure Python kernel levenshtein_distance
+    rapidfuzz : native calls of the rapidfuzz package (optional, used if installed) - the same distances, 50-100x faster
+The backend is selected at import (see set_backend). The ratios are computed from the integer distances either way,
+so that the choice of the backend does not change any result.
 """
 
 
+from functools import lru_cache
 from .utils import check_types, check_empty_or_none, check_equivalence
 
+try:
+    from rapidfuzz import process
+    from rapidfuzz.distance import Indel
+except ImportError:   # optional dependency
+    process = Indel = None
+try:
+    import numpy   # rapidfuzz.process.cdist returns numpy arrays
+except ImportError:   # optional dependency
+    numpy = None
+
+
+# Metric backends and the selected one (see set_backend)
+BACKENDS = ("python", "rapidfuzz")
+backend = "python"
+
+# Pairs on which an accelerated backend must give the same distances as the Python kernel before it is selected
+BACKEND_CHECK_PAIRS = (("KITTEN", "SITTING"), ("LUDERMANN", "LUEDERMAN"), ("TURBO OPTIMUS LTD", "TURBO LIMITED"),
+                       ("AAAB", "ABAA"), ("ÄÖÜ SS", "AOU ß"), ("0714 151819", "0714/15 18 19"), ("", "ABC"), ("X", "X"))
+
+
+# Phonetic codes: the minimum ratio of two names with equal codes and the number of memoized values
+PHONETIC_RATIO = 0.9
+PHONETIC_CACHE_SIZE = 1 << 17
+
 
 
 def levenshtein_distance(s1, s2, replacement_cost=2):
@@ -50,11 +80,64 @@ def levenshtein_ratio(s1, s2):
     """Levenshtein similarity ratio"""
     if not (s1 and s2):   # both strings must be > zero-length
         return None
-    d = levenshtein_distance(s1, s2, replacement_cost=2)  # must be 2 here !!!
+    d = indel_distance(s1, s2)  # the replacement cost must be 2 here !!!
     return (len(s1) + len(s2) - d) / (len(s1) + len(s2))
 
 
 
+def indel_distance(s1, s2):
+    """levenshtein_distance(s1, s2, replacement_cost=2) computed by the selected backend"""
+    if backend == "rapidfuzz":
+        return Indel.distance(s1, s2)
+    return levenshtein_distance(s1, s2, replacement_cost=2)
+
+
+
+def levenshtein_ratios(s, values):
+    """
+    levenshtein_ratio of a string against each of the values (a list, in the same order)
+    With the rapidfuzz backend the distances are computed by one native call (process.cdist)
+    """
+    if backend != "rapidfuzz" or not s:
+        return [levenshtein_ratio(s, v) for v in values]
+    if numpy is not None:
+        distances = process.cdist([s], values, scorer=Indel.distance)[0].tolist()
+    else:
+        distances = [Indel.distance(s, v) for v in values]
+    ratios = list()
+    for (v, d) in zip(values, distances):   # the same checks as the decorators of levenshtein_ratio
+        if type(v) is not str:
+            raise TypeError("Argument at position 2 must be of type 'str' and not '{}'".format(type(v).__name__))
+        ratios.append(0.0 if not v else 1.0 if s == v else (len(s) + len(v) - d) / (len(s) + len(v)))
+    return ratios
+
+
+
+def set_backend(name=None):
+    """
+    Selects the backend of the Levenshtein distances: 'python', 'rapidfuzz' or None (rapidfuzz if installed, otherwise python).
+    An accelerated backend is selected only if it gives the same distances as the Python kernel on BACKEND_CHECK_PAIRS
+    (if it does not, None falls back to python and 'rapidfuzz' raises a RuntimeError)
+    Returns the selected backend
+    """
+    global backend
+    if name not in (None,) + BACKENDS:
+        raise ValueError("the backend must be one of {} (not {!r})".format(BACKENDS, name))
+    if name == "rapidfuzz" and Indel is None:
+        raise ImportError("the rapidfuzz backend requires the rapidfuzz package")
+    if name == "python" or Indel is None:
+        backend = "python"
+        return backend
+    if all(Indel.distance(a, b) == levenshtein_distance(a, b, replacement_cost=2) for (a, b) in BACKEND_CHECK_PAIRS):
+        backend = "rapidfuzz"
+    elif name == "rapidfuzz":
+        raise RuntimeError("the rapidfuzz backend gives different distances than the Python kernel")
+    else:
+        backend = "python"
+    return backend
+
+
+
 
 def cosine_similarity(vector1, vector2):
     """cosine similarity of two vectors"""
@@ -72,11 +155,13 @@ def token_set_ratio(s1, s2):
     s1,s2 = ([s.strip() for s in s.strip().replace(',', ' ').upper().split(' ') if s] for s in (s1,s2))
     s1,s2 = (s1,s2) if len(s1) <= len(s2) else (s2,s1)
     vectors1,vectors2 = ([(ord(s[0])-33, len(s)) for s in st] for st in (s1,s2))
-    n = max(vectors1 + vectors2, key=lambda t: t[0])[0]
-    vectors1,vectors2 = ([(c2, *([0,]*c1+[1,]+[0,]*(n-c1))) for c1,c2 in vectors] for vectors in (vectors1,vectors2))
-    
-    ll = []; [ll.append([]) for v in s1]
-    ll = [[cosine_similarity(v1,v2) for v2 in vectors2] for v1 in vectors1]
+    if min(vectors1 + vectors2)[0] >= 0:
+        # Cosine similarities of the vectors (length, one-hot first letter) in a closed form (the same floats, without the vectors)
+        ll = [[(l1*l2 + (c1 == c2)) / ((l1**2 + 1) ** 0.5 * (l2**2 + 1) ** 0.5) for (c2,l2) in vectors2] for (c1,l1) in vectors1]
+    else:
+        n = max(vectors1 + vectors2, key=lambda t: t[0])[0]
+        vectors1,vectors2 = ([(c2, *([0,]*c1+[1,]+[0,]*(n-c1))) for c1,c2 in vectors] for vectors in (vectors1,vectors2))
+        ll = [[cosine_similarity(v1,v2) for v2 in vectors2] for v1 in vectors1]
     
     right_indeces = [t[0] for t in sorted([(i,max(l)) for i,l in enumerate(ll)], reverse=True, key=lambda t: t[-1])]
     left_indeces = list(range(len(s2)))
@@ -106,3 +191,151 @@ def n_grams_ratio(s1, s2, n=2):
     if normalizer == 0: return 0
     return len(S1.intersection(S2)) / normalizer
 
+
+
+
+@check_types(str, str)   # this will be checkd first
+@check_empty_or_none     # this will be checked second
+@check_equivalence       # this will be checked last
+def phone_ratio(s1, s2):
+    """Similarity of two telephone numbers canonicalized to their digits (see canonical.py): the share of the common ending.
+    A number that is the ending of the other one (a missing country or area code) scores 0.9"""
+    if not (s1.isdigit() and s2.isdigit()):
+        return n_grams_ratio(s1, s2)   # not canonicalized
+    k = 0
+    for (c1, c2) in zip(reversed(s1), reversed(s2)):
+        if c1 != c2: break
+        k += 1
+    if k == min(len(s1), len(s2)) and k >= 6:
+        return 0.9
+    return k / max(len(s1), len(s2))
+
+
+
+@check_types(str, str)   # this will be checkd first
+@check_empty_or_none     # this will be checked second
+@check_equivalence       # this will be checked last
+def date_ratio(s1, s2):
+    """Similarity of two ISO dates (see canonical.py): 0.8 if the day and month are swapped,
+    0.6 if only one of the year, month and day differs (e.g. a typo), otherwise 0"""
+    if not (len(s1) == len(s2) == 10 and s1[4] == s2[4] == '-'):
+        return n_grams_ratio(s1, s2)   # not canonicalized
+    (y1, m1, d1), (y2, m2, d2) = ((s[:4], s[5:7], s[8:]) for s in (s1, s2))
+    if y1 == y2 and m1 == d2 and d1 == m2:
+        return 0.8
+    if (y1 == y2) + (m1 == m2) + (d1 == d2) == 2:
+        return 0.6
+    return 0.0
+
+
+
+@check_types(str, str)   # this will be checkd first
+@check_empty_or_none     # this will be checked second
+@check_equivalence       # this will be checked last
+def number_ratio(s1, s2):
+    """Similarity of two numbers (see canonical.py): 1 - the relative difference"""
+    try:
+        a, b = float(s1), float(s2)
+    except ValueError:
+        return n_grams_ratio(s1, s2)   # not canonicalized
+    if a == b:
+        return 1.0
+    return max(0.0, 1 - abs(a - b) / max(abs(a), abs(b)))
+
+
+
+def phonetic_words(value):
+    """The words of a value (upper case, letters only) for the phonetic codes"""
+    return ''.join(c if c.isalpha() else ' ' for c in str(value).upper()).split()
+
+
+
+@lru_cache(maxsize=PHONETIC_CACHE_SIZE)
+def soundex(value):
+    """Soundex codes of the words of a value, e.g. "ROBERT RUPERT" -> "R163 R163" (memoized)"""
+    codes = {**dict.fromkeys("BFPV", '1'), **dict.fromkeys("CGJKQSXZ", '2'), **dict.fromkeys("DT", '3'),
+             'L': '4', 'M': '5', 'N': '5', 'R': '6'}
+    words = list()
+    for word in phonetic_words(value):
+        code, last = word[0], codes.get(word[0], '')
+        for c in word[1:]:
+            d = codes.get(c, '')
+            if d and d != last:
+                code += d
+            if c not in "HW":   # H and W do not separate equal codes, vowels do
+                last = d
+        words.append((code + "000")[:4])
+    return ' '.join(words)
+
+
+
+@lru_cache(maxsize=PHONETIC_CACHE_SIZE)
+def cologne_phonetics(value):
+    """Kölner Phonetik (Cologne phonetics, made for German names) of the words of a value,
+    e.g. "LÜDERMANN" and "LUEDERMAN" -> "52766", "MEYER" and "MAIER" -> "67" (memoized)"""
+    words = list()
+    for word in phonetic_words(value):
+        digits = ''
+        for (k, c) in enumerate(word):
+            prev = word[k-1] if k else ' '
+            nxt = word[k+1] if k+1 < len(word) else ' '
+            if c in "AEIJOUYÄÖÜ":   d = '0'
+            elif c == 'B':          d = '1'
+            elif c == 'P':          d = '3' if nxt == 'H' else '1'
+            elif c in "DT":         d = '8' if nxt in "CSZ" else '2'
+            elif c in "FVW":        d = '3'
+            elif c in "GKQ":        d = '4'
+            elif c == 'C' and k == 0:
+                d = '4' if nxt in "AHKLOQRUX" else '8'
+            elif c == 'C':          d = '4' if nxt in "AHKOQUX" and prev not in "SZ" else '8'
+            elif c == 'X':          d = '8' if prev in "CKQ" else '48'
+            elif c == 'L':          d = '5'
+            elif c in "MN":         d = '6'
+            elif c == 'R':          d = '7'
+            elif c in "SZß":        d = '8'
+            else:                   d = ''   # H and the other characters
+            for x in d:
+                if not digits or digits[-1] != x:   # collapse repeated codes
+                    digits += x
+        digits = digits[:1] + digits[1:].replace('0', '')   # vowels only at the beginning
+        if digits:
+            words.append(digits)
+    return ' '.join(words)
+
+
+
+def phonetic_ratio(s1, s2, encoder=cologne_phonetics, codes=None):
+    """Levenshtein ratio raised by the phonetic codes: names with equal codes score at least PHONETIC_RATIO
+    (the Levenshtein distance is computed only if the lengths allow a higher ratio, e.g. a typo in a long name; equal names score 1).
+    codes : the codes of s1 and s2 if known (computed once per value while preparing the table, see model.phonetic_codes)"""
+    (code1, code2) = codes or (None, None)
+    code1 = encoder(s1) if code1 is None else code1
+    code2 = encoder(s2) if code2 is None else code2
+    if code1 and code1 == code2:
+        if abs(len(s1) - len(s2)) >= (1 - PHONETIC_RATIO) * (len(s1) + len(s2)):
+            return PHONETIC_RATIO   # the Levenshtein ratio is at most 1 - |len1 - len2| / (len1 + len2)
+        return max(PHONETIC_RATIO, levenshtein_ratio(s1, s2))
+    return levenshtein_ratio(s1, s2)
+
+
+
+@check_types(str, str)   # this will be checkd first
+@check_empty_or_none     # this will be checked second
+@check_equivalence       # this will be checked last
+def cologne_ratio(s1, s2, codes=None):
+    """phonetic_ratio with the Kölner Phonetik"""
+    return phonetic_ratio(s1, s2, encoder=cologne_phonetics, codes=codes)
+
+
+
+@check_types(str, str)   # this will be checkd first
+@check_empty_or_none     # this will be checked second
+@check_equivalence       # this will be checked last
+def soundex_ratio(s1, s2, codes=None):
+    """phonetic_ratio with the Soundex"""
+    return phonetic_ratio(s1, s2, encoder=soundex, codes=codes)
+
+
+
+# Select the backend at import
+set_backend()
@@ -9,85 +9,274 @@ The rest of these functions are helper functions for these two.
 
 import csv
 import os
-import sys
 import unicodedata
-from .metrics import cosine_similarity, levenshtein_ratio, token_set_ratio, n_grams_ratio
-from .utils import construct_filepath
+from array import array
+from .metrics import levenshtein_ratios, levenshtein_ratio, token_set_ratio, n_grams_ratio, phone_ratio, date_ratio, number_ratio
+from .metrics import cologne_ratio, soundex_ratio, cologne_phonetics, soundex
+from .utils import construct_filepath, csv_extension, open_csv, strip_csv_extension, read_csv_source
 from .utils import debug_report, debug_detect_duplicates, debug_merge_spreadsheets
+from .cache import cache_key, load_prepared, save_prepared
+from .blocking import build_candidate_index, candidate_rows, row_keys
+from .state import save_state, load_state
+from .reference import save_reference_index, load_reference_index, MappedRows
+from .scorecache import open_score_cache
+from .progress import progress_reporter
+from .stats import stage, make_stats
+from .profiling import profilable
+from .clustering import cluster_edges, cluster_matchings
+from .assignment import offset_ratio, greedy_assignment, top_candidates, heap_assignment
+from .screening import screen_bound, screen_grams, screen_ratio
+from .canonical import refine_column_types, canonicalize_rows
+from .vectorized import character_histograms, column_similarity_matrix, BigramIndex
+from .spilling import EdgeBuffer, CandidateLists
 
 
+# Similarity functions by column type (0 = word, 1 = set of words, 2 = digits+alpha,
+# the typed columns 3 = telephone, 4 = date, 5 = number, see canonical.py,
+# and the phonetic word columns 6 = Kölner Phonetik, 7 = Soundex) and their weights
+SIMILARITY_FUNCTIONS = (levenshtein_ratio, token_set_ratio, n_grams_ratio, phone_ratio, date_ratio, number_ratio,
+                        cologne_ratio, soundex_ratio)
+WEIGHTS = {0:2,   1:1,   2:1,   3:1,   4:1,   5:1,   6:2,   7:2}
 
+# Column types of the word columns by phonetic encoding (see the argument phonetic of prepare_table)
+PHONETIC_TYPES = {"cologne": 6, "soundex": 7}
+PHONETIC_ENCODERS = {6: cologne_phonetics, 7: soundex}
 
+
+
+
+@profilable
 def detect_duplicates(filepath: 'path to the input spreadsheet', 
                       includes_header: 'the first row is the header' = True,
                       includes_id_column: 'the first column is an id column with unique integers' = True,
                       filename: 'output file name' = None, 
                       directory: 'output directory' = None, 
                       threshold: 'similarity probability threshold' = None, 
+                      blocking: 'compare only rows sharing a blocking key' = False,
+                      clustering: 'clusters of duplicates of any size (union-find) instead of pairs' = False,
+                      max_diameter: 'clustering: maximum number of links between two rows of a cluster' = None,
+                      screen: 'lower bound of the cheap screen ratio (True = default), see screening.py' = None,
+                      typed_columns: 'telephone, date and number columns get their own types and comparators, see canonical.py' = False,
+                      phonetic: "'cologne' or 'soundex': name columns compared and blocked by their phonetic codes" = None,
+                      window: 'out of core: size of the sorted neighbourhood window, see neighbourhood.py' = None,
+                      memory_limit: 'budget of the scores and candidate pairs in bytes (spilled to disk above it), see spilling.py' = None,
+                      temp_dir: 'directory of the temporary files (out of core or spilled)' = None,
+                      cache_dir: 'directory for caching the prepared table' = None,
+                      cache_size: 'size limit of the cache directory in bytes' = None,
+                      state_file: 'file keeping the state for incremental runs' = None,
+                      score_cache: 'SQLite file (or PairScoreCache) caching the scores of value pairs' = None,
+                      progress: 'callback progress(stage, completed, total, rate), see progress.py' = None,
+                      stats: 'True (or a RunStats) to return (output file path, RunStats), see stats.py' = None,
+                      profile: "'cprofile' or 'sample' to save a profile into the output directory, see profiling.py" = None,
                       debugging=False) -> 'output file path':
     """Detects duplicates in a csv file and sorts rows: duplicates first, unique rows at the bottom
-    This function expects the input spreadsheet to have a header and id column, unless inicated explicetely"""
+    This function expects the input spreadsheet to have a header and id column, unless inicated explicetely
+    If clustering, all the rows linked by similar pairs share one new id (see cluster_duplicates and clustering.py)
+    If state_file exists, only the rows appended since the last run are compared (see update_duplicates);
+    clustering, typed_columns and phonetic must be the same as in the run that saved it, cache_dir raises a ValueError
+    If window, the rows are compared out of core with their window-1 neighbours in sorted orders (see neighbourhood.py);
+    the options of the in-memory run (blocking, screen, typed_columns, phonetic, clustering, the caches, state_file) raise a ValueError
+    If memory_limit, the scores and the candidate pairs are kept in compact buffers spilled to disk above the budget (see spilling.py)"""
+    
+    # The out-of-core run has none of the options of the in-memory run
+    if window:
+        options = dict(blocking=blocking, screen=screen, typed_columns=typed_columns, phonetic=phonetic, clustering=clustering,
+                       max_diameter=max_diameter, cache_dir=cache_dir, score_cache=score_cache, state_file=state_file)
+        given = [name for (name, value) in options.items() if value]
+        if given:
+            raise ValueError("{} can't be combined with window (the out-of-core run, see neighbourhood.py)".format(', '.join(given)))
+    
+    # The state file keeps the prepared table of the incremental runs (instead of the cache directory)
+    if state_file and cache_dir:
+        raise ValueError("cache_dir can't be combined with state_file (the state file keeps the prepared table)")
+    
+    # Incremental run
+    if state_file and os.path.exists(state_file):
+        return update_duplicates(filepath, state_file, includes_header=includes_header, includes_id_column=includes_id_column,
+                                 filename=filename, directory=directory, threshold=threshold, blocking=blocking,
+                                 clustering=clustering, max_diameter=max_diameter, screen=screen, typed_columns=typed_columns,
+                                 phonetic=phonetic, memory_limit=memory_limit, temp_dir=temp_dir,
+                                 score_cache=score_cache, progress=progress, stats=stats)
+    
+    # Out-of-core run: the sorted neighbourhood method
+    if window:
+        from .neighbourhood import detect_duplicates_out_of_core
+        return detect_duplicates_out_of_core(filepath, includes_header=includes_header, includes_id_column=includes_id_column,
+                                             filename=filename, directory=directory, threshold=threshold, window=window,
+                                             temp_dir=temp_dir, memory_limit=memory_limit, progress=progress, stats=stats)
     
     # Defaults
-    threshold = threshold or 0.45
+    stats = make_stats(stats)
+    
+    # Load rows, get column types, normalize etc.
+    table = prepare_table(filepath, includes_header=includes_header, includes_id_column=includes_id_column,
+                          cache_dir=cache_dir, cache_size=cache_size, progress=progress, stats=stats, typed_columns=typed_columns,
+                          phonetic=phonetic)
+    header, rows, normalized = table["header"], table["rows"], table["normalized"]
+    column_types, codes = table["column_types"], table.get("phonetic")
+    
+    # Score the pairs of rows and match (or cluster) the duplicates
+    edges = None
+    if clustering:
+        matchings = cluster_duplicates(normalized, column_types, threshold=threshold, blocking=blocking, index=table["index"],
+                                       max_diameter=max_diameter, screen=screen, score_cache=score_cache, progress=progress,
+                                       stats=stats, memory_limit=memory_limit, temp_dir=temp_dir, keep_edges=bool(state_file),
+                                       codes=codes)
+        if state_file:
+            matchings, edges = matchings
+    else:
+        matchings = match_duplicates(rows, normalized, column_types, threshold=threshold, blocking=blocking, index=table["index"],
+                                     screen=screen, score_cache=score_cache, progress=progress, stats=stats, debugging=debugging,
+                                     memory_limit=memory_limit, temp_dir=temp_dir, codes=codes)
+    if debugging:
+        debug_detect_duplicates(filepath, rows, matchings)
     
-    # Get column types
-    column_types = determine_column_types(filepath, includes_header=includes_header, includes_id_column=includes_id_column)
+    # Save the state for the next (incremental) run (with clustering, the edges are kept to re-cluster)
+    if state_file:
+        save_state(state_file, dict(header=header, rows=rows, normalized=normalized, column_types=column_types,
+                                    index=table["index"], phonetic=codes, matchings=matchings, clustering=bool(clustering),
+                                    options=dict(typed_columns=bool(typed_columns), phonetic=phonetic or None),
+                                    edges=edges, threshold=threshold or 0.45))
     
-    # Load rows
-    header, rows = load_rows(filepath, includes_header=includes_header, includes_id_column=includes_id_column)
+    # Construct output filepath
+    output_filepath = construct_filepath(filename=filename or "sorted_duplicates.csv", directory=directory)
+    with stage(stats, "writing"):
+        output_filepath = write_sorted_rows(header, rows, matchings, output_filepath=output_filepath, progress=progress)
+    return (output_filepath, stats.finish()) if stats else output_filepath
+
+
+
+def match_duplicates(rows, normalized, column_types, threshold=None, blocking=False, index=None, screen=None,
+                     score_cache=None, progress=None, stats=None, debugging=False, memory_limit=None, temp_dir=None, codes=None):
+    """
+    Finds the duplicates among the rows of a prepared table (see prepare_table): the core of detect_duplicates.
+    rows, normalized, column_types, index : as in the prepared table (the index is built if not provided and blocking)
+    screen : lower bound of the screen ratio (True = the default bound), only the pairs above it are scored (see screening.py)
+    memory_limit : budget in bytes - instead of the square matrix only the most similar row of each row is kept (in arrays)
+                   and the rankings are spilled into temp_dir above the budget (see spilling.py). Ignored if debugging
+    codes : the phonetic codes of the prepared table (see phonetic_codes), compared instead of encoding the values per pair
+    The other arguments are the same as in detect_duplicates.
+    Returns matchings: a list of pairs of row indeces (i,j) sorted by i, followed by (i,None) for the unmatched rows
+    """
+    
+    # Defaults
+    threshold = threshold or 0.45
     includes_id_column = True   # because load_rows()  automatiucally adds an id column if missing
     
-    # Make a square matrix    
+    # Blocking: compare only the rows that share a blocking key
+    if blocking:
+        index = index if index is not None else build_candidate_index(normalized, column_types)
+        columns = [(i, i, t) for (i, t) in enumerate(column_types)]
+    
+    # Screening: score only the pairs with a screen ratio above the lower bound
+    screen = screen_bound(screen)
+    if screen is not None:
+        grams = screen_grams(normalized, range(len(column_types)))
+    
+    # Cache of the scores of value pairs
+    score_cache, opened = open_score_cache(score_cache)
+    cache_counts = (score_cache.hits, score_cache.misses) if score_cache else None
+    
+    # Similarity functions (timed if instrumented)
+    functions = stats.timed_functions(SIMILARITY_FUNCTIONS) if stats else None
+    
+    # Batched scoring with the bigram kernels of the n-gram columns (see row_similarities), the misses of the score cache as well
+    bigrams = bigram_indexes(normalized, [(i, i) for i in range(len(column_types))], column_types)
+    
+    # Make a square matrix, or with a memory budget keep only the most similar row of each row (the first one of equal ratios)
     m = n = len(rows)
-    mx = [];  [mx.append([0,]*n) for _ in range(m)]   # square matirx
+    budgeted = memory_limit is not None and not debugging
+    if budgeted:
+        best_ratios, best_rows = array('d', [0.0]) * n, array('I', [0]) * n
+    else:
+        mx = [];  [mx.append([0,]*n) for _ in range(m)]   # square matirx
     
     # Compute matching ratios
-    for (i, _) in enumerate(rows):
-        #See the progress
-        if debugging and len(rows) >= 40:
-            sys.stdout.write('\r' + ("Progress:" + str(round(i/n*100)).rjust(3) + "%")) # \r prints a carriage return first, so s is printed on top of the previous line
-            sys.stdout.flush()  # comment out if not necessary
-            
-        for j in range(i+1, len(rows)):
-            mx[i][j] = row_similarity(rows[i], rows[j],
-                         column_types=column_types,
-                         includes_id_column=includes_id_column)
-    # Print a new line after the progress bar
-    if debugging and len(rows) >= 40: 
-        sys.stdout.write('\r' + ("Progress:100%"))
-        print()
+    with stage(stats, "scoring"):
+        report = progress_reporter(progress, "scoring", n, debugging=debugging and len(rows) >= 40)
+        for (i, _) in enumerate(rows):
+            #See the progress
+            if report: report(i)
+        
+            if blocking:
+                js = sorted(j for j in candidate_rows(index, row_keys(normalized[i], columns)) if j > i)
+            else:
+                js = range(i+1, len(rows))
+            if screen is not None:
+                n_js = len(js)
+                js = [j for j in js if screen_ratio(grams[i], grams[j]) >= screen]
+                if stats: stats.count("pairs_screened_out", n_js - len(js))
+            if score_cache:
+                score_cache.prefetch(tile_keys(normalized[i], normalized, js, column_types=column_types))
+            ratios = row_similarities(normalized[i], normalized, js, column_types=column_types, includes_id_column=includes_id_column,
+                                      bigrams=bigrams, functions=functions, codes=(codes[i], codes) if codes else None,
+                                      score_cache=score_cache, stats=stats)
+            for (j, r) in zip(js, ratios):
+                if not budgeted:
+                    mx[i][j] = r
+                    continue
+                if r > best_ratios[i]: best_ratios[i], best_rows[i] = r, j
+                if r > best_ratios[j]: best_ratios[j], best_rows[j] = r, i
+            if score_cache:
+                score_cache.flush()
+            if stats: stats.count("pairs_scored", len(js))
+        if report: report.done()
+    
+    if stats:
+        stats.count("pairs_total", n * (n - 1) // 2)
+        stats.add_score_cache(score_cache, since=cache_counts)
+    if opened: score_cache.close()
+    
+    # With a memory budget: the rankings are sorted (spilled above the budget) and assigned without the matrix
+    if budgeted:
+        with stage(stats, "assignment"), EdgeBuffer(('d', 'I', 'I'), memory_limit, temp_dir) as rankings:
+            for i in range(n):
+                rankings.add(-best_ratios[i], i, best_rows[i])
+            matchings, free = list(), bytearray(b'\x01') * n
+            for (i, j, _) in greedy_assignment(((i, j, -r) for (r, i, j) in rankings.sorted()), threshold, duplicates=True, size=n):
+                matchings.append((i,j))
+                free[i] = free[j] = 0
+            matchings = sorted(matchings, key=lambda t: t[0])
+            nx = [i for i in range(n) if free[i]]
+            [matchings.append((i,None)) for i in nx]
+        if stats:
+            stats.count("matched", 2 * (len(matchings) - len(nx)))
+            stats.count("unmatched", len(nx))
+            stats.count("spilled_runs", rankings.spills)
+        return matchings
     
     # Reflect the mx
     [mx[i].__setitem__(j, mx[j][i]) for i in range(len(rows)) for j in range(len(rows)) if j<i]
     
     # Sort
-    rankings = list()
-    for i,row in enumerate(mx):
-        rankings.append((i, row.index(max(row)), max(row)))
-    rankings = sorted(rankings, reverse=True, key=lambda t: t[2]) 
+    with stage(stats, "assignment"):
+        rankings = list()
+        for i,row in enumerate(mx):
+            rankings.append((i, row.index(max(row)), max(row)))
+        rankings = sorted(rankings, reverse=True, key=lambda t: t[2]) 
     
-    # For debugging purposes
-    debugging_matchings = list()
+        # For debugging purposes
+        debugging_matchings = list()
     
-    # Make matchings
-    matchings = list()
-    nx = set(t[0] for t in rankings)  # remove is the method
+        # Make matchings
+        matchings = list()
+        nx = set(t[0] for t in rankings)  # remove is the method
     
-    for (i,j,r) in rankings:
-        match = r >= threshold   # arbitrary threshold values
-        if match and (j in nx) and (i in nx):
+        for (i,j,r) in greedy_assignment(rankings, threshold, duplicates=True):
             matchings.append((i,j))
             nx.remove(i)
-            nx.remove(j)   # prevent double matching
+            nx.remove(j)
             if debugging:
                 debugging_matchings.append((int(rows[i][0]), int(rows[j][0]), round(r,2)))
     
-    # Sort the matchings lt
-    matchings = sorted(matchings, key=lambda t: t[0])
+        # Sort the matchings lt
+        matchings = sorted(matchings, key=lambda t: t[0])
     
-    # Add unmatched rows
-    [matchings.append((i,None)) for i in nx]
+        # Add unmatched rows
+        [matchings.append((i,None)) for i in nx]
+    if stats:
+        stats.count("matched", 2 * (len(matchings) - len(nx)))
+        stats.count("unmatched", len(nx))
     
     # Debugging
     if debugging:
@@ -103,68 +292,517 @@ def detect_duplicates(filepath: 'path to the input spreadsheet',
             this.matchings = matchings
             this.debugging_matchings = debugging_matchings 
         debug_report(this)
-        debug_detect_duplicates(filepath, rows, matchings)
-    
-    # Unravel the indeces
-    nx_unravelled = [i for i in sum(matchings, ()) if i is not None]
-    assert len(nx_unravelled) == len(set(nx_unravelled))
-    
-    # Make new index
-    g = zip(sum(((i,i) for i in range(len(matchings))), ()), sum(matchings, ()))
-    nx_new = [i for i,j in g if j is not None]
-    assert len(nx_new) == len(nx_unravelled)
+    return matchings
+
+
+
+
+def cluster_duplicates(normalized, column_types, threshold=None, blocking=False, index=None, max_diameter=None, screen=None,
+                       score_cache=None, progress=None, stats=None, memory_limit=None, temp_dir=None, keep_edges=False, codes=None):
+    """
+    Clusters the duplicates among the normalized rows of a prepared table (see prepare_table and clustering.py).
+    Every scored pair with a similarity ratio of at least the threshold is an edge; the clusters are the connected rows
+    (with at most max_diameter links between any two rows of a cluster, if given). Only the edges are kept in memory,
+    in compact arrays spilled into temp_dir above memory_limit if given (see spilling.py).
+    The other arguments are the same as in match_duplicates.
+    Returns matchings: a tuple of row indeces per cluster sorted by the first row, followed by (i,None) for the unique rows
+    (and the edges as a list of (i, j, ratio) sorted by (i, j) if keep_edges, for the state of incremental runs, see update_duplicates)
+    """
     
-    # Make new header
-    header = ("id(new)",) + tuple(header)
+    # Defaults
+    threshold = threshold or 0.45
     
-    # Construct output filepath
-    output_filepath = construct_filepath(filename=filename or "sorted_duplicates.csv", directory=directory)
+    # Blocking: compare only the rows that share a blocking key
+    if blocking:
+        index = index if index is not None else build_candidate_index(normalized, column_types)
+        columns = [(i, i, t) for (i, t) in enumerate(column_types)]
+    
+    # Screening: score only the pairs with a screen ratio above the lower bound
+    screen = screen_bound(screen)
+    if screen is not None:
+        grams = screen_grams(normalized, range(len(column_types)))
+    
+    # Cache of the scores of value pairs and the similarity functions (timed if instrumented)
+    score_cache, opened = open_score_cache(score_cache)
+    cache_counts = (score_cache.hits, score_cache.misses) if score_cache else None
+    functions = stats.timed_functions(SIMILARITY_FUNCTIONS) if stats else None
+    bigrams = bigram_indexes(normalized, [(i, i) for i in range(len(column_types))], column_types)
+    
+    # Collect the edges (the pairs above the threshold)
+    n = len(normalized)
+    edges = EdgeBuffer(('d', 'I', 'I'), memory_limit, temp_dir) if memory_limit is not None else list()
+    report = progress_reporter(progress, "scoring", n)
+    with stage(stats, "scoring"):
+        for i in range(n):
+            if report: report(i)
+            if blocking:
+                js = sorted(j for j in candidate_rows(index, row_keys(normalized[i], columns)) if j > i)
+            else:
+                js = range(i+1, n)
+            if screen is not None:
+                n_js = len(js)
+                js = [j for j in js if screen_ratio(grams[i], grams[j]) >= screen]
+                if stats: stats.count("pairs_screened_out", n_js - len(js))
+            if score_cache:
+                score_cache.prefetch(tile_keys(normalized[i], normalized, js, column_types=column_types))
+            ratios = row_similarities(normalized[i], normalized, js, column_types=column_types, bigrams=bigrams, functions=functions,
+                                      codes=(codes[i], codes) if codes else None, score_cache=score_cache, stats=stats)
+            for (j, r) in zip(js, ratios):
+                if r >= threshold:
+                    if memory_limit is None:
+                        edges.append((i, j, r))
+                    else:
+                        edges.add(-r, i, j)
+            if score_cache:
+                score_cache.flush()
+            if stats: stats.count("pairs_scored", len(js))
+    if report: report.done()
+    if stats:
+        stats.count("pairs_total", n * (n - 1) // 2)
+        stats.add_score_cache(score_cache, since=cache_counts)
+    if opened: score_cache.close()
+    
+    # Clusters (the spilled edges are merged back in descending order of the ratio)
+    with stage(stats, "assignment"):
+        if memory_limit is None:
+            clusters = cluster_edges(n, edges, max_diameter=max_diameter)
+            kept = edges if keep_edges else None
+        else:
+            with edges:
+                ranked = ((i, j, -r) for (r, i, j) in edges.sorted())
+                kept = list(ranked) if keep_edges else None   # the state keeps all the edges anyway
+                clusters = cluster_edges(n, kept if keep_edges else ranked, max_diameter=max_diameter, presorted=True)
+                if keep_edges: kept.sort()
+        matchings = cluster_matchings(clusters)
+    if stats:
+        stats.count("edges", len(edges))
+        if memory_limit is not None: stats.count("spilled_runs", edges.spills)
+        stats.count("matched", sum(len(c) for c in clusters if len(c) > 1))
+        stats.count("unmatched", sum(1 for c in clusters if len(c) == 1))
+    return (matchings, kept) if keep_edges else matchings
+
+
+
+
+def update_duplicates(filepath, state_file,
+                      includes_header=True, includes_id_column=True,
+                      filename=None, directory=None,
+                      threshold=None, blocking=False, clustering=False, max_diameter=None, screen=None, typed_columns=False,
+                      phonetic=None, memory_limit=None, temp_dir=None, score_cache=None, progress=None, stats=None):
+    """
+    Incremental version of detect_duplicates (called by detect_duplicates if its state_file exists).
+    Only the rows appended since the last run are compared: new x existing and new x new pairs.
+    The existing matchings are kept, the new rows are matched with the unmatched existing rows or with each other.
+    With clustering (only for a state saved with clustering), the edges of the new rows are added to the kept edges
+    of the last run and all the rows are re-clustered (with max_diameter), as in a full run (see cluster_duplicates).
+    typed_columns and phonetic fix the column types of the state, they must be the same as in the run that saved it.
+    screen : lower bound of the screen ratio, only the new pairs above it are scored (see screening.py)
+    The input file holds either the whole table (the rows from the last run followed by the appended rows)
+    or only the appended rows (with the same columns).
+    memory_limit : budget in bytes - the new edges (with clustering) and the rankings of the new rows are kept in arrays
+                   spilled into temp_dir above the budget (see spilling.py), as in cluster_duplicates and match_duplicates
+    Returns the output file path (and the RunStats if stats, see detect_duplicates). The state file is updated.
+    """
     
-    # Write to file
-    output_filepath = output_filepath or "output.csv"
-    with open(output_filepath, mode='wt', encoding='utf_8') as fw:
-        wr = csv.writer(fw)
-        wr.writerow(header)
-        for (i,ix) in zip(nx_unravelled, nx_new):
-            row = (ix + 1,) + tuple(rows[i])
-            wr.writerow(row)
-    return output_filepath
+    # Defaults
+    threshold = threshold or 0.45
+    stats = make_stats(stats)
+    
+    # Load the state of the last run and the rows
+    with stage(stats, "loading"):
+        state = load_state(state_file)
+        header, rows = load_rows(filepath, includes_header=includes_header, includes_id_column=includes_id_column, progress=progress)
+    rows_old, normalized_old, column_types = state["rows"], state["normalized"], state["column_types"]
+    k = len(rows_old)
+    if len(header) != len(state["header"]):
+        raise ValueError("the appended rows must have the same columns as the rows from the previous run")
+    if bool(clustering) != state.get("clustering", False):
+        raise ValueError("the state file was saved {} clustering, run with clustering={}".format(
+                         "with" if state.get("clustering") else "without", bool(state.get("clustering"))))
+    for (name, value) in dict(typed_columns=bool(typed_columns), phonetic=phonetic or None).items():
+        if value != state["options"][name]:
+            raise ValueError(f"the state file was saved with {name}={state['options'][name]!r}, run with the same {name}")
+    if clustering and threshold < state["threshold"]:
+        raise ValueError(f"the state file keeps only the edges with a ratio of at least {state['threshold']}, "
+                         "the threshold can't be lower")
+    
+    # Whole table or only the appended rows?
+    if len(rows) >= k and all(tuple(a) == tuple(b) for (a,b) in zip(rows, rows_old)):
+        rows_new = list(rows[k:])
+    else:
+        rows_new = list(rows)
+        if state["header"][0] == "_id_":   # generic id's must continue from the last run
+            rows_new = [(k + i,) + tuple(row[1:]) for (i, row) in enumerate(rows_new)]
+    
+    # Extend the rows and the candidate index with the appended rows
+    rows = list(rows_old) + rows_new
+    normalized_new = canonicalize_rows(normalize_rows(rows_new), column_types)
+    normalized = list(normalized_old) + normalized_new
+    codes = state.get("phonetic")
+    if codes:
+        codes = list(codes) + phonetic_codes(normalized_new, column_types)
+    index = state["index"]
+    columns = [(i, i, t) for (i, t) in enumerate(column_types)]
+    for i in range(k, len(rows)):
+        for key in row_keys(normalized[i], columns):
+            index.setdefault(key, []).append(i)
+    
+    # Screening: score only the pairs with a screen ratio above the lower bound
+    screen = screen_bound(screen)
+    if screen is not None:
+        grams = screen_grams(normalized, range(len(column_types)))
+    
+    # Compare the new rows against all the other rows (each pair once)
+    score_cache, opened = open_score_cache(score_cache)
+    cache_counts = (score_cache.hits, score_cache.misses) if score_cache else None
+    functions = stats.timed_functions(SIMILARITY_FUNCTIONS) if stats else None
+    budgeted = memory_limit is not None
+    best = dict()   # row index -> (index of the most similar row, similarity ratio)
+    if budgeted:    # the same in arrays over the new rows (the first one of equal ratios)
+        best_ratios, best_rows = array('d', [-1.0]) * (len(rows) - k), array('I', [0]) * (len(rows) - k)
+    edges = [t for t in state["edges"] if t[2] >= threshold] if clustering else None
+    new_edges = EdgeBuffer(('d', 'I', 'I'), memory_limit, temp_dir) if clustering and budgeted else edges
+    report = progress_reporter(progress, "scoring", len(rows) - k)
+    with stage(stats, "scoring"):
+        for i in range(k, len(rows)):
+            if report: report(i - k)
+            js = sorted(j for j in candidate_rows(index, row_keys(normalized[i], columns)) if j < i) if blocking else range(i)
+            if screen is not None:
+                n_js = len(js)
+                js = [j for j in js if screen_ratio(grams[j], grams[i]) >= screen]
+                if stats: stats.count("pairs_screened_out", n_js - len(js))
+            # The earlier row is on the left, as in a full run (the similarity is not symmetric)
+            if score_cache:
+                score_cache.prefetch((name, b, a) for (name, a, b) in tile_keys(normalized[i], normalized, js, column_types=column_types))
+            for j in js:
+                r = row_similarity(normalized[j], normalized[i], column_types=column_types, normalized=True, score_cache=score_cache,
+                                   functions=functions, codes=(codes[j], codes[i]) if codes else None)
+                if clustering:
+                    if r >= threshold:
+                        if budgeted:
+                            new_edges.add(-r, j, i)
+                        else:
+                            edges.append((j, i, r))
+                    continue
+                if budgeted:
+                    if r > best_ratios[i - k]: best_ratios[i - k], best_rows[i - k] = r, j
+                    if j >= k and r > best_ratios[j - k]: best_ratios[j - k], best_rows[j - k] = r, i
+                    continue
+                if r > best.get(i, (None, -1))[1]: best[i] = (j, r)
+                if j >= k and r > best.get(j, (None, -1))[1]: best[j] = (i, r)
+            if score_cache:
+                score_cache.flush()
+            if stats: stats.count("pairs_scored", len(js))
+    if report: report.done()
+    if stats:
+        stats.count("pairs_total", sum(range(k, len(rows))))
+        stats.add_score_cache(score_cache, since=cache_counts)
+    if opened: score_cache.close()
+    if not budgeted:
+        for i in range(k, len(rows)):
+            best.setdefault(i, (i, 0))
+    
+    # Re-cluster all the rows (the edges in the order of a full run), or
+    # make matchings among the free rows (the unmatched existing rows and the new rows)
+    # With a memory budget, the spilled edges (the state keeps all the edges anyway) and rankings are merged back in order
+    if clustering:
+        if budgeted:
+            with new_edges:
+                edges.extend((i, j, -r) for (r, i, j) in new_edges.sorted())
+            if stats: stats.count("spilled_runs", new_edges.spills)
+        edges.sort()
+        clusters = cluster_edges(len(rows), edges, max_diameter=max_diameter)
+        matchings = cluster_matchings(clusters)
+        n_matched = sum(len(c) for c in clusters if len(c) > 1)
+    else:
+        matched = [t for t in state["matchings"] if None not in t]
+        nx = {t[0] for t in state["matchings"] if t[1] is None}.union(range(k, len(rows)))
+        if budgeted:
+            rankings = EdgeBuffer(('d', 'I', 'I'), memory_limit, temp_dir)
+            for (i, (r, j)) in enumerate(zip(best_ratios, best_rows), start=k):
+                rankings.add(-max(r, 0), i, j if r >= 0 else i)
+            ranked = ((i, j, -r) for (r, i, j) in rankings.sorted())
+        else:
+            ranked = sorted(((i,j,r) for (i,(j,r)) in best.items()), reverse=True, key=lambda t: t[2])
+        for (i,j,r) in greedy_assignment(ranked, threshold, duplicates=True, free=set(nx)):
+            matched.append((min(i,j), max(i,j)))
+            nx.remove(i)
+            nx.remove(j)
+        if budgeted:
+            rankings.close()
+            if stats: stats.count("spilled_runs", rankings.spills)
+        matchings = sorted(matched, key=lambda t: t[0]) + [(i,None) for i in sorted(nx)]
+        n_matched = 2 * len(matched)
+    if stats:
+        stats.count("matched", n_matched)
+        stats.count("unmatched", len(rows) - n_matched)
+    
+    # Save the state and write the output
+    with stage(stats, "writing"):
+        save_state(state_file, dict(state, rows=rows, normalized=normalized, index=index, phonetic=codes, matchings=matchings,
+                                    edges=edges, threshold=threshold if clustering else state.get("threshold")))
+        output_filepath = construct_filepath(filename=filename or "sorted_duplicates.csv", directory=directory)
+        output_filepath = write_sorted_rows(state["header"], rows, matchings, output_filepath=output_filepath, progress=progress)
+    return (output_filepath, stats.finish()) if stats else output_filepath
 
 
 
-def merge_spreadsheets(filepath1: 'path to the first spreadsheet', filepath2: 'path to the second spreadsheet',
+@profilable
+def merge_spreadsheets(filepath1: 'path to the first spreadsheet', filepath2: 'path to the second spreadsheet' = None,
                        includes_header: 'the first row is the header' = True,
                        includes_id_column: 'the first column is an id column with unique integers' = True,
                        filename: 'output file name' = None, directory: 'output directory' = None, 
                        threshold: 'similarity probability threshold' = None, 
                        columns_matching: 'ratio of column names matching vs. vectorized values distribution technique' = None,
+                       blocking: 'compare only rows sharing a blocking key' = False,
+                       cache_dir: 'directory for caching the prepared tables' = None,
+                       cache_size: 'size limit of the cache directory in bytes' = None,
+                       reference_index: 'reference index file (or loaded index) replacing the second spreadsheet' = None,
+                       score_cache: 'SQLite file (or PairScoreCache) caching the scores of value pairs' = None,
+                       assignment: "'greedy' or 'heap' (falls back to the next best free row), see assignment.py" = None,
+                       screen: 'lower bound of the cheap screen ratio (True = default), see screening.py' = None,
+                       typed_columns: 'telephone, date and number columns get their own types and comparators, see canonical.py' = False,
+                       phonetic: "'cologne' or 'soundex': name columns compared and blocked by their phonetic codes" = None,
+                       memory_limit: 'budget of the scores and candidate pairs in bytes (spilled to disk above it), see spilling.py' = None,
+                       temp_dir: 'directory of the spilled temporary files' = None,
+                       progress: 'callback progress(stage, completed, total, rate), see progress.py' = None,
+                       stats: 'True (or a RunStats) to return (output file path, RunStats), see stats.py' = None,
+                       profile: "'cprofile' or 'sample' to save a profile into the output directory, see profiling.py" = None,
                        debugging=False) -> 'output file path':
     """Merges two spreadsheets into one detecting and combining any duplicates.
     This function expects that both spreadsheets have an id column with unique integers,
     unless explicetely indicated in the arguments (includes_id_column).
+    If a reference index is provided (see build_reference_index), it serves as the right table instead of filepath2
+    and the rows are compared by candidate lookups (blocking).
     (this function is a wrapper function, executing the spreadsheet merging process)"""
     
-    file_left, file_right, column_matchings, column_types = match_columns(filepath1, filepath2,
-                                                includes_header=includes_header,
-                                                includes_id_column=includes_id_column,
+    stats = make_stats(stats)
+    table1 = prepare_table(filepath1, includes_header=includes_header, includes_id_column=includes_id_column,
+                           cache_dir=cache_dir, cache_size=cache_size, progress=progress, stats=stats, typed_columns=typed_columns,
+                           phonetic=phonetic)
+    if reference_index is not None:
+        with stage(stats, "loading"):
+            table2 = load_reference_index(reference_index) if isinstance(reference_index, (str, os.PathLike)) else reference_index
+        blocking = True
+    else:
+        table2 = prepare_table(filepath2, includes_header=includes_header, includes_id_column=includes_id_column,
+                               cache_dir=cache_dir, cache_size=cache_size, progress=progress, stats=stats, typed_columns=typed_columns,
+                               phonetic=phonetic)
+    with stage(stats, "match_columns"):
+        table_left, table_right, column_matchings, column_types = match_prepared_columns(table1, table2,
                                                 ignore_column_types_when_matching_columns=False,
-                                                proportion_of_column_names_similarity=columns_matching)
-    header_left,  rows_left  = load_rows(file_left,  includes_header=includes_header, includes_id_column=includes_id_column)
-    header_right, rows_right = load_rows(file_right, includes_header=includes_header, includes_id_column=includes_id_column)
-    
-    row_matchings = match_rows(rows_left, rows_right, column_matchings, column_types, 
-                               threshold=threshold, debugging=debugging)
+                                                proportion_of_column_names_similarity=columns_matching,
+                                                swap=reference_index is None)
+    file_left,  header_left,  rows_left  = (table_left[k]  for k in ("filepath", "header", "rows"))
+    file_right, header_right, rows_right = (table_right[k] for k in ("filepath", "header", "rows"))
+    
+    row_matchings = match_rows(table_left["normalized"], table_right["normalized"], column_matchings, column_types, 
+                               threshold=threshold, debugging=debugging, normalized=True,
+                               blocking=blocking, index=table_right["index"], score_cache=score_cache, progress=progress,
+                               stats=stats, assignment=assignment, screen=screen, memory_limit=memory_limit, temp_dir=temp_dir,
+                               reference_index=table2 if reference_index is not None else None,
+                               codes=(table_left.get("phonetic"), table_right.get("phonetic")))
     
     # Construct output filepath
     output_filepath = construct_filepath(filename=filename or "merged_spreadsheet.csv", directory=directory)
     
-    output_filepath = write_rows(header_left, rows_left, header_right, rows_right,
-                                   column_matchings, row_matchings,
-                                   output_filepath=output_filepath)
+    with stage(stats, "writing"):
+        output_filepath = write_rows(header_left, rows_left, header_right, rows_right,
+                                       column_matchings, row_matchings,
+                                       output_filepath=output_filepath, progress=progress)
     # Debug
     if debugging:
         debug_merge_spreadsheets(file_left, file_right, rows_left, rows_right, row_matchings)   # the new (short) report (comes second)
-    return output_filepath
+    return (output_filepath, stats.finish()) if stats else output_filepath
+
+
+
+
+def detect_duplicate_rows(source, includes_header=True, includes_id_column=True, threshold=None, blocking=False,
+                          screen=None, typed_columns=False, phonetic=None, score_cache=None, progress=None, stats=None):
+    """
+    In-memory version of detect_duplicates: nothing is read from or written to disk.
+    source : bytes (plain or compressed csv), a file-like object (e.g. an uploaded file stream) or an iterable of rows
+    The other arguments are the same as in detect_duplicates.
+    
+    Returns
+    -------
+    a dict with the keys:
+        header : the header of the sorted rows (with the new id column "id(new)" first)
+        rows : a list of the sorted rows (the content of the output file of detect_duplicates)
+        pairs : a list of tuples (i, j, similarity ratio) - indeces of duplicate rows (zero-based, not counting the header)
+        unmatched : a list of indeces of the unique rows
+        stats : a RunStats (only if stats, see stats.py)
+    """
+    stats = make_stats(stats)
+    table = prepare_table(source, includes_header=includes_header, includes_id_column=includes_id_column,
+                          progress=progress, stats=stats, typed_columns=typed_columns, phonetic=phonetic)
+    rows, normalized, column_types, codes = table["rows"], table["normalized"], table["column_types"], table.get("phonetic")
+    matchings = match_duplicates(rows, normalized, column_types, threshold=threshold, blocking=blocking, index=table["index"],
+                                 screen=screen, score_cache=score_cache, progress=progress, stats=stats, codes=codes)
+    
+    # Similarity ratios of the duplicates (each pair was scored with the smaller index on the left)
+    pairs = [(i, j, row_similarity(normalized[min(i,j)], normalized[max(i,j)], column_types=column_types, normalized=True,
+                                   codes=(codes[min(i,j)], codes[max(i,j)]) if codes else None))
+             for (i,j) in matchings if j is not None]
+    header, lines, _ = sorted_rows(table["header"], rows, matchings)
+    result = dict(header=header, rows=list(lines), pairs=pairs, unmatched=[i for (i,j) in matchings if j is None])
+    if stats: result["stats"] = stats.finish()
+    return result
+
+
+
+
+def merge_tables(source1, source2, includes_header=True, includes_id_column=True, threshold=None, columns_matching=None,
+                 blocking=False, score_cache=None, assignment=None, screen=None, typed_columns=False, phonetic=None,
+                 progress=None, stats=None):
+    """
+    In-memory version of merge_spreadsheets: nothing is read from or written to disk.
+    source1, source2 : bytes (plain or compressed csv), file-like objects (e.g. uploaded file streams) or iterables of rows
+    The other arguments are the same as in merge_spreadsheets.
+    
+    Returns
+    -------
+    a dict with the keys:
+        header : the merged header
+        rows : a list of the merged rows (the content of the output file of merge_spreadsheets)
+        column_matchings : a list of tuples (column of source1, column of source2) - zero-based, not counting the id column
+        pairs : a list of tuples (i, j, similarity ratio) - i is a row index of source1, j of source2 (zero-based, not counting the header)
+        unmatched1, unmatched2 : lists of the row indeces of source1 and source2 without a match
+        stats : a RunStats (only if stats, see stats.py)
+    """
+    stats = make_stats(stats)
+    table1, table2 = (prepare_table(source, includes_header=includes_header, includes_id_column=includes_id_column,
+                                    progress=progress, stats=stats, typed_columns=typed_columns, phonetic=phonetic)
+                      for source in (source1, source2))
+    with stage(stats, "match_columns"):
+        table_left, table_right, column_matchings, column_types = match_prepared_columns(table1, table2,
+                                                proportion_of_column_names_similarity=columns_matching)
+    row_matchings = match_rows(table_left["normalized"], table_right["normalized"], column_matchings, column_types,
+                               threshold=threshold, normalized=True, blocking=blocking, index=table_right["index"],
+                               score_cache=score_cache, progress=progress, stats=stats, assignment=assignment, screen=screen,
+                               codes=(table_left.get("phonetic"), table_right.get("phonetic")))
+    header, lines = merged_rows(table_left["header"], table_left["rows"], table_right["header"], table_right["rows"],
+                                column_matchings, row_matchings)
+    
+    # Similarity ratios of the matched rows, with the indeces in the order of the sources
+    codes_left, codes_right = table_left.get("phonetic"), table_right.get("phonetic")
+    pairs = [(i, j, row_similarity(table_left["normalized"][i], table_right["normalized"][j], column_matchings, column_types,
+                                   normalized=True, codes=(codes_left[i], codes_right[j]) if codes_left and codes_right else None))
+             for (i,j) in row_matchings if None not in (i,j)]
+    swapped = table_left is not table1
+    flip = (lambda t: (t[1], t[0]) + tuple(t[2:])) if swapped else tuple
+    result = dict(header=header, rows=list(lines),
+                  column_matchings=[flip(t) for t in column_matchings],
+                  pairs=[flip(t) for t in pairs],
+                  unmatched1=[t[int(swapped)] for t in row_matchings if t[1-int(swapped)] is None],
+                  unmatched2=[t[1-int(swapped)] for t in row_matchings if t[int(swapped)] is None])
+    if stats: result["stats"] = stats.finish()
+    return result
+
+
+
+
+def prepare_table(filepath, includes_header=None, includes_id_column=None, cache_dir=None, cache_size=None, progress=None,
+                  stats=None, typed_columns=False, phonetic=None):
+    """
+    Loads a spreadsheet (a file path or an in-memory source, see load_rows) and computes everything needed before its rows are compared.
+    If cache_dir is provided, the prepared table is cached there (keyed by the file content hash)
+    so that the next call with the same file skips the preprocessing altogether.
+    progress is an optional callback reporting the loading of the rows (see progress.py).
+    stats is an optional RunStats recording the time of the preprocessing stages and the cache hits (see stats.py).
+    If typed_columns, the telephone, date and number columns get their own types and their values are canonicalized (see canonical.py).
+    If phonetic ('cologne' or 'soundex'), the word columns (type 0, e.g. names) get the phonetic types (see PHONETIC_TYPES):
+    compared by metrics.cologne_ratio / soundex_ratio and blocked by the phonetic codes of their words.
+    
+    Returns
+    -------
+    a dict with the keys:
+        filepath : the file path (None for an in-memory source)
+        header : tuple of str (as returned by load_rows)
+        rows : a list of tuples (as returned by load_rows)
+        normalized : the rows normalized (see normalize_rows) - and canonicalized if typed_columns
+        column_types : a tuple of int's (see determine_column_types and canonical.refine_column_types)
+        vectors, m : the column vectors and the number of rows (see vectorize_columns)
+        index : the candidate index (see blocking.build_candidate_index)
+        phonetic : the phonetic codes of the values if phonetic (see phonetic_codes), otherwise None
+    """
+    
+    # Try the cache first
+    key = None
+    if cache_dir and isinstance(filepath, (str, os.PathLike)) and os.path.exists(filepath):
+        options = dict(typed_columns=True) if typed_columns else dict()   # the keys of the default tables stay the same
+        if phonetic: options.update(phonetic=phonetic)
+        key = cache_key(filepath, includes_header=includes_header, includes_id_column=includes_id_column, **options)
+        with stage(stats, "loading"):
+            table = load_prepared(key, cache_dir)
+        if stats: stats.count("prepared_cache_hits" if table is not None else "prepared_cache_misses")
+        if table is not None:
+            return dict(table, filepath=filepath)
+    
+    # Load and preprocess
+    with stage(stats, "loading"):
+        header, rows = load_rows(filepath, includes_header=includes_header, includes_id_column=includes_id_column, progress=progress)
+    table = prepare_rows(header, rows, stats=stats, typed_columns=typed_columns, phonetic=phonetic)
+    
+    # Save into the cache
+    if key:
+        save_prepared(key, table, cache_dir, cache_size=cache_size)
+    return dict(table, filepath=filepath if isinstance(filepath, (str, os.PathLike)) else None)
+
+
+
+
+def build_reference_index(filepath, index_file=None, includes_header=True, includes_id_column=True, typed_columns=False,
+                          phonetic=None):
+    """
+    Builds a reference index file from a spreadsheet which serves as the right table in repeated merges
+    (see merge_spreadsheets(..., reference_index=index_file) and reference.py)
+    Returns the path to the index file (by default the spreadsheet path with the extension .index)
+    The merged spreadsheets must use the same typed_columns and phonetic (see prepare_table)
+    """
+    index_file = index_file or strip_csv_extension(filepath) + ".index"
+    table = prepare_table(filepath, includes_header=includes_header, includes_id_column=includes_id_column,
+                          typed_columns=typed_columns, phonetic=phonetic)
+    return save_reference_index(table, index_file)
+
+
+
+
+def prepare_rows(header, rows, stats=None, typed_columns=False, phonetic=None):
+    """Same as prepare_table but for rows that have already been loaded (by load_rows). The returned dict has no filepath"""
+    with stage(stats, "normalizing"):
+        normalized = normalize_rows(rows)
+    with stage(stats, "column_types"):
+        column_types = determine_row_types(header, rows)
+        if typed_columns:
+            column_types = refine_column_types(normalized, column_types)
+            normalized = canonicalize_rows(normalized, column_types)
+        if phonetic:
+            if phonetic not in PHONETIC_TYPES:
+                raise ValueError("phonetic must be one of {}, not {!r}".format(sorted(PHONETIC_TYPES), phonetic))
+            column_types = tuple(PHONETIC_TYPES[phonetic] if t == 0 else t for t in column_types)
+        codes = phonetic_codes(normalized, column_types)
+    with stage(stats, "vectorizing"):
+        vectors, header, m = vectorize_rows(header, rows)
+    with stage(stats, "indexing"):
+        index = build_candidate_index(normalized, column_types)
+    return dict(header=tuple(header), rows=list(rows), normalized=normalized,
+                column_types=column_types, vectors=vectors, m=m, index=index, phonetic=codes)
+
+
+
+def phonetic_codes(normalized, column_types, includes_id_column=True):
+    """
+    The phonetic codes of the values of the phonetic columns (see PHONETIC_TYPES), computed once per value
+    so that the pairs of rows compare the codes (see row_similarity) instead of encoding both values per pair.
+    Returns a list with a tuple per row (the code of each column, None for the other columns), or None if there are no phonetic columns
+    """
+    ix = int(includes_id_column)
+    encoders = [PHONETIC_ENCODERS.get(t) for t in column_types]
+    if not any(encoders):
+        return None
+    return [tuple(encoder(row[c + ix]) if encoder else None for (c, encoder) in enumerate(encoders)) for row in normalized]
 
 
 
@@ -180,23 +818,31 @@ def vectorize_columns(filepath, includes_header=None, includes_id_column=None):
     """
     
     header, rows = load_rows(filepath, includes_header=includes_header, includes_id_column=includes_id_column)
+    return vectorize_rows(header, rows)
+
+
+
+
+def vectorize_rows(header, rows):
+    """
+    Same as vectorize_columns but for rows that have already been loaded (by load_rows)
+    Returns (vectors, header, m)
+    """
     includes_id_column = True  # load_rows() adds a generic id column if not found a valid one
     ix = int(includes_id_column)  # will be used as the starting index:  1=start from the nsecond column
     
     n_columns = len(header) - int(includes_id_column)   # 0 = the second column  (skipping the id column)
     ll = list();  [ll.append([]) for _ in range(n_columns)]
-    lll = list(); [lll.append([]) for _ in range(n_columns)]   # lengths
     
     for row in rows:
-        [ll[i].extend(ord(c) for c in str(v).upper()) for (i,v) in enumerate(row[ix:])]
-        [lll[i].append(len(str(v))) for (i,v) in enumerate(row[ix:])]
+        [ll[i].append(str(v)) for (i,v) in enumerate(row[ix:])]
     
     # Average length of values
-    m = len(lll[0])   # m = number of rows in the table
-    lengths = [sum(l)/m for l in lll]
+    m = len(ll[0])   # m = number of rows in the table
+    lengths = [sum(len(v) for v in l)/m for l in ll]
     
-    # Construct a vector
-    vectors = [[l.count(n) for n in range(32,91)]+[length,] for l,length in zip(ll,lengths)]
+    # Construct a vector (the counts of the characters 32..90, with NumPy if installed - see vectorized.py)
+    vectors = [counts+[length,] for counts,length in zip(character_histograms(ll), lengths)]
     return (vectors, header, m)  # n vectors each with 59 components (where n = number of columns in the csv file)
 
 
@@ -211,6 +857,16 @@ def determine_column_types(filepath, includes_header=None, includes_id_column=No
     
     # Load data
     header, rows = load_rows(filepath, includes_header=includes_header, includes_id_column=includes_id_column)
+    return determine_row_types(header, rows)
+
+
+
+
+def determine_row_types(header, rows):
+    """
+    Same as determine_column_types but for rows that have already been loaded (by load_rows)
+    Returns: a tuple of integers
+    """
     
     # Table has id column?
     includes_id_column = True    # because load_rows() checks whether the first column is a valid id column and adds a generated id column if necessary
@@ -239,7 +895,8 @@ def determine_column_types(filepath, includes_header=None, includes_id_column=No
 def match_columns(filepath1, filepath2,
                   includes_header=None, includes_id_column=True,
                   proportion_of_column_names_similarity=None,
-                  ignore_column_types_when_matching_columns=False):
+                  ignore_column_types_when_matching_columns=False,
+                  cache_dir=None, cache_size=None, typed_columns=False, phonetic=None):
     """
     Determines which file will serve as the left and right tables.
     Matches columns from these two files - based on char distribution AND column names similarities.
@@ -254,14 +911,37 @@ def match_columns(filepath1, filepath2,
         column_types : a list of integers denoting a type of each colummn from the 'left' table (?)
     """
     
+    table1, table2 = (prepare_table(filepath, includes_header=includes_header, includes_id_column=includes_id_column,
+                                    cache_dir=cache_dir, cache_size=cache_size, typed_columns=typed_columns,
+                                    phonetic=phonetic) for filepath in (filepath1, filepath2))
+    table_left, table_right, column_matchings, column_types = match_prepared_columns(table1, table2,
+                proportion_of_column_names_similarity=proportion_of_column_names_similarity,
+                ignore_column_types_when_matching_columns=ignore_column_types_when_matching_columns)
+    return (table_left["filepath"], table_right["filepath"], column_matchings, column_types)
+
+
+
+
+def match_prepared_columns(table1, table2,
+                           proportion_of_column_names_similarity=None,
+                           ignore_column_types_when_matching_columns=False,
+                           swap=True):
+    """
+    Same as match_columns but for prepared tables (see prepare_table)
+    If swap=False, table1 always serves as the left table and table2 as the right table
+    (e.g. when table2 is a reference index)
+    Returns:
+        (table_left, table_right, column_matchings, column_types)
+    """
+    
     # Defaults
     proportion_of_column_names_similarity = proportion_of_column_names_similarity or 0.5
     
-    vectors_1, header_1, m1 = vectorize_columns(filepath1, includes_header=includes_header, includes_id_column=includes_id_column)
-    vectors_2, header_2, m2 = vectorize_columns(filepath2, includes_header=includes_header, includes_id_column=includes_id_column)
+    vectors_1, header_1, m1 = table1["vectors"], table1["header"], table1["m"]
+    vectors_2, header_2, m2 = table2["vectors"], table2["header"], table2["m"]
     
-    types_1 = determine_column_types(filepath1, includes_header=includes_header, includes_id_column=includes_id_column)
-    types_2 = determine_column_types(filepath2, includes_header=includes_header, includes_id_column=includes_id_column)
+    types_1 = table1["column_types"]
+    types_2 = table2["column_types"]
     
     # Here 'left' means the table with the smaller number of columns
     condition = len(header_1) <= len(header_2)
@@ -269,20 +949,19 @@ def match_columns(filepath1, filepath2,
     header_left, header_right = (header_1, header_2)  if condition else (header_2, header_1)
     types_left, types_right = (types_1, types_2) if condition else (types_2, types_1)
     m_left, m_right = (m1, m2) if condition else (m2,m1)
-    file_left, file_right = (filepath1, filepath2) if condition else (filepath2, filepath1)
-    
-    cosine_similarities = [[cosine_similarity(a, b) for b in vectors_right] for a in vectors_left]
+    table_left, table_right = (table1, table2) if condition else (table2, table1)
     
     # At this point the headers automatically include an id column
     ix = 1   # i.e. start from index 1 skipping the id column
     
     # Get similarity ratios of the header names
-    n_grams_ratios = [[n_grams_ratio(a, b, n=2) for b in header_right[ix:]] for a in header_left[ix:]]
+    header_bigrams = BigramIndex(header_right[ix:])   # the same ratios as n_grams_ratio(a, b, n=2), see vectorized.py
+    n_grams_ratios = [header_bigrams.ratios(a) for a in header_left[ix:]]
     assert len(n_grams_ratios) == len(header_left) - 1, "error"   # seems to work
     #assert len(n_grams_ratios) == len(header_1) - 1, "error"  #original
     
     p = proportion_of_column_names_similarity   # proportion of header-name similaritiy    (0.2 - 0.6  ok)
-    cosine_and_n_grams = [[sum([v1*(1-p), v2*(p)])/2 for (v1,v2) in zip(l1,l2)] for (l1,l2) in zip(cosine_similarities, n_grams_ratios)]
+    cosine_and_n_grams = column_similarity_matrix(vectors_left, vectors_right, n_grams_ratios, p)   # see vectorized.py
     
     column_matchings = []
     column_types = []
@@ -312,16 +991,32 @@ def match_columns(filepath1, filepath2,
     unmatched_columns = [(None,ix) for ix in range(len(header_right)-1) if ix not in [t[1] for t in column_matchings]]
     column_matchings += unmatched_columns
     
-    # Here 'left' will mean the table with the fewer rows
-    condition = m_left <= m_right
-    file_left, file_right = (file_left, file_right) if condition else (file_right, file_left)
+    # Here 'left' will mean the table with the fewer rows (or table1 if not swapping)
+    condition = (m_left <= m_right) if swap else (table_left is table1)
+    table_left, table_right = (table_left, table_right) if condition else (table_right, table_left)
     if not condition: column_matchings = [(t[1], t[0]) for t in column_matchings]
-    return (file_left, file_right, column_matchings, column_types)
+    return (table_left, table_right, column_matchings, column_types)
+
+
+
+
+def normalize_value(value):
+    """Removes diacretics and umlauts and converts to upper case (this is the form in which values are compared)"""
+    return ''.join(c for c in unicodedata.normalize('NFD', str(value)) if unicodedata.category(c) != 'Mn').upper()
+
 
 
 
+def normalize_rows(rows, includes_id_column=True):
+    """Normalizes the values of all rows (see normalize_value). The id column is kept as it is"""
+    ix = int(includes_id_column)
+    return [tuple(row[:ix]) + tuple(normalize_value(v) for v in row[ix:]) for row in rows]
 
-def row_similarity(row_left, row_right, column_matchings=None, column_types=None, includes_id_column=True):
+
+
+
+def row_similarity(row_left, row_right, column_matchings=None, column_types=None, includes_id_column=True, normalized=False,
+                   score_cache=None, functions=None, codes=None):
     """
     Given two rows calculates their similarity
     By default this function expects both rows with id column, unless explicetely indicated in the arguments
@@ -339,6 +1034,19 @@ def row_similarity(row_left, row_right, column_matchings=None, column_types=None
     includes_id_column : bool, optional
         Expects True. Automatically the rows will have an id column at this time anyway. 
         The default is True.
+    normalized : bool, optional
+        True if both rows have already been normalized (see normalize_rows). 
+        The default is False.
+    score_cache : PairScoreCache, optional
+        Scores of value pairs are looked up in (and added to) this cache (see scorecache.py). 
+        The default is None.
+    functions : a sequence of functions, optional
+        Replaces SIMILARITY_FUNCTIONS, e.g. the timed functions of a RunStats (see stats.py). 
+        The default is None.
+    codes : a pair of tuples, optional
+        The phonetic codes of the left and the right row (see phonetic_codes): the phonetic columns compare these codes
+        (not looked up in the score cache) instead of encoding the values. 
+        The default is None.
 
     Returns
     -------
@@ -356,18 +1064,17 @@ def row_similarity(row_left, row_right, column_matchings=None, column_types=None
     if includes_id_column:
         row_left, row_right = (row[1:] for row in (row_left, row_right))
     
-    # Preprocess both rows (by removing diacretics and umlauts, and converting to upper case)
-    row_left, row_right = ([''.join(c for c in unicodedata.normalize('NFD', str(v)) if unicodedata.category(c) != 'Mn').upper() for v in row] for row in (row_left, row_right))
+    # Preprocess both rows (by removing diacretics and umlauts, and converting to upper case) unless done beforehand
+    if not normalized:
+        row_left, row_right = ([normalize_value(v) for v in row] for row in (row_left, row_right))
     
     # Drop None's in matchings
     column_matchings = [t for t in column_matchings if None not in t]
     
     # Similarity Functions 
-    funcs = (levenshtein_ratio, token_set_ratio, n_grams_ratio)
-    weights = {0:2,   1:1,   2:1} 
-    weights = [weights[k] for k in column_types]
+    weights = [WEIGHTS[k] for k in column_types]
     weights = [w/sum(weights) for w in weights]
-    funcs = [funcs[i] for i in column_types]
+    funcs = [(functions or SIMILARITY_FUNCTIONS)[i] for i in column_types]
     
     # Check
     assert len(funcs) == len(column_matchings), "assert len(funcs) == len(column_matchings)"
@@ -375,10 +1082,14 @@ def row_similarity(row_left, row_right, column_matchings=None, column_types=None
     
     # Iterate over column values
     ratios = []
-    for (ix_left, ix_right), func in zip(column_matchings, funcs):
+    codes_left, codes_right = codes or (None, None)
+    for (ix_left, ix_right), func, t in zip(column_matchings, funcs, column_types):
         v1 = row_left[ix_left]
         v2 = row_right[ix_right]
-        ratios.append(func(v1,v2))
+        if codes_left and codes_right and t in PHONETIC_ENCODERS:
+            ratios.append(func(v1, v2, codes=(codes_left[ix_left], codes_right[ix_right])))
+        else:
+            ratios.append(score_cache.get(func, v1, v2) if score_cache else func(v1,v2))
     
     # If None in ratios - exclude None's (dor not recalibrate weights because this would slant the chances towards the remaining value(s))
     ratios = (r or 0 for r in ratios)    # turns None's into zeros
@@ -389,14 +1100,92 @@ def row_similarity(row_left, row_right, column_matchings=None, column_types=None
     
 
 
-def load_rows(filepath, includes_id_column=None, includes_header=None):
+def row_similarities(row_left, rows_right, js, column_matchings=None, column_types=None, includes_id_column=True,
+                     bigrams=None, functions=None, codes=None, score_cache=None, stats=None):
+    """
+    Batched row_similarity of a normalized row against the normalized rows rows_right[j] for j in js
+    (the same ratios as row_similarity(..., normalized=True), as a list in the order of js)
+    bigrams : a dict mapping the right column index to the BigramIndex of the column (see bigram_indexes)
+        these columns are scored with one kernel call per column instead of one n_grams_ratio call per pair
+    The Levenshtein columns are scored with one call per column as well (see metrics.levenshtein_ratios)
+    codes : a pair (the phonetic codes of the left row, the phonetic codes of the right rows, see phonetic_codes)
+    score_cache : the scores are looked up per value pair, only the misses go through the kernels (see PairScoreCache.get_many)
+    stats : a RunStats recording the calls of the batched kernels under the name of the similarity function
+    The kernels are chosen by the column type, i.e. the same with the timed functions of the stats
+    The other arguments are the same as in row_similarity
+    """
+    ix = int(includes_id_column)
+    n = len(row_left) - ix
+    column_matchings = [t for t in (column_matchings or [(i,i) for i in range(n)]) if None not in t]
+    column_types = column_types or [1 for _ in range(n)]
+    weights = [WEIGHTS[k] for k in column_types]
+    weights = [w/sum(weights) for w in weights]
+    funcs = [(functions or SIMILARITY_FUNCTIONS)[i] for i in column_types]
+    bigrams = bigrams or dict()
+    
+    # Weighted sums of the ratios, column by column (in the same order as row_similarity)
+    totals = [0] * len(js)
+    codes_left, codes_right = codes or (None, None)
+    for ((ix_left, ix_right), func, t, w) in zip(column_matchings, funcs, column_types, weights):
+        v1 = row_left[ix_left + ix]
+        values = [rows_right[j][ix_right + ix] for j in js]
+        if codes_left and codes_right and t in PHONETIC_ENCODERS:   # not cached, as in row_similarity
+            c1 = codes_left[ix_left]
+            ratios = [func(v1, v2, codes=(c1, codes_right[j][ix_right])) for (j, v2) in zip(js, values)]
+        else:
+            # The kernel of the column scores the values at the positions ks (all of them, or the misses of the score cache)
+            if ix_right in bigrams:
+                kernel = lambda ks: bigrams[ix_right].ratios(v1, [js[k] for k in ks])
+            elif SIMILARITY_FUNCTIONS[t] is levenshtein_ratio:
+                kernel = lambda ks: levenshtein_ratios(v1, [values[k] for k in ks])
+            else:
+                kernel = None
+            if kernel is None:
+                kernel = lambda ks: [func(v1, values[k]) for k in ks]
+            elif stats:
+                kernel = stats.timed_kernel(func.__name__, kernel)
+            ratios = score_cache.get_many(func, v1, values, kernel) if score_cache else kernel(range(len(js)))
+        for (k, r) in enumerate(ratios):
+            totals[k] += (r or 0) * w
+    return totals
+
+
+
+def bigram_indexes(rows, column_matchings, column_types, includes_id_column=True):
+    """
+    The BigramIndex of each compared n-gram column (type 2) of the normalized rows (the right table), by the right column index
+    (see row_similarities and vectorized.py). Returns an empty dict if there are no such columns
+    """
+    ix = int(includes_id_column)
+    return {ix_right: BigramIndex([row[ix_right + ix] for row in rows])
+            for ((_, ix_right), t) in zip(column_matchings, column_types) if SIMILARITY_FUNCTIONS[t] is n_grams_ratio}
+
+
+
+def tile_keys(row, rows, js, column_matchings=None, column_types=None, includes_id_column=True):
+    """
+    Keys (metric name, value, value) of all value pairs compared when the row is compared with rows[j] for j in js
+    (used to prefetch the scores of a scoring tile from a PairScoreCache). The rows must be normalized
+    """
+    ix = int(includes_id_column)
+    n = len(row) - ix
+    column_matchings = [t for t in (column_matchings or [(i,i) for i in range(n)]) if None not in t]
+    column_types = column_types or [1 for _ in range(n)]
+    names = [SIMILARITY_FUNCTIONS[t].__name__ for t in column_types]
+    return {(name, row[ix_left + ix], rows[j][ix_right + ix]) for j in js
+                for ((ix_left, ix_right), name) in zip(column_matchings, names)}
+
+
+
+
+def load_rows(filepath, includes_id_column=None, includes_header=None, progress=None):
     """
     Loads rows from file
 
     Parameters
     ----------
     filepath : str
-        path to the csv file
+        path to the csv file, or an in-memory source: bytes, a file-like object or an iterable of rows (see utils.read_csv_source)
     includes_id_column : bool, optional
         If False - adds a generic id column. 
         If True or None - checks for a valid id column and adds if necessary
@@ -405,6 +1194,8 @@ def load_rows(filepath, includes_id_column=None, includes_header=None):
         If False - adds a generic header.
         If True or None - checks and adds if necessary
         The default is None.
+    progress : callable, optional
+        Callback reporting the number of rows read (see progress.py). The default is None.
 
     Returns
     -------
@@ -413,19 +1204,45 @@ def load_rows(filepath, includes_id_column=None, includes_header=None):
         each tuple represents a row in a table.
     """
     
+    # In-memory source
+    if not isinstance(filepath, (str, os.PathLike)):
+        report = progress_reporter(progress, "loading")
+        rows = read_csv_source(filepath)
+        if report: report.done(len(rows))
+        return complete_rows(rows, includes_id_column=includes_id_column, includes_header=includes_header)
+    
     # Get the file path right
     if not os.path.exists(filepath):
         filepath = os.path.expanduser(filepath)
         if not os.path.exists(filepath):
             raise FileNotFoundError(f"file not found: {filepath}")
         
-    # make sure the file is a csv file
-    if os.path.splitext(filepath)[-1] != ".csv":
-        raise TypeError("filepath must point to a csv file")
-    
-    # Open and read the file
-    with open(filepath, mode='rt', encoding='utf-8') as fr:
-        rows = tuple(csv.reader(fr))
+    # make sure the file is a csv file (plain or compressed)
+    if not csv_extension(filepath):
+        raise TypeError("filepath must point to a csv file (.csv, .csv.gz, .csv.bz2 or .csv.xz)")
+    
+    # Open and read the file (decompressed on the fly)
+    report = progress_reporter(progress, "loading")
+    with open_csv(filepath, mode='rt') as fr:
+        if report:
+            rows = list()
+            for row in csv.reader(fr):
+                rows.append(row)
+                report(len(rows))
+            report.done(len(rows))
+        else:
+            rows = tuple(csv.reader(fr))
+    return complete_rows(rows, includes_id_column=includes_id_column, includes_header=includes_header)
+
+
+
+
+def complete_rows(rows, includes_id_column=None, includes_header=None):
+    """
+    Splits off the header (or adds a generic one) and adds a generic id column if the first column is not a valid id column.
+    Used by load_rows. The arguments are the same as in load_rows.
+    Returns (header, rows)
+    """
     
     # Determine about the header
     if includes_header is None:
@@ -451,7 +1268,9 @@ def load_rows(filepath, includes_id_column=None, includes_header=None):
 
 
 def match_rows(rows_left, rows_right, column_matchings, column_types, includes_id_column=True, 
-               threshold: 'similarity probability threshold' = None, debugging=False):
+               threshold: 'similarity probability threshold' = None, debugging=False,
+               normalized=False, blocking=False, index=None, reference_index=None, score_cache=None, progress=None,
+               stats=None, assignment=None, top_k=None, screen=None, memory_limit=None, temp_dir=None, codes=None):
     """
     Finds matching rows. 
     This function expects both rows to start with an id column, unless explicetely inicated so as includes_id_column=False
@@ -473,6 +1292,41 @@ def match_rows(rows_left, rows_right, column_matchings, column_types, includes_i
         Can be adjusted to improve the accuracy. The default is None.
     debugging : bool, optional
         Works only with the generated csv files. Prints a report on matching. The default is False.
+    normalized : bool, optional
+        True if the rows have already been normalized (see normalize_rows). The default is False.
+    blocking : bool, optional
+        If True, only the rows sharing a blocking key are compared (the rest are deemed dissimilar). The default is False.
+    index : dict, optional
+        The candidate index of the right table (see blocking.build_candidate_index). 
+        Built from rows_right if not provided. Only used if blocking=True. The default is None.
+    reference_index : str or dict, optional
+        A reference index file or a loaded reference index (see build_reference_index) serving as the right table.
+        rows_right and index are then taken from it and blocking is turned on. The default is None.
+    score_cache : str or PairScoreCache, optional
+        SQLite file (or an open cache) where the scores of value pairs are looked up and stored (see scorecache.py). 
+        The default is None.
+    progress : callable, optional
+        Callback progress(stage, completed, total, rate) reporting the scored rows (see progress.py). The default is None.
+    stats : RunStats, optional
+        Records the time of the scoring and assignment stages, the calls of the similarity functions 
+        and the number of compared pairs (see stats.py). The default is None.
+    assignment : str, optional
+        'greedy' (each left row is matched with its most similar right row if still free) 
+        or 'heap' (falls back to the next best free candidate, see assignment.py). The default is None ('greedy').
+    top_k : int, optional
+        Number of candidates kept per left row for the 'heap' assignment. The default is None (5).
+    screen : float or bool, optional
+        Lower bound of the cheap screen ratio (True = the default bound): only the pairs above it are scored
+        with the similarity functions (see screening.py). The default is None (no screening).
+    memory_limit : int, optional
+        Budget in bytes of the running statistics: the rankings, the sums and the candidates of the left rows are kept
+        in compact arrays and the rankings are spilled to disk above the budget (see spilling.py). 
+        Ignored if debugging. The default is None (lists in memory).
+    temp_dir : str, optional
+        Directory of the spilled files. The default is None (the system's temporary directory).
+    codes : a pair of lists, optional
+        The phonetic codes of the normalized left and right rows (see phonetic_codes), compared instead of encoding the values per pair.
+        The default is None.
 
     Returns
     -------
@@ -483,60 +1337,157 @@ def match_rows(rows_left, rows_right, column_matchings, column_types, includes_i
     
     # Defaults
     threshold = threshold or 0.49
-    
-    # Create matrix
+    if assignment not in (None, "greedy", "heap"):
+        raise ValueError(f"assignment must be 'greedy' or 'heap' (not {assignment!r})")
+    
+    # Reference index as the right table
+    if reference_index is not None:
+        if isinstance(reference_index, (str, os.PathLike)):
+            reference_index = load_reference_index(reference_index)
+        rows_right, index, blocking = reference_index["normalized"], reference_index["index"], True
+        codes = None   # the reference index keeps no codes
+        if not normalized:
+            rows_left = normalize_rows(rows_left, includes_id_column=includes_id_column)
+    
+    # Normalize the rows once (instead of for every comparison)
+    elif not normalized:
+        rows_left, rows_right = (normalize_rows(rows, includes_id_column=includes_id_column) for rows in (rows_left, rows_right))
+    codes_left, codes_right = codes if codes and None not in codes and normalized else (None, None)
+    
+    # Blocking: compare only the rows that share a blocking key
+    if blocking:
+        columns = [(ix_left, ix_right, t) for ((ix_left, ix_right), t) in zip([t for t in column_matchings if None not in t], column_types)]
+        if index is None:
+            types_right = [None,] * (len(rows_right[0]) - int(includes_id_column))
+            for (_, ix_right, t) in columns: types_right[ix_right] = t
+            index = build_candidate_index(rows_right, types_right, includes_id_column=includes_id_column)
+    
+    # Screening: score only the pairs with a screen ratio above the lower bound
+    screen = screen_bound(screen)
+    if screen is not None:
+        compared = [t for t in column_matchings if None not in t]
+        grams_left = screen_grams(rows_left, [t[0] for t in compared], includes_id_column=includes_id_column)
+        grams_right = screen_grams(rows_right, [t[1] for t in compared], includes_id_column=includes_id_column)
+    
+    # Cache of the scores of value pairs
+    score_cache, opened = open_score_cache(score_cache)
+    cache_counts = (score_cache.hits, score_cache.misses) if score_cache else None
+    
+    # Similarity functions (timed if instrumented)
+    functions = stats.timed_functions(SIMILARITY_FUNCTIONS) if stats else None
+    
+    # Batched scoring with the bigram kernels of the n-gram columns of the right table (see row_similarities)
+    # - the misses of the score cache as well - unless the right table is a (memory-mapped) reference index,
+    # whose rows are compared by candidate lookups without building any index over them
+    bigrams = None
+    if reference_index is None and not isinstance(rows_right, MappedRows):
+        bigrams = bigram_indexes(rows_right, [t for t in column_matchings if None not in t], column_types,
+                                 includes_id_column=includes_id_column)
+    
+    # Running statistics of each left row instead of a matrix (the matrix is kept only for the debugging report)
+    # With a memory budget in arrays, the rankings as (-ratio, left row, right row, offset ratio) spilled above the budget
     m,n = (len(rows_left), len(rows_right))
-    mx = [];  [mx.append([0,]*n) for _ in range(m)]
+    mx = [[0,]*n for _ in range(m)] if debugging else None
+    heap = assignment == "heap"
+    budgeted = memory_limit is not None and not debugging
+    rankings = EdgeBuffer(('d', 'I', 'I', 'd'), memory_limit, temp_dir) if budgeted else list()   # (left row, most similar right row, its ratio, offset ratio)
+    totals = array('d') if budgeted else list()     # sum of the ratios of each left row
+    counts = (array('I') if budgeted else list()) if heap and screen is not None else None   # number of the scored right rows of each left row
+    candidates = (CandidateLists() if budgeted else list()) if heap else None   # the top k (ratio, right row) of each left row
     
     # Compute matching ratios
-    for i,row_left in enumerate(rows_left):
-        #See the progress
-        if debugging and max(m,n) >= 40:
-            sys.stdout.write('\r' + ("Progress:" + str(round(i/n*100)).rjust(3) + "%")) # \r prints a carriage return first, so s is printed on top of the previous line
-            sys.stdout.flush()  # comment out if not necessary
+    report = progress_reporter(progress, "scoring", m, debugging=debugging and max(m,n) >= 40)
+    with stage(stats, "scoring"):
+        for i,row_left in enumerate(rows_left):
+            #See the progress
+            if report: report(i)
             
-        for j,row_right in enumerate(rows_right):
-            mx[i][j] = row_similarity(row_left=row_left, row_right=row_right,
-                         column_matchings=column_matchings,
-                         column_types=column_types,
-                         includes_id_column=includes_id_column)
-    # Print a new line after the progress bar
-    if debugging and max(m,n) >= 40: 
-        sys.stdout.write('\r' + ("Progress:100%"))
-        print()
-    
-    # Sort
-    rankings = list()
-    ln = len(mx[0])
-    for i,row in enumerate(mx):
-        mm = max(row)   # maximum value
-        offset_ratio = 1 - ((sum(row) - mm)/(ln-1) / mm)
-        rankings.append((i, row.index(mm), mm, offset_ratio))
-    rankings = sorted(rankings, reverse=True, key=lambda t: t[2])
-    
-    # For debugging purposes
-    debugging_matchings = list()
-    
-    # Make matchings
-    matchings = list()
-    right_indeces = set(t[1] for t in rankings)  # remove is the method
-    
-    for i,j,r,o in rankings:
-        match = (o >= 0.49 and r >= 0.25) or r >= threshold   # arbitrary threshold values
-        if match and (j in right_indeces):
-            matchings.append((i,j))
-            right_indeces.remove(j)   # prevent double matching
-            if debugging:
-                debugging_matchings.append((int(rows_left[i][0]), int(rows_right[j][0]), round(r,2)))
-    
-    # Sort the matchings lt
-    matchings = sorted(matchings, key=lambda t: t[0])
-    
-    # Add unmatched rows
-    left_indeces = set(range(m)).difference({t[0] for t in matchings})
-    right_indeces = set(range(n)).difference({t[1] for t in matchings})
-    [matchings.append((i,None)) for i in left_indeces]
-    [matchings.append((None,j)) for j in right_indeces]
+            if blocking:
+                js = sorted(candidate_rows(index, row_keys(row_left, columns, includes_id_column=includes_id_column)))
+            else:
+                js = range(n)
+            if screen is not None:
+                n_js = len(js)
+                js = [j for j in js if screen_ratio(grams_left[i], grams_right[j]) >= screen]
+                if stats: stats.count("pairs_screened_out", n_js - len(js))
+            if score_cache:
+                score_cache.prefetch(tile_keys(row_left, rows_right, js, column_matchings, column_types, includes_id_column=includes_id_column))
+            mm, jj, total = 0, 0, 0   # maximum value, its (first) index, sum
+            scores = list()
+            if bigrams is not None:
+                ratios = row_similarities(row_left, rows_right, js, column_matchings, column_types,
+                                          includes_id_column=includes_id_column, bigrams=bigrams, functions=functions,
+                                          codes=(codes_left[i], codes_right) if codes_left else None, score_cache=score_cache, stats=stats)
+            else:
+                ratios = (row_similarity(row_left=row_left, row_right=rows_right[j],
+                                         column_matchings=column_matchings,
+                                         column_types=column_types,
+                                         includes_id_column=includes_id_column,
+                                         normalized=True,
+                                         score_cache=score_cache,
+                                         functions=functions,
+                                         codes=(codes_left[i], codes_right[j]) if codes_left else None) for j in js)
+            for (j, r) in zip(js, ratios):
+                total += r
+                if r > mm: mm, jj = r, j
+                if heap and r: scores.append((r, j))
+                if debugging: mx[i][j] = r
+            if score_cache:
+                score_cache.flush()
+            # With screening, the offset is taken over the scored pairs only (the screened-out ratios are not in the total)
+            o = offset_ratio(mm, total, len(js) if screen is not None else n)
+            if budgeted:
+                rankings.add(-mm, i, jj, o)
+            else:
+                rankings.append((i, jj, mm, o))
+            totals.append(total)
+            if counts is not None: counts.append(len(js))
+            if heap: candidates.append(top_candidates(scores, top_k))
+            if stats: stats.count("pairs_scored", len(js))
+    if report: report.done()
+    if stats:
+        stats.count("pairs_total", m * n)
+        stats.add_score_cache(score_cache, since=cache_counts)
+    if opened: score_cache.close()
+    
+    # Sort (with a memory budget the spilled runs are merged back in the same order)
+    with stage(stats, "assignment"):
+        if budgeted:
+            ranked = ((i, j, -r, o) for (r, i, j, o) in rankings.sorted())
+        else:
+            rankings = sorted(rankings, reverse=True, key=lambda t: t[2])
+            ranked = rankings
+    
+        # For debugging purposes
+        debugging_matchings = list()
+    
+        # Make matchings
+        matchings = list()
+        if heap:
+            for (i,j,r) in heap_assignment(candidates, totals, n, threshold, counts=counts):
+                matchings.append((i,j))
+                if debugging:
+                    debugging_matchings.append((int(rows_left[i][0]), int(rows_right[j][0]), round(r,2)))
+        else:
+            for (i,j,r) in greedy_assignment(ranked, threshold, size=n):
+                matchings.append((i,j))
+                if debugging:
+                    debugging_matchings.append((int(rows_left[i][0]), int(rows_right[j][0]), round(r,2)))
+        if budgeted:
+            rankings.close()
+            if stats: stats.count("spilled_runs", rankings.spills)
+    
+        # Sort the matchings lt
+        matchings = sorted(matchings, key=lambda t: t[0])
+    
+        # Add unmatched rows
+        left_indeces = set(range(m)).difference({t[0] for t in matchings})
+        right_indeces = set(range(n)).difference({t[1] for t in matchings})
+        [matchings.append((i,None)) for i in left_indeces]
+        [matchings.append((None,j)) for j in right_indeces]
+    if stats:
+        stats.count("matched", 2 * (len(matchings) - len(left_indeces) - len(right_indeces)))
+        stats.count("unmatched", len(left_indeces) + len(right_indeces))
     
     # Debugging
     if debugging:
@@ -562,9 +1513,68 @@ def match_rows(rows_left, rows_right, column_matchings, column_types, includes_i
 
 
 
+def write_sorted_rows(header, rows, matchings, output_filepath=None, progress=None):
+    """
+    Writes the rows sorted by the matchings: matched rows one after the other with a common new id, unique rows at the bottom.
+    This function is used by the detect_duplicates function
+
+    Parameters
+    ----------
+    header : tuple of str
+    rows : a list of tuples
+    matchings : a list of tuples
+        Pairs of row indeces, e.g. (3, 17), or clusters of any size, e.g. (3, 17, 20). Unmatched rows are represented as (i, None)
+    output_filepath : str, optional
+        The default is None.
+    progress : callable, optional
+        Callback reporting the written rows (see progress.py). The default is None.
+
+    Returns
+    -------
+    output_filepath : str
+        output file path
+    """
+    
+    # Write to file (compressed if the file name ends with .gz, .bz2 or .xz)
+    header, lines, n = sorted_rows(header, rows, matchings)
+    output_filepath = output_filepath or "output.csv"
+    report = progress_reporter(progress, "writing", n)
+    with open_csv(output_filepath, mode='wt') as fw:
+        wr = csv.writer(fw)
+        wr.writerow(header)
+        for (k,row) in enumerate(lines):
+            wr.writerow(row)
+            if report: report(k)
+    if report: report.done()
+    return output_filepath
+
+
+
+
+def sorted_rows(header, rows, matchings):
+    """
+    The rows sorted by the matchings (see write_sorted_rows)
+    Returns (header, rows, n): the header with the new id column, a generator of the sorted rows and their number
+    """
+    
+    # Unravel the indeces
+    nx_unravelled = [i for i in sum(matchings, ()) if i is not None]
+    assert len(nx_unravelled) == len(set(nx_unravelled))
+    
+    # Make new index (one per pair or cluster)
+    nx_new = [ix for (ix, t) in enumerate(matchings) for i in t if i is not None]
+    assert len(nx_new) == len(nx_unravelled)
+    
+    # Make new header
+    header = ("id(new)",) + tuple(header)
+    return (header, ((ix + 1,) + tuple(rows[i]) for (i,ix) in zip(nx_unravelled, nx_new)), len(nx_new))
+
+
+
+
 def write_rows(header_left, rows_left, header_right, rows_right,
                column_matchings, row_matchings,
-               output_filepath=None):
+               output_filepath=None, progress=None):
     """
     Merges a row from the left and a row from the right tables into a single row.
     The header is merged into one long header as well.
@@ -586,6 +1596,8 @@ def write_rows(header_left, rows_left, header_right, rows_right,
         see the docs of the functions above.
     output_filepath : str, optional
         A default name for the file is passed ("merged_spreadsheets.csv"). The default is None.
+    progress : callable, optional
+        Callback reporting the written rows (see progress.py). The default is None.
 
     Returns
     -------
@@ -593,6 +1605,40 @@ def write_rows(header_left, rows_left, header_right, rows_right,
         output file path
     """
 
+    # Compile and write (compressed if the file name ends with .gz, .bz2 or .xz)
+    header, lines = merged_rows(header_left, rows_left, header_right, rows_right, column_matchings, row_matchings)
+    output_filepath = output_filepath or "output.csv"
+    report = progress_reporter(progress, "writing", len(row_matchings))
+    with open_csv(output_filepath, mode='wt') as fw:
+        wr = csv.writer(fw)
+        wr.writerow(header)
+        for (k,row) in enumerate(lines):
+            wr.writerow(row)
+            if report: report(k)
+    if report: report.done()
+    return output_filepath
+
+
+
+
+def merged_rows(header_left, rows_left, header_right, rows_right, column_matchings, row_matchings):
+    """
+    The merged rows (see write_rows, the arguments are the same)
+    Returns (header, rows): the merged header and a generator of the merged rows
+    """
+    header, merge = row_merger(header_left, header_right, column_matchings)
+    return (header, (merge(rows_left[l] if l is not None else None, rows_right[r] if r is not None else None)
+                     for (l,r) in row_matchings))
+
+
+
+
+def row_merger(header_left, header_right, column_matchings):
+    """
+    Returns (header, merge): the merged header and a function merge(row_left, row_right) returning the merged row
+    (either row can be None)
+    """
+
     # Sort the column mathings for prettyness
     column_matchings = sorted(column_matchings, key=lambda t: (10000 if t[0] is None else ((t[0] + 1)*100) + (1000 if t[1] is None else (t[1]+1)*1 )) )
     
@@ -615,22 +1661,15 @@ def write_rows(header_left, rows_left, header_right, rows_right,
             keys_right.append(k)
             indeces_right.append(t[1]+1)
     
-    # Compile and write
-    output_filepath = output_filepath or "output.csv"
-    with open(output_filepath, mode='wt', encoding='utf_8') as fw:
-        wr = csv.writer(fw)
-        wr.writerow(header)
-        for l,r in row_matchings:
-            d = {k:None for k in header}
-            if l is not None:
-                row_left = rows_left[l]
-                d.update({k:v for k,v in zip(keys_left, (row_left[j] for j in indeces_left))})
-            if r is not None:
-                row_right = rows_right[r]
-                d.update({k:v for k,v in zip(keys_right, (row_right[j] for j in indeces_right))})
-            row = [d[k] for k in header]
-            wr.writerow(row)
-    return output_filepath
+    # Compile
+    def merge(row_left, row_right):
+        d = {k:None for k in header}
+        if row_left is not None:
+            d.update({k:v for k,v in zip(keys_left, (row_left[j] for j in indeces_left))})
+        if row_right is not None:
+            d.update({k:v for k,v in zip(keys_right, (row_right[j] for j in indeces_right))})
+        return [d[k] for k in header]
+    return (header, merge)
 
 
 
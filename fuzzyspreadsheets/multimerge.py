@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+"""
+Merges many spreadsheets (e.g. partial exports of the same entities) into one in a single pass.
+Every spreadsheet is prepared (loaded, normalized, vectorized) only once:
+    1. the columns are aligned to a common schema: the first spreadsheet defines the schema,
+       the columns of every next spreadsheet are matched to it (see model.match_prepared_columns)
+       and its unmatched columns are appended to the schema
+    2. the rows are matched to entities: the rows of the first spreadsheet are the first entities,
+       the rows of every next spreadsheet are matched to the existing entities (one row per spreadsheet and entity,
+       with the same rules as model.match_rows) or become new entities.
+       With blocking (the default) one candidate index over the schema columns is shared by all the spreadsheets
+       and extended with every new entity, so each row is compared only with its candidates
+       and the work grows linearly with the number of spreadsheets (instead of re-scoring an accumulated table pairwise)
+The merged spreadsheet has one row per entity: the ids from every spreadsheet ("id (1)", "id (2)", ...)
+followed by the schema columns (the value of the first spreadsheet in which it is not empty).
+"""
+
+
+import csv
+from .utils import construct_filepath, open_csv
+from .model import prepare_table, match_prepared_columns, row_similarity, SIMILARITY_FUNCTIONS
+from .blocking import candidate_rows, row_keys
+from .scorecache import open_score_cache
+from .progress import progress_reporter
+from .stats import stage, make_stats
+from .profiling import profilable
+from .assignment import offset_ratio, greedy_assignment
+
+
+
+@profilable
+def merge_many_spreadsheets(filepaths: 'paths to the spreadsheets',
+                            includes_header: 'the first row is the header' = True,
+                            includes_id_column: 'the first column is an id column with unique integers' = True,
+                            filename: 'output file name' = None, directory: 'output directory' = None,
+                            threshold: 'similarity probability threshold' = None,
+                            columns_matching: 'ratio of column names matching vs. vectorized values distribution technique' = None,
+                            blocking: 'compare only rows sharing a blocking key' = True,
+                            cache_dir: 'directory for caching the prepared tables' = None,
+                            cache_size: 'size limit of the cache directory in bytes' = None,
+                            score_cache: 'SQLite file (or PairScoreCache) caching the scores of value pairs' = None,
+                            progress: 'callback progress(stage, completed, total, rate), see progress.py' = None,
+                            stats: 'True (or a RunStats) to return (output file path, RunStats), see stats.py' = None,
+                            profile: "'cprofile' or 'sample' to save a profile into the output directory, see profiling.py" = None
+                            ) -> 'output file path':
+    """Merges any number of spreadsheets into one, combining the rows of the same entity (see the module docstring).
+    The sources can also be in-memory sources (see model.load_rows)"""
+
+    stats = make_stats(stats)
+    tables = [prepare_table(filepath, includes_header=includes_header, includes_id_column=includes_id_column,
+                            cache_dir=cache_dir, cache_size=cache_size, progress=progress, stats=stats) for filepath in filepaths]
+    with stage(stats, "match_columns"):
+        schema_header, schema_types, mappings = match_schema(tables, proportion_of_column_names_similarity=columns_matching)
+    entities = match_entities(tables, schema_types, mappings, threshold=threshold, blocking=blocking,
+                              score_cache=score_cache, progress=progress, stats=stats)
+
+    # Construct output filepath
+    output_filepath = construct_filepath(filename=filename or "merged_spreadsheets.csv", directory=directory)
+
+    with stage(stats, "writing"):
+        header, lines = merged_entity_rows(tables, schema_header, mappings, entities)
+        report = progress_reporter(progress, "writing", len(entities))
+        with open_csv(output_filepath, mode='wt') as fw:
+            wr = csv.writer(fw)
+            wr.writerow(header)
+            for (k, row) in enumerate(lines):
+                wr.writerow(row)
+                if report: report(k)
+        if report: report.done()
+    return (output_filepath, stats.finish()) if stats else output_filepath
+
+
+
+def match_schema(tables, proportion_of_column_names_similarity=None):
+    """
+    Aligns the columns of prepared tables (see model.prepare_table) to a common schema
+    Returns:
+        schema_header : the names of the schema columns (the id column is not part of the schema)
+        schema_types : the column types of the schema columns
+        mappings : one list per table of tuples (table column, schema column) - zero-based, not counting the id column
+    """
+    first = tables[0]
+    schema_header = list(first["header"][1:])
+    schema_types = list(first["column_types"])
+    schema_vectors = list(first["vectors"])
+    mappings = [[(i, i) for i in range(len(schema_header))]]
+
+    for table in tables[1:]:
+        schema = dict(header=(first["header"][0],) + tuple(schema_header), vectors=schema_vectors,
+                      column_types=tuple(schema_types), m=0)
+        _, _, column_matchings, _ = match_prepared_columns(table, schema,
+                                        proportion_of_column_names_similarity=proportion_of_column_names_similarity, swap=False)
+        mapping = [t for t in column_matchings if None not in t]
+
+        # The unmatched columns of the table extend the schema
+        for ix in sorted(t[0] for t in column_matchings if t[1] is None and t[0] is not None):
+            mapping.append((ix, len(schema_header)))
+            schema_header.append(table["header"][ix + 1])
+            schema_types.append(table["column_types"][ix])
+            schema_vectors.append(table["vectors"][ix])
+        mappings.append(sorted(mapping))
+    return (tuple(schema_header), tuple(schema_types), mappings)
+
+
+
+def match_entities(tables, schema_types, mappings, threshold=None, blocking=True, score_cache=None, progress=None, stats=None):
+    """
+    Matches the rows of prepared tables to entities (see the module docstring)
+    Returns a list of entities, each a list with one row index per table (None if the entity has no row in that table)
+    """
+
+    # Defaults
+    threshold = threshold or 0.49
+
+    n_tables, n_columns = len(tables), len(schema_types)
+    members = list()   # entity -> row index per table
+    values = list()    # entity -> [entity index] + the normalized schema values (the first non-empty value)
+    present = list()   # entity -> frozenset of the schema columns of its tables
+    index = dict()     # shared candidate index: (schema column, token) -> entities
+
+    def add_values(e, row, mapping):
+        """Fills the empty schema values of the entity from a normalized row (and indexes them)"""
+        filled = list()
+        for (ix, s) in mapping:
+            if not values[e][s + 1] and str(row[ix + 1]).strip():
+                values[e][s + 1] = row[ix + 1]
+                filled.append((s, s, schema_types[s]))
+        present[e] = present[e].union(s for (_, s) in mapping)
+        if blocking:
+            for key in row_keys(values[e], filled):
+                index.setdefault(key, []).append(e)
+
+    def add_entity(k, i, row, mapping):
+        members.append([None,] * n_tables)
+        members[-1][k] = i
+        values.append([len(values),] + ['',] * n_columns)
+        present.append(frozenset())
+        add_values(len(values) - 1, row, mapping)
+
+    # Cache of the scores of value pairs and the similarity functions (timed if instrumented)
+    score_cache, opened = open_score_cache(score_cache)
+    cache_counts = (score_cache.hits, score_cache.misses) if score_cache else None
+    functions = stats.timed_functions(SIMILARITY_FUNCTIONS) if stats else None
+
+    report = progress_reporter(progress, "scoring", sum(len(table["normalized"]) for table in tables[1:]))
+    done = 0
+    try:
+        for (i, row) in enumerate(tables[0]["normalized"]):
+            add_entity(0, i, row, mappings[0])
+
+        for k in range(1, n_tables):
+            rows, mapping, n = tables[k]["normalized"], mappings[k], len(members)
+            columns = [(ix, s, schema_types[s]) for (ix, s) in mapping]
+            comparisons = dict()   # frozenset of schema columns -> (column matchings, column types)
+
+            # Most similar entity of each row and the offset ratio (see model.match_rows)
+            with stage(stats, "scoring"):
+                rankings = list()
+                for (i, row) in enumerate(rows):
+                    js = sorted(candidate_rows(index, row_keys(row, columns))) if blocking else range(n)
+                    mm, jj, total = 0, 0, 0
+                    for j in js:
+                        if present[j] not in comparisons:
+                            cm = [t for t in mapping if t[1] in present[j]]
+                            comparisons[present[j]] = (cm, [schema_types[s] for (_, s) in cm])
+                        cm, types = comparisons[present[j]]
+                        r = row_similarity(row, values[j], column_matchings=cm, column_types=types, normalized=True,
+                                           score_cache=score_cache, functions=functions) if cm else 0
+                        total += r
+                        if r > mm: mm, jj = r, j
+                    rankings.append((i, jj, mm, offset_ratio(mm, total, n)))
+                    if stats: stats.count("pairs_scored", len(js))
+                    done += 1
+                    if report: report(done)
+                if stats: stats.count("pairs_total", len(rows) * n)
+
+            # Greedy assignment (one row of this table per entity), the unmatched rows become new entities
+            with stage(stats, "assignment"):
+                rankings = sorted(rankings, reverse=True, key=lambda t: t[2])
+                matched = set()
+                for (i, j, r) in greedy_assignment(rankings, threshold):
+                    members[j][k] = i
+                    add_values(j, rows[i], mapping)
+                    matched.add(i)
+                for (i, row) in enumerate(rows):
+                    if i not in matched:
+                        add_entity(k, i, row, mapping)
+                if stats:
+                    stats.count("matched", len(matched))
+                    stats.count("unmatched", len(rows) - len(matched))
+    finally:
+        if stats: stats.add_score_cache(score_cache, since=cache_counts)
+        if opened: score_cache.close()
+    if report: report.done()
+    return members
+
+
+
+def merged_entity_rows(tables, schema_header, mappings, entities):
+    """
+    The merged rows (see merge_many_spreadsheets)
+    Returns (header, rows): the merged header and a generator of the merged rows
+    """
+    header = tuple("{} ({})".format(table["header"][0], k + 1) for (k, table) in enumerate(tables)) + tuple(schema_header)
+    sources = [dict((s, ix) for (ix, s) in mapping) for mapping in mappings]   # schema column -> table column
+
+    def merge(entity):
+        ids = tuple(tables[k]["rows"][i][0] if i is not None else '' for (k, i) in enumerate(entity))
+        row = list()
+        for s in range(len(schema_header)):
+            value = ''
+            for (k, i) in enumerate(entity):
+                if i is not None and s in sources[k]:
+                    v = tables[k]["rows"][i][sources[k][s] + 1]
+                    if str(v).strip():
+                        value = v
+                        break
+            row.append(value)
+        return ids + tuple(row)
+    return (header, (merge(entity) for entity in entities))
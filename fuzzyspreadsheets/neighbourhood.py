@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+"""
+Out-of-core duplicate detection by the sorted neighbourhood method, for spreadsheets that do not fit in memory
+(used by detect_duplicates(..., window=k)).
+    1. Spooling : the rows are streamed into a temporary spool file; only the byte offset of each row is kept (array of 8-byte ints)
+    2. Sorting : for each sort key (by default every column: the normalized value) the (key, row) records
+                 are sorted externally - sorted runs of run_size records are spilled to disk and merged (heapq.merge)
+    3. Scoring : a window slides over each sorted order; each row is compared with the window-1 preceding rows
+                 (the rows are read back from the spool); the pairs above the threshold (edges) are spilled to disk
+    4. Assignment : the edges are sorted externally by the similarity ratio and matched greedily
+                    (a pair matches if both rows are still free - the same as the 'heap' assignment)
+    5. Writing : the sorted output of detect_duplicates (the matched pairs with a common new id, then the unique rows)
+The memory is bounded by run_size records, the window and 12 bytes per row (the offsets and the matches).
+The column types and the id column are determined from the first rows (see planner.peek_table).
+All the temporary files are in one temporary directory (in temp_dir if given) that is removed at the end.
+"""
+
+
+import io
+import os
+import csv
+import heapq
+import tempfile
+from array import array
+from collections import deque
+from itertools import islice, chain
+from .utils import open_csv, csv_extension, construct_filepath
+from .model import SIMILARITY_FUNCTIONS, complete_rows, determine_row_types, normalize_value, row_similarity
+from .planner import SAMPLE_SIZE
+from .progress import progress_reporter
+from .stats import stage, make_stats
+from .spilling import external_sort, spill_run, read_run, run_capacity
+from .assignment import greedy_assignment
+
+
+# Defaults: rows compared with each row (window - 1 preceding rows) and records per sorted run
+DEFAULT_WINDOW = 10
+DEFAULT_RUN_SIZE = 200000
+
+# Estimated memory of the key of a (key, row) record in bytes (for run_size from memory_limit)
+SORT_KEY_BYTES = 64
+
+# Unmatched row (in the array of the matched rows)
+NO_MATCH = 0xFFFFFFFF
+
+
+
+def detect_duplicates_out_of_core(filepath, includes_header=True, includes_id_column=True, filename=None, directory=None,
+                                  threshold=None, window=None, keys=None, run_size=None, temp_dir=None, memory_limit=None,
+                                  progress=None, stats=None):
+    """
+    Out-of-core version of detect_duplicates (see the module docstring)
+    window : number of rows in the sliding window (each row is compared with the window-1 preceding rows). The default is 10
+    keys : the columns sorted by (zero-based not counting the id column), one sorting pass each. The default is all the columns
+    run_size : number of (key, row) records sorted in memory at once. The default is 200000
+    temp_dir : directory of the temporary files. The default is the system's temporary directory
+    memory_limit : the budget of the sorted runs in bytes (sets run_size, see spilling.run_capacity). The default is None
+    The other arguments are the same as in detect_duplicates.
+    Returns the output file path (and the RunStats if stats)
+    """
+
+    # Defaults
+    threshold = threshold or 0.45
+    window = max(int(window or DEFAULT_WINDOW), 2)
+    run_size = run_size or (run_capacity(memory_limit, SORT_KEY_BYTES) if memory_limit else DEFAULT_RUN_SIZE)
+    stats = make_stats(stats)
+    functions = stats.timed_functions(SIMILARITY_FUNCTIONS) if stats else None
+
+    with tempfile.TemporaryDirectory(prefix="fuzzyspreadsheets-", dir=temp_dir) as tmp:
+
+        # Spool the rows, column types from the first rows
+        with stage(stats, "loading"):
+            spool_file = os.path.join(tmp, "rows.csv")
+            header, column_types, offsets = spool_rows(filepath, spool_file, includes_header=includes_header,
+                                                       includes_id_column=includes_id_column, progress=progress)
+        n = len(offsets) - 1
+        keys = list(range(len(column_types))) if keys is None else list(keys)
+
+        with open(spool_file, mode='rb') as spool:
+            read = lambda i: read_row(spool, offsets, i)
+
+            # Score the neighbours in each sorted order, spill the edges
+            edges = list()   # the spilled runs of the edges
+            buffer = list()
+            n_edges = 0
+            report = progress_reporter(progress, "scoring", n * len(keys))
+            for (p, c) in enumerate(keys):
+                with stage(stats, "sorting"):
+                    records = external_sort(sort_records(spool_file, c), run_size, tmp, "keys{}".format(p))
+                with stage(stats, "scoring"):
+                    neighbours = deque(maxlen=window - 1)
+                    for (k, (_, i)) in enumerate(records):
+                        row = normalized_row(read(i))
+                        for (j, other) in neighbours:
+                            r = row_similarity(row, other, column_types=column_types, normalized=True, functions=functions)
+                            if r >= threshold:
+                                buffer.append((-r, min(i, j), max(i, j)))
+                                n_edges += 1
+                        if stats: stats.count("pairs_scored", len(neighbours))
+                        neighbours.append((i, row))
+                        if len(buffer) >= run_size:
+                            edges.append(spill_run(sorted(buffer), tmp, "edges{}".format(len(edges))))
+                            buffer = list()
+                        if report: report(p * n + k + 1)
+            if buffer:
+                edges.append(spill_run(sorted(buffer), tmp, "edges{}".format(len(edges))))
+            if report: report.done()
+
+            # Greedy assignment over the edges in descending order of the ratio
+            with stage(stats, "assignment"):
+                partner = array('I', [NO_MATCH]) * n
+                ranked = ((i, j, -r) for (r, i, j) in heapq.merge(*(read_run(path) for path in edges)))
+                for (i, j, _) in greedy_assignment(ranked, threshold, duplicates=True, size=n):
+                    partner[i], partner[j] = j, i
+            matched = sum(1 for i in range(n) if partner[i] != NO_MATCH)
+            if stats:
+                stats.count("pairs_total", n * (n - 1) // 2)
+                stats.count("edges", n_edges)
+                stats.count("matched", matched)
+                stats.count("unmatched", n - matched)
+
+            # Write the output: the pairs (by the first row) with a common new id, then the unique rows
+            output_filepath = construct_filepath(filename=filename or "sorted_duplicates.csv", directory=directory)
+            with stage(stats, "writing"):
+                report = progress_reporter(progress, "writing", n)
+                with open_csv(output_filepath, mode='wt') as fw:
+                    wr = csv.writer(fw)
+                    wr.writerow(("id(new)",) + tuple(header))
+                    k = written = 0
+                    for i in range(n):
+                        if partner[i] != NO_MATCH and i < partner[i]:
+                            k += 1
+                            wr.writerow((k,) + read(i))
+                            wr.writerow((k,) + read(partner[i]))
+                            written += 2
+                            if report: report(written)
+                    for i in range(n):
+                        if partner[i] == NO_MATCH:
+                            k += 1
+                            wr.writerow((k,) + read(i))
+                            written += 1
+                            if report: report(written)
+                if report: report.done()
+    return (output_filepath, stats.finish()) if stats else output_filepath
+
+
+
+def spool_rows(filepath, spool_file, includes_header=True, includes_id_column=True, progress=None):
+    """
+    Streams the rows of a csv file into the spool file (one csv record per row, with the id column completed)
+    Returns (header, column_types, offsets): offsets is an array of the byte offsets of the rows (and of the end of the file)
+    """
+    if not isinstance(filepath, (str, os.PathLike)) or not csv_extension(filepath):
+        raise TypeError("filepath must point to a csv file (.csv, .csv.gz, .csv.bz2 or .csv.xz)")
+    offsets = array('Q', [0])
+    report = progress_reporter(progress, "loading")
+    with open_csv(filepath, mode='rt') as fr, open(spool_file, mode='wb') as fw:
+        reader = csv.reader(fr)
+
+        # The header, the id column and the column types from the first rows
+        first = list(islice(reader, SAMPLE_SIZE + int(bool(includes_header))))
+        if not first:
+            raise ValueError(f"empty spreadsheet: {filepath}")
+        header, sample = complete_rows(first, includes_id_column=includes_id_column, includes_header=includes_header)
+        column_types = determine_row_types(header, sample) if sample else tuple(1 for _ in header[1:])
+        generic_id = header[0] == "_id_" and len(header) == len(first[0]) + 1
+
+        # The rows (the sample rows already have their generic ids)
+        record = RecordWriter()
+        wr = csv.writer(record)
+        k = len(sample)
+        for row in chain(sample, ((((k + i,) + tuple(row)) if generic_id else row) for (i, row) in enumerate(reader))):
+            wr.writerow(row)
+            data = record.line.encode('utf_8')
+            fw.write(data)
+            offsets.append(offsets[-1] + len(data))
+            if report: report(len(offsets) - 1)
+    if report: report.done(len(offsets) - 1)
+    return (tuple(header), column_types, offsets)
+
+
+
+class RecordWriter:
+    """File-like object keeping the last line written by a csv.writer (one csv record, possibly spanning several lines)"""
+
+    def __init__(self):
+        self.line = ''
+
+    def write(self, line):
+        self.line = line
+
+
+
+def read_row(spool, offsets, i):
+    """The row i from the spool file (a tuple of str)"""
+    spool.seek(offsets[i])
+    data = spool.read(offsets[i+1] - offsets[i]).decode('utf_8')
+    return tuple(next(csv.reader(io.StringIO(data))))
+
+
+
+def normalized_row(row):
+    """The row normalized (see model.normalize_rows)"""
+    return (row[0],) + tuple(normalize_value(v) for v in row[1:])
+
+
+
+def sort_records(spool_file, column):
+    """The (key, row) records of a sorting pass: the key is the normalized value of the column (rows with an empty value are skipped)"""
+    with open(spool_file, mode='rt', encoding='utf_8', newline='') as fr:
+        for (i, row) in enumerate(csv.reader(fr)):
+            key = normalize_value(row[column + 1]).strip() if column + 1 < len(row) else ''
+            if key:
+                yield (key, i)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+"""
+Cost estimation for detect_duplicates and merge_spreadsheets before they run.
+Only the header and a sample of the first rows are parsed, the remaining lines are just counted.
+From the row counts and the column types of the sample the planner estimates the number of compared pairs,
+the memory of the similarity matrix and the runtime, and picks the execution strategy:
+    exhaustive : every row against every other row
+    blocked : only rows sharing a blocking key (see blocking.py)
+"""
+
+
+import csv
+from itertools import islice
+from .utils import open_csv
+from .model import complete_rows, determine_row_types, normalize_rows
+from .blocking import build_candidate_index, candidate_rows, row_keys
+
+
+# Rough runtime of one similarity function call by column type (seconds) and the overhead per compared pair of rows
+TYPE_COSTS = {0: 55e-6, 1: 200e-6, 2: 10e-6, 3: 2e-6, 4: 2e-6, 5: 2e-6}
+PAIR_COST = 10e-6
+
+# Memory of one cell of the similarity matrix (a list slot + a float object)
+CELL_BYTES = 32
+
+# Rows parsed for the column types and the blocking statistics
+SAMPLE_SIZE = 1000
+
+# Above this estimated runtime the blocked strategy is chosen
+MAX_EXHAUSTIVE_SECONDS = 60
+
+
+
+def peek_table(filepath, includes_header=True, includes_id_column=True, sample_size=None):
+    """
+    Reads the header and the first rows of a spreadsheet and counts the remaining lines
+    Returns (header, sample_rows, n_rows)
+    """
+    sample_size = sample_size or SAMPLE_SIZE
+    with open_csv(filepath, mode='rt') as fr:
+        rows = list(islice(csv.reader(fr), sample_size + int(bool(includes_header))))
+        n_rest = sum(1 for _ in fr)
+    header, sample = complete_rows(rows, includes_id_column=includes_id_column, includes_header=includes_header)
+    return (header, sample, len(sample) + n_rest)
+
+
+
+def candidates_per_row(sample, column_types, n_rows):
+    """Estimates the average number of candidate rows per row when blocking (extrapolated from the sample)"""
+    if not sample:
+        return 0
+    normalized = normalize_rows(sample)
+    index = build_candidate_index(normalized, column_types)
+    columns = [(i, i, t) for (i, t) in enumerate(column_types)]
+    c = sum(len(candidate_rows(index, row_keys(row, columns))) - 1 for row in normalized) / len(normalized)
+    return min(n_rows, c * n_rows / len(sample))   # the blocks grow with the table
+
+
+
+def estimate_job(filepaths, operation=None, includes_header=True, includes_id_column=True,
+                 max_exhaustive_seconds=None):
+    """
+    Estimates the cost of detect_duplicates (one file) or merge_spreadsheets (two files)
+
+    Returns
+    -------
+    a dict with the keys:
+        operation : 'detect' or 'merge'
+        rows, columns : lists with the number of rows and columns (not counting the id column) of each file
+        pairs : number of compared pairs of rows (exhaustive)
+        pairs_blocked : estimated number of compared pairs of rows when blocking
+        memory : estimated memory of the similarity matrix in bytes
+        seconds_exhaustive, seconds_blocked : estimated runtimes
+        strategy : 'exhaustive' or 'blocked'
+        seconds : estimated runtime of the chosen strategy
+    """
+    max_exhaustive_seconds = max_exhaustive_seconds or MAX_EXHAUSTIVE_SECONDS
+    operation = operation or ("merge" if len(filepaths) == 2 else "detect")
+    tables = [peek_table(filepath, includes_header=includes_header, includes_id_column=includes_id_column)
+              for filepath in filepaths]
+    types = [determine_row_types(header, sample) if sample else () for (header, sample, _) in tables]
+    n = [t[2] for t in tables]
+
+    # Cost of comparing two rows (in a merge at most the columns of the narrower table are matched)
+    column_types = min(types, key=len)
+    pair_seconds = PAIR_COST + sum(TYPE_COSTS.get(t, max(TYPE_COSTS.values())) for t in column_types)
+
+    # Number of compared pairs
+    if operation == "detect":
+        pairs = n[0] * (n[0] - 1) // 2
+        pairs_blocked = min(pairs, int(n[0] * candidates_per_row(tables[0][1], types[0], n[0]) / 2))
+        cells = n[0] * n[0]
+    else:
+        pairs = cells = n[0] * n[1]
+        i = n.index(min(n))   # the right table (the one with more rows) is the indexed one
+        pairs_blocked = min(pairs, int(n[i] * candidates_per_row(tables[1-i][1], types[1-i], n[1-i])))
+
+    seconds_exhaustive = pairs * pair_seconds
+    seconds_blocked = pairs_blocked * pair_seconds
+    strategy = "exhaustive" if seconds_exhaustive <= max_exhaustive_seconds else "blocked"
+    return dict(operation=operation, rows=n, columns=[len(t) for t in types],
+                pairs=pairs, pairs_blocked=pairs_blocked, memory=cells * CELL_BYTES,
+                seconds_exhaustive=round(seconds_exhaustive, 2), seconds_blocked=round(seconds_blocked, 2),
+                strategy=strategy, seconds=round(seconds_exhaustive if strategy == "exhaustive" else seconds_blocked, 2))
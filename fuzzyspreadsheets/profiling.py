@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""
+Opt-in profiling of detect_duplicates / merge_spreadsheets (e.g. of one slow job on real data).
+Two modes:
+    'cprofile' : deterministic profile of every function call (cProfile), saved as <function name>.pstats
+                 (read with pstats, snakeviz etc.)
+    'sample'   : lightweight periodic stack sampler (a thread looks at the stack of the profiled thread every few milliseconds),
+                 saved as collapsed stacks <function name>.collapsed (one line per stack: "frame;frame;frame count",
+                 the input format of flamegraph.pl and speedscope)
+The profile is saved into the output directory of the run.
+The mode is given by the profile argument or, if None, by the environment variable FUZZYSPREADSHEETS_PROFILE.
+"""
+
+
+import os
+import sys
+import threading
+import cProfile
+from functools import wraps
+from collections import Counter
+from contextlib import contextmanager
+
+
+PROFILE_ENVIRON = "FUZZYSPREADSHEETS_PROFILE"
+PROFILE_MODES = ("cprofile", "sample")
+
+# Interval between two stack samples (seconds)
+SAMPLE_INTERVAL = 0.005
+
+
+
+def profile_mode(profile=None):
+    """Returns 'cprofile', 'sample' or None from the profile argument (True = 'cprofile') or from the environment variable"""
+    if profile is None:
+        profile = os.environ.get(PROFILE_ENVIRON) or None
+    if profile in (None, False, "0", ""):
+        return None
+    if profile is True or profile == "1":
+        return "cprofile"
+    if profile not in PROFILE_MODES:
+        raise ValueError("profile must be one of {} (not {!r})".format(PROFILE_MODES, profile))
+    return profile
+
+
+
+class StackSampler:
+    """Samples the stack of a thread periodically and counts the collapsed stacks"""
+
+    def __init__(self, thread_id=None, interval=None):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval or SAMPLE_INTERVAL
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = list()
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def save(self, filepath):
+        with open(filepath, mode='wt', encoding='utf-8') as fw:
+            for (stack, count) in self.stacks.most_common():
+                fw.write("{} {}\n".format(stack, count))
+        return filepath
+
+
+
+@contextmanager
+def profiled(mode, directory=None, name="profile"):
+    """Profiles the block ('cprofile' or 'sample') and saves the profile into directory/name.pstats (or .collapsed)"""
+    directory = str(directory or os.getcwd())
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(directory, name + ".pstats"))
+    else:
+        sampler = StackSampler()
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            sampler.save(os.path.join(directory, name + ".collapsed"))
+
+
+
+def profilable(func):
+    """
+    Decorator: profiles the call if its keyword argument 'profile' (or the environment variable) asks for it.
+    The profile is saved into the directory given by the keyword argument 'directory' (or the current working directory)
+    """
+    @wraps(func)
+    def closure(*args, **kwargs):
+        mode = profile_mode(kwargs.get("profile"))
+        if mode is None:
+            return func(*args, **kwargs)
+        with profiled(mode, kwargs.get("directory"), func.__name__):
+            return func(*args, **kwargs)
+    return closure
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+"""
+Progress reporting for the long running stages (loading, scoring, writing).
+The progress is passed to a callback supplied by the caller:
+    progress(stage, completed, total, rate)
+        stage : 'loading', 'scoring' or 'writing'
+        completed : number of units (rows) done so far
+        total : total number of units (None if not known in advance, e.g. the rows of a file being loaded)
+        rate : units per second since the start of the stage
+The callback is throttled (at most one call per interval, plus the final one).
+Without a callback the stages only test a None reporter, i.e. the reporting costs nothing.
+"""
+
+
+import sys
+import time
+
+
+# Minimum time between two calls of the callback (seconds)
+DEFAULT_INTERVAL = 0.2
+
+
+
+class ProgressReporter:
+    """Reports the progress of one stage to the callback. Call it with the number of completed units"""
+
+    def __init__(self, progress, stage, total=None, interval=None):
+        self.progress = progress
+        self.stage = stage
+        self.total = total
+        self.interval = DEFAULT_INTERVAL if interval is None else interval
+        self.start = self.last = time.monotonic()
+        self.progress(stage, 0, total, 0.0)
+
+    def __call__(self, completed):
+        now = time.monotonic()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        self.progress(self.stage, completed, self.total, completed / (now - self.start))
+
+    def done(self, completed=None):
+        """Reports the end of the stage (always passed to the callback)"""
+        completed = self.total if completed is None else completed
+        elapsed = time.monotonic() - self.start
+        self.progress(self.stage, completed, self.total if self.total is not None else completed,
+                      completed / elapsed if elapsed else 0.0)
+
+
+
+def progress_reporter(progress, stage, total=None, debugging=False):
+    """
+    Returns a ProgressReporter for the stage, or None if there is no callback.
+    If debugging and no callback is given, the progress is printed as a bar (see print_progress)
+    """
+    if progress is None and debugging:
+        progress = print_progress
+    return ProgressReporter(progress, stage, total) if progress else None
+
+
+
+def print_progress(stage, completed, total, rate):
+    """Callback printing a progress bar on stdout (the default when debugging)"""
+    if not total:
+        return
+    sys.stdout.write('\r' + ("Progress:" + str(round(completed/total*100)).rjust(3) + "%"))   # \r prints on top of the previous line
+    sys.stdout.flush()
+    if completed >= total:
+        print()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""
+Persistent reference index for repeated merges against the same (reference) spreadsheet.
+The index file holds the prepared table of the reference spreadsheet (see model.prepare_table):
+the rows, normalized rows, column types, column vectors and the candidate index.
+The rows and the candidate index are memory-mapped on load, i.e. they are read lazily from the file
+and shared between processes by the operating system instead of being parsed into memory.
+
+File layout:
+    magic (8 bytes) | length of the metadata (8 bytes) | metadata (json) | sections aligned to 8 bytes
+    sections: row offsets (uint64), rows (json lines), normalized row offsets (uint64), normalized rows (json lines),
+              postings of the candidate index (uint32)
+"""
+
+
+import os
+import json
+import mmap
+import struct
+from array import array
+
+
+MAGIC = b"FZREFIX1"
+
+
+
+class MappedRows:
+    """Read-only sequence of rows decoded lazily from a memory-mapped section of the index file"""
+
+    def __init__(self, buffer, offsets):
+        self.buffer = buffer
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0: i += len(self)
+        if not 0 <= i < len(self): raise IndexError("row index out of range")
+        return tuple(json.loads(bytes(self.buffer[self.offsets[i]:self.offsets[i+1]])))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+
+class MappedIndex:
+    """Read-only candidate index (blocking key -> row indices) with the posting lists in a memory-mapped section"""
+
+    def __init__(self, blocks, postings):
+        self.blocks = blocks   # blocking key -> (start, end) in postings
+        self.postings = postings
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __contains__(self, key):
+        return key in self.blocks
+
+    def get(self, key, default=None):
+        t = self.blocks.get(key)
+        return default if t is None else self.postings[t[0]:t[1]]
+
+    def __getitem__(self, key):
+        start, end = self.blocks[key]
+        return self.postings[start:end]
+
+
+
+def encode_rows(rows):
+    """Encodes rows as json lines. Returns (offsets, blob)"""
+    offsets, chunks, n = array('Q', [0]), [], 0
+    for row in rows:
+        b = json.dumps(list(row), ensure_ascii=False).encode('utf-8')
+        chunks.append(b)
+        n += len(b)
+        offsets.append(n)
+    return offsets, b''.join(chunks)
+
+
+
+def data_offset(meta_length):
+    """Position of the first section in the file"""
+    position = len(MAGIC) + 8 + meta_length
+    return position + (-position) % 8
+
+
+
+def save_reference_index(table, index_file):
+    """Writes a prepared table (see model.prepare_table) into a reference index file"""
+
+    # Sections
+    row_offsets, row_blob = encode_rows(table["rows"])
+    norm_offsets, norm_blob = encode_rows(table["normalized"])
+    postings, blocks = array('I'), []
+    for key in sorted(table["index"], key=lambda k: (k[0], str(k[1]))):
+        block = table["index"][key]
+        blocks.append([key[0], key[1], len(postings), len(postings) + len(block)])
+        postings.extend(block)
+    sections = [row_offsets.tobytes(), row_blob, norm_offsets.tobytes(), norm_blob, postings.tobytes()]
+
+    # Section positions relative to the start of the data (which follows the metadata, aligned to 8 bytes)
+    positions, position = [], 0
+    for section in sections:
+        position += (-position) % 8
+        positions.append([position, position + len(section)])
+        position += len(section)
+
+    # Metadata (everything small enough to be parsed on load)
+    meta = dict(filepath=str(table.get("filepath")), header=list(table["header"]),
+                column_types=list(table["column_types"]), vectors=table["vectors"], m=table["m"],
+                blocks=blocks, sections=positions)
+    meta = json.dumps(meta, ensure_ascii=False).encode('utf-8')
+
+    # Write
+    temp = str(index_file) + ".{}.tmp".format(os.getpid())
+    with open(temp, mode='wb') as fw:
+        fw.write(MAGIC + struct.pack('<Q', len(meta)) + meta)
+        base = data_offset(len(meta))
+        for section, (start, _) in zip(sections, positions):
+            fw.write(b'\0' * (base + start - fw.tell()))
+            fw.write(section)
+    os.replace(temp, index_file)
+    return index_file
+
+
+
+def load_reference_index(index_file):
+    """
+    Loads a reference index file (memory-mapped).
+    Returns a prepared table (a dict with the same keys as returned by model.prepare_table)
+    """
+    with open(index_file, mode='rb') as fr:
+        if fr.read(8) != MAGIC:
+            raise ValueError(f"not a reference index file: {index_file}")
+        n = struct.unpack('<Q', fr.read(8))[0]
+        meta = json.loads(fr.read(n).decode('utf-8'))
+        mm = mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ)   # the map stays valid after the file is closed
+
+    base = data_offset(n)
+    view = memoryview(mm)
+    (a, b), (c, d), (e, f), (g, h), (p, q) = ((base + start, base + end) for (start, end) in meta["sections"])
+    rows = MappedRows(view[c:d], view[a:b].cast('Q'))
+    normalized = MappedRows(view[g:h], view[e:f].cast('Q'))
+    index = MappedIndex({(col, token): (start, end) for (col, token, start, end) in meta["blocks"]}, view[p:q].cast('I'))
+    return dict(filepath=meta["filepath"], header=tuple(meta["header"]), rows=rows, normalized=normalized,
+                column_types=tuple(meta["column_types"]), vectors=meta["vectors"], m=meta["m"], index=index)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+"""
+Persistent cache of similarity scores of value pairs (SQLite-backed).
+The same value pairs (e.g. "KONIGSTRASSE 12" vs "KONIG STR. 12A") recur across runs and across spreadsheets,
+so their scores are stored in a local SQLite file keyed by (metric name, normalized value, normalized value).
+The lookups and inserts are batched per scoring tile (one row against its candidate rows):
+    cache.prefetch(keys)    # one query for all the value pairs of the tile
+    cache.get(...)          # served from memory, or computed and queued for insertion
+    cache.get_many(...)     # the same for one value against many, the misses computed by one batched kernel call
+    cache.flush()           # one transaction for all the new scores
+The number of entries is capped; the least recently used entries are evicted first, in batches
+(down to EVICT_TARGET of the cap, so that the eviction does not run on every flush).
+"""
+
+
+import os
+import time
+import sqlite3
+
+
+DEFAULT_MAX_ENTRIES = 1000000
+
+# The eviction deletes the least recently used entries down to this share of max_entries
+EVICT_TARGET = 0.9
+
+
+
+class PairScoreCache:
+    """SQLite-backed cache of scores of value pairs. See the module docstring"""
+
+    def __init__(self, path, max_entries=None):
+        self.path = str(path)
+        self.max_entries = max_entries or DEFAULT_MAX_ENTRIES
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(self.path, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")   # readers don't block the writer (several jobs share the file)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS scores (metric TEXT, a TEXT, b TEXT, score REAL, used REAL, "
+                                "PRIMARY KEY (metric, a, b))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS scores_used ON scores (used)")
+        self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS wanted (metric TEXT, a TEXT, b TEXT)")
+        self.connection.commit()
+        self.count = self.connection.execute("SELECT COUNT(*) FROM scores").fetchone()[0]   # kept up to date with the inserted rows
+        self.memory = dict()    # scores of the current tile: (metric, a, b) -> score
+        self.pending = dict()   # new scores waiting to be inserted
+        self.used = set()       # keys found in the database (their 'used' timestamp is refreshed on flush)
+        self.hits = self.misses = 0
+
+    def prefetch(self, keys):
+        """Loads the scores of the given keys (metric, a, b) from the database into memory with batched queries"""
+        keys = [k for k in set(keys) if k not in self.memory]
+        if not keys: return
+        # The wanted keys go into a temp table which is then joined on the primary key of the scores
+        self.connection.execute("DELETE FROM wanted")
+        self.connection.executemany("INSERT INTO wanted (metric, a, b) VALUES (?,?,?)", keys)
+        sql = "SELECT s.metric, s.a, s.b, s.score FROM wanted w JOIN scores s ON s.metric=w.metric AND s.a=w.a AND s.b=w.b"
+        for (metric, a, b, score) in self.connection.execute(sql):
+            self.memory[(metric, a, b)] = score
+            self.used.add((metric, a, b))
+        self.connection.commit()   # end the read transaction (a read lock held until the flush could deadlock with another writer)
+
+    def get(self, func, a, b):
+        """Returns the score of func(a, b) from memory or computes it (and queues it for insertion)"""
+        key = (func.__name__, a, b)
+        score = self.memory.get(key)
+        if score is not None:
+            self.hits += 1
+            return score
+        self.misses += 1
+        score = func(a, b)
+        if score is not None:
+            self.memory[key] = self.pending[key] = score
+        return score
+
+    def get_many(self, func, a, bs, compute):
+        """
+        Returns the scores of func(a, b) for each b of bs from memory. The misses are computed by one call compute(ks)
+        (ks = the positions of the missing values in bs, e.g. a batched kernel, see model.row_similarities) and queued for insertion
+        """
+        name = func.__name__
+        scores = [self.memory.get((name, a, b)) for b in bs]
+        missing = [k for (k, score) in enumerate(scores) if score is None]
+        self.hits += len(bs) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            for (k, score) in zip(missing, compute(missing)):
+                scores[k] = score
+                if score is not None:
+                    self.memory[(name, a, bs[k])] = self.pending[(name, a, bs[k])] = score
+        return scores
+
+    def flush(self):
+        """Inserts the new scores and refreshes the used ones in one transaction. Then evicts and clears the memory"""
+        now = time.time()
+        inserted = 0
+        with self.connection:
+            if self.pending:
+                # Only the new rows count (the keys inserted meanwhile by another job are updated instead)
+                inserted = self.connection.executemany("INSERT OR IGNORE INTO scores (metric, a, b, score, used) VALUES (?,?,?,?,?)",
+                                                       [k + (v, now) for (k, v) in self.pending.items()]).rowcount
+                if inserted < len(self.pending):
+                    self.connection.executemany("UPDATE scores SET score=?, used=? WHERE metric=? AND a=? AND b=?",
+                                                [(v, now) + k for (k, v) in self.pending.items()])
+            if self.used:
+                self.connection.executemany("UPDATE scores SET used=? WHERE metric=? AND a=? AND b=?",
+                                            [(now,) + k for k in self.used])
+        self.count += max(inserted, 0)
+        self.memory.clear()
+        self.pending.clear()
+        self.used.clear()
+        if self.count > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        """Deletes the least recently used entries down to EVICT_TARGET of max_entries"""
+        n = self.connection.execute("SELECT COUNT(*) FROM scores").fetchone()[0]   # other jobs may share the file
+        target = int(self.max_entries * EVICT_TARGET)
+        if n > self.max_entries:
+            with self.connection:
+                n -= self.connection.execute("DELETE FROM scores WHERE rowid IN (SELECT rowid FROM scores ORDER BY used LIMIT ?)",
+                                             (n - target,)).rowcount
+        self.count = n
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+def open_score_cache(score_cache):
+    """Returns (cache, opened): a PairScoreCache for a path (opened=True) or the given cache object as it is"""
+    if score_cache is None or isinstance(score_cache, PairScoreCache):
+        return (score_cache, False)
+    return (PairScoreCache(score_cache), True)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+"""
+Cheap screening of the pairs of rows before the (expensive) similarity functions.
+Each row is turned once into the set of the character bigrams of its compared values (the normalized values joined by a space).
+The screen ratio of a pair is the Jaccard index of the two bigram sets: a set intersection instead of Levenshtein distances.
+Only the pairs with a screen ratio of at least the lower bound are scored with the weighted similarity functions,
+the others are deemed dissimilar (ratio 0, as the pairs skipped by blocking).
+On the generated spreadsheets the true pairs have a screen ratio above 0.4 while 99% of the other pairs are below 0.2,
+hence the default lower bound. calibrate_screen derives the bound from known matched pairs instead.
+"""
+
+
+# Default lower bound of the screen ratio
+DEFAULT_SCREEN = 0.2
+
+# Default share of the known matched pairs kept by a calibrated lower bound
+DEFAULT_SCREEN_RECALL = 0.99
+
+
+
+def screen_bound(screen):
+    """The lower bound from the screen argument: None/False = no screening, True = the default bound, or the bound itself"""
+    if screen is None or screen is False:
+        return None
+    return DEFAULT_SCREEN if screen is True else float(screen)
+
+
+
+def screen_grams(rows, columns, includes_id_column=True):
+    """
+    The bigram sets of normalized rows (see model.normalize_rows)
+    columns : the indeces of the compared columns (zero-based not counting the id column)
+    """
+    ix = int(includes_id_column)
+    grams = list()
+    for row in rows:
+        s = ' '.join(str(row[c + ix]) for c in columns)
+        grams.append(frozenset(s[k:k+2] for k in range(len(s) - 1)))
+    return grams
+
+
+
+def screen_ratio(grams1, grams2):
+    """Jaccard index of two bigram sets"""
+    union = len(grams1 | grams2)
+    return len(grams1 & grams2) / union if union else 0
+
+
+
+def calibrate_screen(grams_left, grams_right, pairs, recall=None):
+    """
+    The largest lower bound keeping at least the share 'recall' of known matched pairs
+    (e.g. the matchings of a previous run or the true pairs of a log file, as (left row, right row) indeces)
+    Returns DEFAULT_SCREEN if there are no pairs
+    """
+    recall = recall or DEFAULT_SCREEN_RECALL
+    ratios = sorted(screen_ratio(grams_left[i], grams_right[j]) for (i, j) in pairs)
+    if not ratios:
+        return DEFAULT_SCREEN
+    return ratios[int(len(ratios) * (1 - recall))]
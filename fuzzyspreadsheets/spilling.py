@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+"""
+Memory-budgeted buffers and external sorting (used with memory_limit, see model.match_duplicates, cluster_duplicates,
+match_rows, and by neighbourhood.py).
+The scored pairs (edges) and the per-row rankings are accumulated in compact arrays (array('I') for the row indeces,
+array('d') for the ratios) instead of lists of tuples. When the buffered records reach the memory budget,
+they are sorted and spilled into a run file; the runs are merged back lazily (heapq.merge) for the assignment.
+The work is the same, only slower with many spills - the memory stays bounded and the results are the same as without a budget.
+    EdgeBuffer : the records (tuples of numbers) in arrays, spilled in sorted runs; sorted() yields all the records in order
+    CandidateLists : the top k candidates of each left row (see assignment.heap_assignment) in flat arrays
+    external_sort, spill_run, read_run : sorting of any records with at most run_size records in memory
+"""
+
+
+import os
+import heapq
+import pickle
+import shutil
+import tempfile
+from array import array
+from itertools import islice
+
+
+# Records pickled at once into a run file
+CHUNK_SIZE = 4096
+
+# Estimated memory of a record while a run is sorted and spilled (a tuple of Python numbers and its list slot), in bytes
+SORT_RECORD_BYTES = 120
+
+# Minimum number of records per run (a tiny budget still spills runs of a useful size)
+MIN_RUN_SIZE = 1024
+
+
+
+def run_capacity(memory_limit, record_bytes):
+    """The number of records that fit into the memory budget (in bytes), given the bytes per record"""
+    return max(int(memory_limit) // (record_bytes + SORT_RECORD_BYTES), MIN_RUN_SIZE)
+
+
+
+class EdgeBuffer:
+    """
+    Records of numbers (e.g. (-ratio, i, j)) buffered in one array per field and spilled in sorted runs above the budget.
+    typecodes : the array typecode of each field, e.g. ('d', 'I', 'I')
+    memory_limit : the budget of the buffered records in bytes (None = never spill)
+    temp_dir : directory of the run files (in a temporary directory created on the first spill, removed by close)
+    Usage:
+        with EdgeBuffer(('d', 'I', 'I'), memory_limit) as edges:
+            edges.add(-r, i, j)
+            for (r, i, j) in edges.sorted(): ...
+    """
+
+    def __init__(self, typecodes, memory_limit=None, temp_dir=None):
+        self.typecodes = tuple(typecodes)
+        self.fields = [array(t) for t in self.typecodes]
+        self.capacity = run_capacity(memory_limit, sum(a.itemsize for a in self.fields)) if memory_limit else None
+        self.temp_dir = temp_dir
+        self.directory = None
+        self.runs = list()
+        self.count = 0    # records added
+        self.spills = 0   # runs spilled
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, *record):
+        for (a, v) in zip(self.fields, record):
+            a.append(v)
+        self.count += 1
+        if self.capacity and len(self.fields[0]) >= self.capacity:
+            self.spill()
+
+    def spill(self):
+        """Sorts the buffered records into a run file and empties the buffer"""
+        if not len(self.fields[0]):
+            return
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="fuzzyspreadsheets-", dir=self.temp_dir)
+        self.runs.append(spill_run(sorted(zip(*self.fields)), self.directory, "run{}".format(self.spills)))
+        self.spills += 1
+        self.fields = [array(t) for t in self.typecodes]
+
+    def sorted(self):
+        """Generator of all the records in ascending order (the spilled runs merged with the buffer)"""
+        buffered = sorted(zip(*self.fields))
+        if not self.runs:
+            return iter(buffered)
+        runs, self.runs = self.runs, list()
+        return heapq.merge(*(read_run(path) for path in runs), buffered)
+
+    def close(self):
+        """Removes the run files"""
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+
+
+class CandidateLists:
+    """
+    The candidate lists of the rows (lists of (ratio, row) pairs, see assignment.top_candidates) in flat arrays:
+    12 bytes per candidate instead of a list of tuples per row. Indexing returns the list of a row
+    """
+
+    def __init__(self):
+        self.ratios = array('d')
+        self.rows = array('I')
+        self.offsets = array('Q', [0])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        a, b = self.offsets[i], self.offsets[i+1]
+        return list(zip(self.ratios[a:b], self.rows[a:b]))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def append(self, candidates):
+        for (r, j) in candidates:
+            self.ratios.append(r)
+            self.rows.append(j)
+        self.offsets.append(len(self.rows))
+
+
+
+def external_sort(records, run_size, directory, name):
+    """Sorts the records with at most run_size records in memory: the sorted runs are spilled into files and merged"""
+    runs = list()
+    while True:
+        run = sorted(islice(records, run_size))
+        if not run:
+            break
+        runs.append(spill_run(run, directory, "{}-{}".format(name, len(runs))))
+    return heapq.merge(*(read_run(path) for path in runs))
+
+
+
+def spill_run(run, directory, name):
+    """Writes a sorted run into a file (pickled in chunks) and returns its path"""
+    path = os.path.join(directory, name + ".run")
+    with open(path, mode='wb') as fw:
+        for k in range(0, len(run), CHUNK_SIZE):
+            pickle.dump(run[k:k+CHUNK_SIZE], fw, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+
+def read_run(path):
+    """Generator of the records of a run file (the file is deleted when exhausted)"""
+    with open(path, mode='rb') as fr:
+        while True:
+            try:
+                chunk = pickle.load(fr)
+            except EOFError:
+                break
+            yield from chunk
+    os.remove(path)
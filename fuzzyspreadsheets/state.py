@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+"""
+Persisted state of a detect_duplicates run (used for incremental duplicate detection).
+The state holds the rows, normalized rows, column types, candidate index and the current row matchings
+(and with clustering, the edges above the threshold, so that the rows can be re-clustered),
+and the options fixing the column types (typed_columns, phonetic),
+so that a later run with appended rows only needs to compare the new rows (see model.update_duplicates)
+"""
+
+
+import os
+import pickle
+
+
+# Increment whenever the content of the state changes (old state files are then rejected)
+STATE_VERSION = 3
+
+
+
+def save_state(state_file, state):
+    """Saves the state (a dict) to a file. Written to a temp file first so that the previous state is never left half written"""
+    directory = os.path.dirname(str(state_file))
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    temp = str(state_file) + ".{}.tmp".format(os.getpid())
+    with open(temp, mode='wb') as fw:
+        pickle.dump(dict(state, version=STATE_VERSION), fw, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp, state_file)
+    return state_file
+
+
+
+def load_state(state_file):
+    """Loads the state saved by save_state"""
+    with open(state_file, mode='rb') as fr:
+        state = pickle.load(fr)
+    if not (isinstance(state, dict) and state.get("version") == STATE_VERSION):
+        raise ValueError(f"incompatible state file: {state_file}")
+    return state
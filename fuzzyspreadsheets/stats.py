@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+Opt-in instrumentation of a detect_duplicates / merge_spreadsheets run.
+A RunStats object records:
+    stages : wall time per stage (loading, normalizing, column_types, vectorizing, indexing, match_columns, scoring, assignment, writing)
+    metrics : number of calls and time per similarity function (only the computed scores, not the ones served by the score cache)
+              the batched kernels (see model.row_similarities) count one call per scored pair
+    counters : pairs_total, pairs_scored (pairs_pruned = the difference, e.g. by blocking), cache hits and misses, matched/unmatched rows
+Usage:
+    output_filepath, stats = detect_duplicates("spreadsheet.csv", stats=True)
+    stats.as_dict()  or  stats.to_json()
+Without stats the functions only test a None object, i.e. the instrumentation costs nothing.
+"""
+
+
+import json
+import time
+from functools import wraps
+from contextlib import contextmanager, nullcontext
+
+
+
+class RunStats:
+    """Timings and counters of one run. See the module docstring"""
+
+    def __init__(self):
+        self.stages = dict()     # stage -> seconds
+        self.metrics = dict()    # function name -> [calls, seconds]
+        self.counters = dict()   # counter -> int
+        self.start = time.perf_counter()
+        self.seconds = None      # total wall time (set by finish)
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager adding the wall time of the block to the stage"""
+        t = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - t
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def timed(self, func):
+        """Wraps a similarity function so that its calls and time are recorded (the name is kept, see scorecache.py)"""
+        record = self.metrics.setdefault(func.__name__, [0, 0.0])
+        @wraps(func)
+        def closure(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record[0] += 1
+                record[1] += time.perf_counter() - t
+        return closure
+
+    def timed_functions(self, functions):
+        return tuple(self.timed(func) for func in functions)
+
+    def timed_kernel(self, name, kernel):
+        """Wraps a batched kernel (the positions ks -> their ratios) so that each scored pair counts as a call of the function name"""
+        record = self.metrics.setdefault(name, [0, 0.0])
+        def closure(ks):
+            t = time.perf_counter()
+            try:
+                return kernel(ks)
+            finally:
+                record[0] += len(ks)
+                record[1] += time.perf_counter() - t
+        return closure
+
+    def add_score_cache(self, score_cache, since=(0, 0)):
+        """Adds the hits and misses of a PairScoreCache (minus the counts 'since' of a cache shared with other runs)"""
+        if score_cache is not None:
+            self.count("score_cache_hits", score_cache.hits - since[0])
+            self.count("score_cache_misses", score_cache.misses - since[1])
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self.start
+        return self
+
+    @property
+    def pairs_pruned(self):
+        return self.counters.get("pairs_total", 0) - self.counters.get("pairs_scored", 0)
+
+    def hit_rate(self, cache):
+        """Hit rate of 'prepared_cache', 'score_cache' or 'result_cache' (None if the cache was not used)"""
+        hits, misses = self.counters.get(cache + "_hits", 0), self.counters.get(cache + "_misses", 0)
+        return round(hits / (hits + misses), 4) if hits + misses else None
+
+    def as_dict(self):
+        seconds = self.seconds if self.seconds is not None else time.perf_counter() - self.start
+        return dict(seconds=round(seconds, 4),
+                    stages={k: round(v, 4) for (k, v) in self.stages.items()},
+                    metrics={k: dict(calls=c, seconds=round(s, 4)) for (k, (c, s)) in self.metrics.items()},
+                    counters=dict(self.counters, pairs_pruned=self.pairs_pruned),
+                    hit_rates={k: self.hit_rate(k) for k in ("prepared_cache", "score_cache", "result_cache")})
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.as_dict(), **kwargs)
+
+    def __repr__(self):
+        return "RunStats({})".format(self.to_json())
+
+
+
+def stage(stats, name):
+    """stats.stage(name) or a no-op context manager if there are no stats"""
+    return stats.stage(name) if stats is not None else nullcontext()
+
+
+
+def make_stats(stats):
+    """Returns a RunStats for stats=True, the given RunStats as it is, or None"""
+    if stats is None or stats is False:
+        return None
+    return RunStats() if stats is True else stats
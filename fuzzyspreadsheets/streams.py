@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+"""
+Lazy output of detect_duplicates / merge_spreadsheets: the matched groups are yielded as soon as they are final,
+instead of being materialized, sorted and written at the very end.
+The rows are split into groups that cannot influence each other's matchings:
+    blocking : the connected components of the candidate graph (rows sharing a blocking key, see blocking.py)
+    otherwise : one group with all the rows (i.e. everything is final only at the end)
+Each group is scored and matched on its own (with the same greedy assignment and the same results as the whole table)
+and yielded right away:
+    (row, row, similarity ratio) for a matched pair (left row, right row for a merge, in the order of the sources)
+    (row, None, None) or (None, row, None) for an unmatched row
+Usage:
+    stream = duplicate_groups("spreadsheet.csv", blocking=True)
+    for (row, duplicate, ratio) in stream: ...
+    write_stream(merge_groups("spreadsheet1.csv", "spreadsheet2.csv", blocking=True), "merged.csv")
+"""
+
+
+import csv
+from .utils import open_csv
+from .model import prepare_table, match_prepared_columns, row_similarity, tile_keys, row_merger
+from .blocking import candidate_rows, row_keys
+from .scorecache import open_score_cache
+from .progress import progress_reporter
+from .clustering import components
+from .assignment import offset_ratio, greedy_assignment
+
+
+
+class MatchStream:
+    """
+    Iterable of the finalized groups (see the module docstring). It can be iterated only once.
+    kind : 'detect' or 'merge'
+    header : the header of the table ('detect') or a pair of headers (header1, header2) ('merge')
+    column_matchings : 'merge' only - pairs of column indeces (source1, source2), zero-based not counting the id column
+    """
+
+    def __init__(self, kind, header, groups, column_matchings=None):
+        self.kind = kind
+        self.header = header
+        self.groups = groups
+        self.column_matchings = column_matchings
+
+    def __iter__(self):
+        return self.groups
+
+
+
+def duplicate_groups(source, includes_header=True, includes_id_column=True, threshold=None, blocking=False,
+                     cache_dir=None, cache_size=None, score_cache=None, progress=None):
+    """
+    Lazy version of detect_duplicates (the arguments are the same, source is a file path or an in-memory source)
+    Returns a MatchStream yielding (row, duplicate row, similarity ratio) and (row, None, None) for the unique rows
+    """
+    table = prepare_table(source, includes_header=includes_header, includes_id_column=includes_id_column,
+                          cache_dir=cache_dir, cache_size=cache_size)
+    groups = generate_duplicate_groups(table, threshold=threshold, blocking=blocking, score_cache=score_cache, progress=progress)
+    return MatchStream("detect", table["header"], groups)
+
+
+
+def generate_duplicate_groups(table, threshold=None, blocking=False, score_cache=None, progress=None):
+    """Generator of the finalized groups of a prepared table (see duplicate_groups and model.match_duplicates)"""
+    threshold = threshold or 0.45
+    rows, normalized, column_types = table["rows"], table["normalized"], table["column_types"]
+    n = len(rows)
+
+    # Groups
+    if blocking:
+        columns = [(i, i, t) for (i, t) in enumerate(column_types)]
+        neighbours = [sorted(j for j in candidate_rows(table["index"], row_keys(normalized[i], columns)) if j > i) for i in range(n)]
+        groups = components(n, ((i, j) for i in range(n) for j in neighbours[i]))
+    else:
+        neighbours = None
+        groups = [list(range(n))] if n else []
+
+    score_cache, opened = open_score_cache(score_cache)
+    report = progress_reporter(progress, "scoring", n)
+    done = 0
+    try:
+        for group in groups:
+            # Most similar row of each row: row -> (ratio, index) (ties go to the smaller index like in the whole table)
+            best = {i: (0, n) for i in group}
+            for i in group:
+                js = neighbours[i] if blocking else range(i+1, n)
+                if score_cache:
+                    score_cache.prefetch(tile_keys(normalized[i], normalized, js, column_types=column_types))
+                for j in js:
+                    r = row_similarity(normalized[i], normalized[j], column_types=column_types, normalized=True, score_cache=score_cache)
+                    if r > best[i][0] or (r == best[i][0] and j < best[i][1]): best[i] = (r, j)
+                    if r > best[j][0] or (r == best[j][0] and i < best[j][1]): best[j] = (r, i)
+                if score_cache:
+                    score_cache.flush()
+
+            # Greedy assignment within the group
+            rankings = sorted(((i, best[i][1], best[i][0]) for i in group), reverse=True, key=lambda t: t[2])
+            matched = list(greedy_assignment(rankings, threshold, duplicates=True))
+            nx = set(group).difference(k for t in matched for k in t[:2])
+
+            # Yield the group
+            for (i,j,r) in sorted(matched):
+                yield (rows[i], rows[j], r)
+            for i in sorted(nx):
+                yield (rows[i], None, None)
+            done += len(group)
+            if report: report(done)
+    finally:
+        if opened: score_cache.close()
+    if report: report.done()
+
+
+
+def merge_groups(source1, source2, includes_header=True, includes_id_column=True, threshold=None, columns_matching=None,
+                 blocking=False, cache_dir=None, cache_size=None, score_cache=None, progress=None):
+    """
+    Lazy version of merge_spreadsheets (the arguments are the same, the sources are file paths or in-memory sources)
+    Returns a MatchStream yielding (row1, row2, similarity ratio) and (row1, None, None) or (None, row2, None) for unmatched rows
+    """
+    table1, table2 = (prepare_table(source, includes_header=includes_header, includes_id_column=includes_id_column,
+                                    cache_dir=cache_dir, cache_size=cache_size) for source in (source1, source2))
+    table_left, table_right, column_matchings, column_types = match_prepared_columns(table1, table2,
+                                                proportion_of_column_names_similarity=columns_matching)
+    swapped = table_left is not table1
+    groups = generate_merge_groups(table_left, table_right, column_matchings, column_types, swapped=swapped,
+                                   threshold=threshold, blocking=blocking, score_cache=score_cache, progress=progress)
+    if swapped:
+        column_matchings = [(t[1], t[0]) for t in column_matchings]
+    return MatchStream("merge", (table1["header"], table2["header"]), groups, column_matchings)
+
+
+
+def generate_merge_groups(table_left, table_right, column_matchings, column_types, swapped=False,
+                          threshold=None, blocking=False, score_cache=None, progress=None):
+    """
+    Generator of the finalized groups of two prepared tables (see merge_groups and model.match_rows)
+    If swapped, the right table is the first source (the yielded pairs are in the order of the sources)
+    """
+    threshold = threshold or 0.49
+    rows_left, rows_right = table_left["normalized"], table_right["normalized"]
+    m, n = len(rows_left), len(rows_right)
+    order = (lambda a, b, r: (b, a, r)) if swapped else (lambda a, b, r: (a, b, r))
+
+    # Groups (the nodes are the left rows 0..m-1 and the right rows m..m+n-1)
+    if blocking:
+        columns = [(ix_left, ix_right, t) for ((ix_left, ix_right), t) in zip([t for t in column_matchings if None not in t], column_types)]
+        neighbours = [sorted(candidate_rows(table_right["index"], row_keys(row, columns))) for row in rows_left]
+        groups = components(m + n, ((i, m + j) for i in range(m) for j in neighbours[i]))
+    else:
+        neighbours = None
+        groups = [list(range(m + n))] if m + n else []
+
+    score_cache, opened = open_score_cache(score_cache)
+    report = progress_reporter(progress, "scoring", m)
+    done = 0
+    try:
+        for group in groups:
+            lefts = [x for x in group if x < m]
+
+            # Most similar right row of each left row and the offset ratio (see match_rows)
+            rankings = list()
+            for i in lefts:
+                js = neighbours[i] if blocking else range(n)
+                if score_cache:
+                    score_cache.prefetch(tile_keys(rows_left[i], rows_right, js, column_matchings, column_types))
+                mm, jj, total = 0, 0, 0
+                for j in js:
+                    r = row_similarity(rows_left[i], rows_right[j], column_matchings=column_matchings, column_types=column_types,
+                                       normalized=True, score_cache=score_cache)
+                    total += r
+                    if r > mm: mm, jj = r, j
+                if score_cache:
+                    score_cache.flush()
+                rankings.append((i, jj, mm, offset_ratio(mm, total, n)))
+            rankings = sorted(rankings, reverse=True, key=lambda t: t[2])
+
+            # Greedy assignment within the group
+            matched = list(greedy_assignment(rankings, threshold))
+
+            # Yield the group
+            for (i,j,r) in sorted(matched):
+                yield order(table_left["rows"][i], table_right["rows"][j], r)
+            matched_left, matched_right = {t[0] for t in matched}, {t[1] for t in matched}
+            for i in lefts:
+                if i not in matched_left:
+                    yield order(table_left["rows"][i], None, None)
+            for x in group:
+                if x >= m and x - m not in matched_right:
+                    yield order(None, table_right["rows"][x - m], None)
+            done += len(lefts)
+            if report: report(done)
+    finally:
+        if opened: score_cache.close()
+    if report: report.done()
+
+
+
+def write_stream(stream, output_filepath):
+    """
+    Writes a MatchStream into a csv file as the groups arrive (compressed if the file name ends with .gz, .bz2 or .xz).
+    Duplicates: the rows with a new id column "id(new)" (a pair of duplicates shares the new id), in the order of the groups.
+    Merges: the merged rows (the columns of the first source are labelled "(left)", of the second "(right)").
+    Returns the output file path
+    """
+    with open_csv(output_filepath, mode='wt') as fw:
+        wr = csv.writer(fw)
+        if stream.kind == "detect":
+            wr.writerow(("id(new)",) + tuple(stream.header))
+            for (k, (row, duplicate, _)) in enumerate(stream, start=1):
+                wr.writerow((k,) + tuple(row))
+                if duplicate is not None:
+                    wr.writerow((k,) + tuple(duplicate))
+        else:
+            header, merge = row_merger(stream.header[0], stream.header[1], stream.column_matchings)
+            wr.writerow(header)
+            for (row1, row2, _) in stream:
+                wr.writerow(merge(row1, row2))
+    return output_filepath
@@ -5,10 +5,24 @@ utility functions for the fuzzyspreadsheets package
 """
 
 
-import os, csv
+import os, io, csv
+import gzip, bz2, lzma, zlib
 from functools import wraps
 
 
+# Compression is derived from the file extension (e.g. "spreadsheet.csv.gz")
+COMPRESSION_OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+CSV_EXTENSIONS = (".csv",) + tuple(".csv" + ext for ext in COMPRESSION_OPENERS)
+
+# In memory the compression is derived from the first bytes of the data (the decompressors take a max_length, see decompress)
+COMPRESSION_MAGIC = {b"\x1f\x8b": lambda: zlib.decompressobj(wbits=31), b"BZh": bz2.BZ2Decompressor, b"\xfd7zXZ\x00": lzma.LZMADecompressor}
+
+
+
+class SourceTooLarge(ValueError):
+    """Raised when an in-memory csv source is larger than allowed (after decompression, see read_csv_source)"""
+
+
 # Decorator with arguments
 def check_types(*types, **types_dict):    # types_dict  will be ignored here
     """Pass the types as arguments into this decorator e.g.  check_types(int, str, int)"""
@@ -69,7 +83,7 @@ def construct_filepath(filename=None, directory=None):
     """Constructs filepath from provided directory+filename. Flexible functionality"""
     # defaults
     filename = filename or "spreadsheet.csv"
-    if not str(filename).endswith(".csv"): filename = str(filename) + ".csv"
+    if not csv_extension(filename): filename = str(filename) + ".csv"
     directory = str(directory or os.getcwd())
     
     # If directory doesnt exist, maybe - expanduser?
@@ -92,6 +106,74 @@ def construct_filepath(filename=None, directory=None):
 
 
 
+def csv_extension(filepath):
+    """Returns the csv extension of a file path (".csv", ".csv.gz", ".csv.bz2", ".csv.xz") or None"""
+    filepath = str(filepath).lower()
+    return next((ext for ext in sorted(CSV_EXTENSIONS, key=len, reverse=True) if filepath.endswith(ext)), None)
+
+
+
+def strip_csv_extension(filepath):
+    """Removes the (possibly compressed) csv extension from a file path or file name"""
+    ext = csv_extension(filepath)
+    return str(filepath)[:-len(ext)] if ext else str(filepath)
+
+
+
+def open_csv(filepath, mode='rt'):
+    """Opens a csv file in text mode. Files ending with .gz, .bz2 or .xz are (de)compressed on the fly"""
+    opener = COMPRESSION_OPENERS.get(os.path.splitext(str(filepath))[-1].lower(), open)
+    return opener(filepath, mode=mode, encoding='utf-8')
+
+
+
+def read_csv_source(source, max_size=None):
+    """
+    Reads the rows of an in-memory csv source:
+        bytes (plain or gzip/bz2/xz compressed csv), a file-like object (binary or text, e.g. an uploaded file stream)
+        or an iterable of rows (lists or tuples of values)
+    max_size : the maximum size of the (decompressed) csv data in bytes, SourceTooLarge is raised above it (None = no limit)
+    Returns a list of rows
+    """
+    if hasattr(source, "read"):
+        source = source.read()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = bytes(source)
+        decompressor = next((f for (magic, f) in COMPRESSION_MAGIC.items() if source.startswith(magic)), None)
+        source = decompress(source, decompressor, max_size=max_size) if decompressor else source
+        if max_size is not None and len(source) > max_size:
+            raise SourceTooLarge(f"the csv data is larger than {max_size} bytes")
+        source = source.decode('utf-8')
+    if isinstance(source, str):
+        return list(csv.reader(io.StringIO(source, newline='')))
+    return [list(row) for row in source]
+
+
+
+def decompress(data, decompressor, max_size=None):
+    """
+    Decompresses data (of one or more concatenated streams) with a decompressor factory (see COMPRESSION_MAGIC).
+    At most max_size+1 bytes are ever inflated: SourceTooLarge is raised above max_size (e.g. a decompression bomb)
+    """
+    chunks, size = [], 0
+    while data:
+        d = decompressor()
+        try:
+            chunk = d.decompress(data) if max_size is None else d.decompress(data, max_size + 1 - size)
+        except (zlib.error, lzma.LZMAError, OSError) as err:
+            raise ValueError(f"invalid compressed csv data: {err}") from err
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise SourceTooLarge(f"the decompressed csv data is larger than {max_size} bytes")
+        if not d.eof:
+            raise ValueError("the compressed csv data is truncated")
+        chunks.append(chunk)
+        data = d.unused_data
+    return b''.join(chunks)
+
+
+
+
 import unicodedata
 def strip_diacritics(s):
     """Removes diacretics and umlauts from a string"""
@@ -112,7 +194,7 @@ def debug_report(func):
     unmatchings = len([i if i is not None else j for (i,j) in lt if None in (i,j)]) - len({i if i is not None else j for (i,j) in lt if None in (i,j)})
     
     # Print report
-    print("\n\nREPORT ({})".format("detect_duplicates" if func.__name__ == "detect_duplicates" else "merge_spreadsheets"))
+    print("\n\nREPORT ({})".format("detect_duplicates" if func.__name__ in ("detect_duplicates", "match_duplicates") else "merge_spreadsheets"))
     print("==============================")
     if hasattr(func, "column_matchings"):
         print("\ncolumn matchings:")
@@ -138,7 +220,7 @@ def debug_detect_duplicates(filepath, rows, row_matchings):
     Work only with the generated files.
     """
     directory = os.path.split(filepath)[0]
-    filename = os.path.split(filepath)[-1].replace(".csv",'') + "_log.csv"
+    filename = strip_csv_extension(os.path.split(filepath)[-1]) + "_log.csv"
     filepath = os.path.join(directory, filename)
     if not os.path.exists(filepath):
         print(f"\nLog file '{filepath}' for debugging not found")
@@ -186,11 +268,11 @@ def debug_merge_spreadsheets(file_left, file_right, rows_left, rows_right, row_m
     """
     
     directory = os.path.split(file_left)[0]
-    filename1, filename2 = (os.path.split(s)[-1].replace(".csv",'') for s in (file_left, file_right))
+    filename1, filename2 = (strip_csv_extension(os.path.split(s)[-1]) for s in (file_left, file_right))
     filename = "{}_{}_log.csv".format(filename1, filename2)
     path = os.path.join(directory, filename)
     if not os.path.exists(path):
-        filename1, filename2 = (os.path.split(s)[-1].replace(".csv",'') for s in (file_right, file_left))
+        filename1, filename2 = (strip_csv_extension(os.path.split(s)[-1]) for s in (file_right, file_left))
         filename = "{}_{}_log.csv".format(filename1, filename2)
         path = os.path.join(directory, filename)
     if not os.path.exists(path):
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""
+Whole-column kernels with an optional NumPy path.
+NumPy is not required: if it is not installed (or HAS_NUMPY is set to False), the pure Python fallbacks are used,
+with the same results (the NumPy floats may differ in the last digits).
+    character_histograms : the character counts of whole columns (see model.vectorize_rows) - np.bincount over the code points
+    column_similarity_matrix : the cosine similarities of all the column vectors blended with the header n-gram ratios
+                               (see model.match_prepared_columns) - one matrix product instead of a cosine per pair of columns
+    BigramIndex : the bigram sets of the values of a column as integer ids (CSR-like: ids, offsets, sizes),
+                  scoring one value against all (or the candidate) values of the column in one pass
+                  - the same ratios as metrics.n_grams_ratio, without the per-pair overhead (see model.row_similarities)
+"""
+
+
+from collections import Counter
+from itertools import chain
+from .metrics import n_grams_ratio
+
+try:
+    import numpy as np
+except ImportError:   # optional dependency
+    np = None
+
+
+# Use NumPy if installed (can be switched off, e.g. to compare the two paths)
+HAS_NUMPY = np is not None
+
+# Code points counted in the column vectors (the printable upper case ASCII characters)
+FIRST_CODE, LAST_CODE = 32, 90
+
+# BigramIndex: the minimum number of scored values for the NumPy pass over the whole column
+# (and the minimum share of the column, e.g. with blocking only a few candidates are scored - with set intersections)
+NUMPY_MIN_VALUES = 32
+NUMPY_MIN_SHARE = 0.25
+
+
+
+def character_histograms(columns, first=None, last=None):
+    """
+    The counts of the characters first..last (code points) of each column, upper case
+    columns : a list of columns, each a list of str values
+    Returns a list with one list of ints per column
+    """
+    first = FIRST_CODE if first is None else first
+    last = LAST_CODE if last is None else last
+    histograms = list()
+    for column in columns:
+        s = ''.join(v.upper() for v in column)
+        if HAS_NUMPY:
+            codes = np.frombuffer(s.encode('utf_32_le'), dtype='<u4')
+            codes = codes[(codes >= first) & (codes <= last)] - first
+            histograms.append(np.bincount(codes, minlength=last - first + 1).tolist())
+        else:
+            counts = Counter(s)
+            histograms.append([counts[chr(n)] for n in range(first, last + 1)])
+    return histograms
+
+
+
+def column_similarity_matrix(vectors_left, vectors_right, n_grams_ratios, p):
+    """
+    The matrix of the column similarities: (cosine similarity * (1-p) + header n-gram ratio * p) / 2
+    vectors_left, vectors_right : the column vectors (see model.vectorize_rows)
+    n_grams_ratios : the matrix of the n-gram ratios of the header names (left x right)
+    p : the proportion of the header names similarity
+    Returns a list of lists (left x right). Columns with an all-zero vector have a cosine similarity of 0
+    """
+    if HAS_NUMPY and vectors_left and vectors_right:
+        a, b = (np.asarray(vectors, dtype=np.float64) for vectors in (vectors_left, vectors_right))
+        norms = np.outer(np.linalg.norm(a, axis=1), np.linalg.norm(b, axis=1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cosines = np.where(norms > 0, (a @ b.T) / norms, 0.0)
+        blended = (cosines * (1-p) + np.asarray(n_grams_ratios, dtype=np.float64).reshape(cosines.shape) * p) / 2
+        return blended.tolist()
+    norms_left, norms_right = ([sum(v**2 for v in vector) ** 0.5 for vector in vectors] for vectors in (vectors_left, vectors_right))
+    matrix = list()
+    for (a, norm_a, ratios) in zip(vectors_left, norms_left, n_grams_ratios):
+        cosines = [sum(c1*c2 for c1,c2 in zip(a, b)) / (norm_a * norm_b) if norm_a * norm_b else 0
+                   for (b, norm_b) in zip(vectors_right, norms_right)]
+        matrix.append([sum([v1*(1-p), v2*(p)])/2 for (v1,v2) in zip(cosines, ratios)])
+    return matrix
+
+
+
+def bigrams(value):
+    """The bigram set of a value as in metrics.n_grams_ratio (stripped, lower case)"""
+    s = str(value).strip().lower()
+    return {s[k:k+2] for k in range(len(s) - 1)}
+
+
+
+class BigramIndex:
+    """
+    The bigram sets of the values of a column, each bigram encoded as an integer id (the vocabulary is the column's).
+    ratios(value, js) returns n_grams_ratio(value, values[j]) for j in js.
+    The values that n_grams_ratio treats specially (shorter than 2 characters - unigrams - or without bigrams)
+    are scored with n_grams_ratio itself
+    """
+
+    def __init__(self, values):
+        self.values = list(values)
+        self.vocabulary = dict()
+        self.sets = [frozenset(self.vocabulary.setdefault(g, len(self.vocabulary)) for g in bigrams(v)) for v in self.values]
+        self.special = {j for (j, v) in enumerate(self.values) if len(v) < 2 or not self.sets[j]}
+        if HAS_NUMPY:
+            self.sizes = np.fromiter((len(t) for t in self.sets), dtype=np.int64, count=len(self.sets))
+            self.ids = np.fromiter(chain.from_iterable(sorted(t) for t in self.sets), dtype=np.int64)
+            self.offsets = np.concatenate(([0], np.cumsum(self.sizes)))
+            self.cells = np.repeat(np.arange(len(self.sets)), self.sizes)   # the value of each id
+
+    def __len__(self):
+        return len(self.values)
+
+    def ratios(self, value, js=None):
+        """The n-gram ratios of a value against the values js (all the values if None) as a list"""
+        js = range(len(self.values)) if js is None else js
+        grams = bigrams(value)
+        if len(value) < 2 or not grams:
+            return [n_grams_ratio(value, self.values[j]) for j in js]
+        left = {self.vocabulary[g] for g in grams if g in self.vocabulary}
+        size = len(grams)   # including the bigrams unknown to the column
+        if HAS_NUMPY and len(js) >= max(NUMPY_MIN_VALUES, NUMPY_MIN_SHARE * len(self.values)):
+            hit = np.zeros(len(self.vocabulary), dtype=bool)
+            hit[list(left)] = True
+            intersections = np.bincount(self.cells[hit[self.ids]], minlength=len(self.values))
+            js_array = np.asarray(js, dtype=np.int64)
+            intersections = intersections[js_array]
+            ratios = (intersections / (size + self.sizes[js_array] - intersections)).tolist()
+        else:
+            ratios = list()
+            for j in js:
+                k = len(left & self.sets[j])
+                ratios.append(k / (size + len(self.sets[j]) - k))
+        if self.special:
+            for (k, j) in enumerate(js):
+                if j in self.special:
+                    ratios[k] = n_grams_ratio(value, self.values[j])
+        return ratios
@@ -5,19 +5,43 @@ including the do_backend function which is a wrapper for the detect/merge proces
 
 
 import os
-from json import dump, loads
+import hashlib
+from json import dump, load, loads
+from shutil import rmtree
 from datetime import datetime
 from string import ascii_lowercase
 from random import choices
 from fuzzyspreadsheets import generate_spreadsheet, generate_spreadsheets, detect_duplicates, merge_spreadsheets
+from fuzzyspreadsheets.cache import file_hash, PREPROCESSING_VERSION
+from fuzzyspreadsheets.profiling import profile_mode
 
 
+# Default size limit of the cached results (their output folders in the downloads folder)
+DEFAULT_RESULT_CACHE_SIZE = 1024 * 1024 * 512   # 512 megabytes
 
-def do_backend(filepaths=None, operation=None, app=None):
+
+
+def do_backend(filepaths=None, operation=None, app=None, compression=None, config=None, strategy=None,
+               threshold=None, columns_matching=None, progress=None, stats=None, profile=None):
     """
     Wrapper function for spreadsheet merging at the backend level
     filepaths: list of str or None
-        a container of file-paths as strings
+        a container of file-paths as strings (plain or compressed csv files)
+    compression: str or None
+        'gz', 'bz2' or 'xz' to compress the output files. If None, app.config['DOWNLOAD_COMPRESSION'] is used (if any)
+    config: dict or None
+        the app configuration, used instead of app.config (e.g. in a worker process where the app is not available)
+    strategy: str or None
+        'exhaustive' (the default) or 'blocked' as chosen by the planner (see fuzzyspreadsheets.planner)
+    threshold, columns_matching:
+        passed on to detect_duplicates / merge_spreadsheets
+    progress: callable or None
+        callback progress(stage, completed, total, rate) (see fuzzyspreadsheets/progress.py)
+    stats: RunStats or None
+        filled with the timings and counters of the run (see fuzzyspreadsheets/stats.py)
+    profile: str or None
+        'cprofile' or 'sample' to save a profile of the run next to the output files (see fuzzyspreadsheets/profiling.py).
+        If None, app.config['PROFILE'] is used (if any), then the environment variable FUZZYSPREADSHEETS_PROFILE
     returns: tuple of str
         a list or tuple of strings representing paths to the output files
     """
@@ -28,9 +52,32 @@ def do_backend(filepaths=None, operation=None, app=None):
     # Construct folder name
     directory = "{}_{}_{}".format(operation, datetime.now().strftime("%Y_%m_%d_%H_%M_%S"),
                                    str.join('', (ascii_lowercase[ix] for ix in choices(range(26), k=5))))
-    download_folder = app.config['DOWNLOAD_FOLDER'] if app is not None else "downloads"
+    config = config if config is not None else (app.config if app is not None else {})
+    download_folder = config.get('DOWNLOAD_FOLDER') or "downloads"
     directory = os.path.join(download_folder, directory)
 
+    # Output file extension
+    compression = compression or config.get('DOWNLOAD_COMPRESSION')
+    ext = ".csv" + ('.' + compression.lstrip('.') if compression else '')
+
+    # Cache of prepared tables (re-uploads of the same spreadsheet skip the preprocessing)
+    cache_dir = config.get('CACHE_FOLDER')
+    cache_size = config.get('CACHE_SIZE')
+    score_cache = config.get('SCORE_CACHE')
+    blocking = strategy == "blocked"
+    profile = profile or config.get('PROFILE')
+
+    # Cache of results: the same uploaded files with the same parameters return the existing output files
+    result_folder = config.get('RESULT_CACHE_FOLDER')
+    key = None
+    if filepaths and result_folder and not profile_mode(profile):   # a profiled job must run
+        key = result_key(filepaths, operation, threshold=threshold, columns_matching=columns_matching,
+                         strategy=strategy, ext=ext)
+        files = lookup_result(key, result_folder)
+        if stats is not None: stats.count("result_cache_hits" if files else "result_cache_misses")
+        if files:
+            return files
+
     # Make dir
     os.mkdir(directory)
 
@@ -38,23 +85,122 @@ def do_backend(filepaths=None, operation=None, app=None):
     if operation == "detect":
         if not filepaths:
             n_rows = choices(range(10, 100), weights=tuple(range(10, 100))[::-1])[0]
-            filepath = generate_spreadsheet(n_rows, directory=directory, filename="spreadsheet.csv")
+            filepath = generate_spreadsheet(n_rows, directory=directory, filename="spreadsheet" + ext)
         else:
             filepath = filepaths[0]
         # Detect duplicates
-        sorted_duplicates = detect_duplicates(filepath, filename="sorted_duplicates.csv", directory=directory)
-        return [sorted_duplicates] if filepaths else [sorted_duplicates, filepath]
+        sorted_duplicates = detect_duplicates(filepath, filename="sorted_duplicates" + ext, directory=directory, threshold=threshold,
+                                              cache_dir=cache_dir, cache_size=cache_size, score_cache=score_cache, blocking=blocking,
+                                              progress=progress, stats=stats, profile=profile)
+        if stats is not None: sorted_duplicates, stats = sorted_duplicates
+        files = [sorted_duplicates] if filepaths else [sorted_duplicates, filepath]
+        if key:
+            store_result(key, files, result_folder, download_folder, config.get('RESULT_CACHE_SIZE'))
+        return files
 
     # If 'merge'
     if not filepaths:   # Generate two input files
         n_rows = choices(range(10, 100), weights=tuple(range(10, 100))[::-1])[0]
-        filepath1, filepath2 = generate_spreadsheets(n_rows=n_rows, directory=directory)
+        filepath1, filepath2 = generate_spreadsheets(n_rows=n_rows, directory=directory,
+                                                     filename1="spreadsheet1" + ext, filename2="spreadsheet2" + ext)
     else:
         filepath1, filepath2 = filepaths
 
     # Merge the two files
-    merged_spreadsheet = merge_spreadsheets(filepath1, filepath2, directory=directory)
-    return [merged_spreadsheet] if filepaths else [merged_spreadsheet, filepath1, filepath2]
+    merged_spreadsheet = merge_spreadsheets(filepath1, filepath2, filename="merged_spreadsheet" + ext, directory=directory,
+                                            threshold=threshold, columns_matching=columns_matching,
+                                            cache_dir=cache_dir, cache_size=cache_size, score_cache=score_cache, blocking=blocking,
+                                            progress=progress, stats=stats, profile=profile)
+    if stats is not None: merged_spreadsheet, stats = merged_spreadsheet
+    files = [merged_spreadsheet] if filepaths else [merged_spreadsheet, filepath1, filepath2]
+    if key:
+        store_result(key, files, result_folder, download_folder, config.get('RESULT_CACHE_SIZE'))
+    return files
+
+
+
+def result_key(filepaths, operation, **params):
+    """Key of a cached result: SHA-256 of the input files (in order) + operation + parameters"""
+    params = ','.join("{}={!r}".format(k, params[k]) for k in sorted(params))
+    s = "{}|{}|v{}|{}".format('|'.join(file_hash(f) for f in filepaths), operation, PREPROCESSING_VERSION, params)
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+
+
+def lookup_result(key, folder):
+    """
+    Returns the output files of a cached result, or None if not cached (or if the files have been evicted).
+    A hit marks the output folder as recently used
+    """
+    path = os.path.join(folder, key + ".json")
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, mode='rt', encoding='utf-8') as fr:
+            files = load(fr)['files']
+    except (OSError, ValueError, KeyError):
+        files = None
+    if not files or not all(os.path.exists(f) for f in files):
+        try: os.remove(path)
+        except OSError: pass
+        return None
+    for directory in {os.path.dirname(f) for f in files}:
+        try: os.utime(directory)
+        except OSError: pass
+    return files
+
+
+
+def store_result(key, files, folder, download_folder=None, max_size=None):
+    """Records the output files of a result and evicts the least recently used cached results"""
+    if not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, key + ".json")
+    temp = path + ".{}.tmp".format(os.getpid())
+    with open(temp, mode='wt', encoding='utf-8') as fw:
+        dump({'files': list(files)}, fw)
+    os.replace(temp, path)
+    evict_results(folder, download_folder or "downloads", max_size, keep={os.path.dirname(f) for f in files})
+
+
+
+def evict_results(folder, download_folder, max_size=None, keep=()):
+    """
+    Deletes the least recently used cached results (by the modification time of their output folders, see lookup_result)
+    until the total size of the cached results is below max_size. The output folders and the record of a result go together.
+    Only the folders recorded by store_result (and inside the downloads folder) are deleted:
+    the folders of running jobs, of generated spreadsheets etc. are never touched. The folders in 'keep' are never deleted
+    """
+    max_size = max_size or DEFAULT_RESULT_CACHE_SIZE
+    keep = {os.path.abspath(d) for d in keep}
+    root = os.path.abspath(download_folder)
+    results, total = [], 0
+    for entry in os.scandir(folder):
+        if not entry.name.endswith(".json") or not entry.is_file():
+            continue
+        try:
+            with open(entry.path, mode='rt', encoding='utf-8') as fr:
+                files = load(fr)['files']
+        except (OSError, ValueError, KeyError):
+            continue
+        directories = {os.path.abspath(os.path.dirname(f)) for f in files}
+        directories = [d for d in directories if os.path.isdir(d) and os.path.dirname(d) == root]
+        if not directories:
+            continue
+        size = sum(os.path.getsize(os.path.join(dirpath, f)) for d in directories for (dirpath, _, filenames) in os.walk(d) for f in filenames)
+        mtime = max(os.stat(d).st_mtime for d in directories)
+        results.append((mtime, size, entry.path, directories))
+        total += size
+    for (_, size, record, directories) in sorted(results):
+        if total <= max_size:
+            break
+        if keep.intersection(directories):
+            continue
+        try: os.remove(record)
+        except OSError: pass
+        for directory in directories:
+            rmtree(directory, ignore_errors=True)
+        total -= size
 
 
 
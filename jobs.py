@@ -0,0 +1,150 @@
+"""
+Background job queue for the backend operations (detect/merge)
+The jobs run in a pool of worker processes. The state of each job is kept in a json record (one file per job)
+in the job folder, so that any web worker process can report the status of any job.
+"""
+
+
+import os
+import time
+import random
+from json import dump, load
+from datetime import datetime
+from uuid import uuid4
+from concurrent.futures import ProcessPoolExecutor
+from fuzzyspreadsheets.planner import estimate_job
+from fuzzyspreadsheets.stats import RunStats
+from helpers import do_backend, write_errorlog
+
+
+# Process pools shared by all the requests handled by this (web worker) process: 'small' and 'large' jobs
+# (large jobs queue up in their own pool so that they cannot starve the small ones)
+executors = dict()
+
+
+
+class JobRejected(Exception):
+    """Raised when the estimated cost of a job exceeds the budgets of this instance"""
+
+
+
+def get_executor(kind="small", workers=None):
+    """Returns the process pool of the given kind (created on first use) with at most 'workers' concurrent jobs"""
+    if kind not in executors:
+        executors[kind] = ProcessPoolExecutor(max_workers=workers or 1)
+    return executors[kind]
+
+
+
+def plan_job(filepaths, operation, config):
+    """
+    Estimates the cost of a job (see fuzzyspreadsheets.planner) and checks it against the budgets
+    JOB_MAX_PAIRS, JOB_MAX_MEMORY and JOB_MAX_SECONDS (None = no limit). Raises JobRejected if exceeded.
+    Returns the estimate, or None for generated spreadsheets (which are always small)
+    """
+    if not filepaths:
+        return None
+    estimate = estimate_job(filepaths, operation=operation, max_exhaustive_seconds=config.get('JOB_EXHAUSTIVE_SECONDS'))
+    pairs = estimate['pairs'] if estimate['strategy'] == "exhaustive" else estimate['pairs_blocked']
+    budgets = (('JOB_MAX_PAIRS', pairs, "rows to compare"), ('JOB_MAX_MEMORY', estimate['memory'], "memory"),
+               ('JOB_MAX_SECONDS', estimate['seconds'], "runtime"))
+    for (key, value, name) in budgets:
+        if config.get(key) is not None and value > config[key]:
+            raise JobRejected("The spreadsheet{} too large for this server (estimated {}: {} > {})".format(
+                's are' if len(filepaths) > 1 else " is", name, value, config[key]))
+    return estimate
+
+
+
+def job_filepath(job_id, folder=None):
+    """Path to the json record of a job"""
+    return os.path.join(folder or "jobs", os.path.basename(str(job_id)) + ".json")
+
+
+
+def read_job(job_id, folder=None):
+    """Returns the record of a job (a dict) or None if there is no such job"""
+    path = job_filepath(job_id, folder)
+    if not os.path.exists(path):
+        return None
+    with open(path, mode='rt', encoding='utf-8') as fr:
+        return load(fr)
+
+
+
+def update_job(job_id, folder=None, **fields):
+    """Updates (or creates) the record of a job. Written to a temp file first so that readers never see a half written record"""
+    record = read_job(job_id, folder) or {'id': job_id}
+    record.update(fields)
+    path = job_filepath(job_id, folder)
+    temp = path + ".{}.tmp".format(os.getpid())
+    with open(temp, mode='wt', encoding='utf-8') as fw:
+        dump(record, fw)
+    os.replace(temp, path)
+    return record
+
+
+
+def submit_job(filepaths=None, operation=None, config=None):
+    """
+    Estimates the cost of a backend operation, enqueues it and returns immediately
+    filepaths, operation: see do_backend
+    config: dict
+        the app configuration (JOB_* keys and the keys used by do_backend)
+    returns: str
+        the job id
+    raises: JobRejected
+        if the job exceeds the budgets of this instance (see plan_job)
+    """
+    config = dict(config or {})
+    folder = config.get('JOB_FOLDER')
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+
+    # Admission control
+    estimate = plan_job(filepaths, operation, config)
+    large = estimate is not None and estimate['seconds'] > (config.get('JOB_LARGE_SECONDS') or 60)
+    kind, workers = ("large", config.get('JOB_LARGE_WORKERS')) if large else ("small", config.get('JOB_WORKERS'))
+
+    job_id = uuid4().hex
+    update_job(job_id, folder, operation=operation, status="queued", files=None, error=None, estimate=estimate, queue=kind,
+               created=datetime.now().strftime("%d.%m.%Y %H:%M:%S"))
+    config = {k: v for (k, v) in config.items() if isinstance(v, (str, int, float, bool, list, tuple, type(None)))}   # picklable
+    strategy = estimate['strategy'] if estimate else None
+    get_executor(kind, workers).submit(run_job, job_id, filepaths, operation, config, strategy)
+    return job_id
+
+
+
+def job_progress(job_id, folder=None, interval=1.0):
+    """Returns a progress callback (see fuzzyspreadsheets/progress.py) recording the progress in the job record at most every 'interval' seconds"""
+    last = {'time': 0, 'stage': None}
+    def progress(stage, completed, total, rate):
+        now = time.monotonic()
+        if stage == last['stage'] and now - last['time'] < interval and completed != total:
+            return
+        last.update(time=now, stage=stage)
+        update_job(job_id, folder, progress=dict(stage=stage, completed=completed, total=total, rate=round(rate, 1)))
+    return progress
+
+
+
+def run_job(job_id, filepaths, operation, config, strategy=None):
+    """Runs a job in a worker process and records its outcome"""
+    folder = config.get('JOB_FOLDER')
+    random.seed()   # forked worker processes would otherwise share the random state (generated spreadsheets, folder names)
+    update_job(job_id, folder, status="running", started=datetime.now().strftime("%d.%m.%Y %H:%M:%S"))
+    stats = RunStats() if config.get('STATS_LOG') else None
+    try:
+        files = do_backend(filepaths, operation=operation, config=config, strategy=strategy, progress=job_progress(job_id, folder),
+                           stats=stats)
+    except Exception as err:
+        write_errorlog({'date': datetime.now().strftime("%d.%m.%Y %H:%M:%S"), 'job': job_id, 'description': err})
+        update_job(job_id, folder, status="failed", error=repr(err))
+    else:
+        if stats is not None:
+            stats = stats.finish().as_dict()
+            write_errorlog({'date': datetime.now().strftime("%d.%m.%Y %H:%M:%S"), 'job': job_id, 'operation': operation,
+                            'strategy': strategy, 'stats': stats}, filename=config['STATS_LOG'])
+        update_job(job_id, folder, status="done", files=list(files), stats=stats,
+                   finished=datetime.now().strftime("%d.%m.%Y %H:%M:%S"))
@@ -45,6 +45,46 @@ function show_spinner(){
     //document.querySelector("input[type='submit']").disabled = true;
 }
 
+function show_progress(job){
+    document.getElementById("job_status").textContent = job.status;
+    let p = job.progress;
+    if (p) {
+        let done = p.total ? " " + Math.round(p.completed / p.total * 100) + "%" : " " + p.completed + " rows";
+        document.getElementById("job_progress").textContent = p.stage + done + " (" + p.rate + " rows/s)";
+    }
+}
+
+function poll_job(job_id){
+    window.setInterval(spinner, 500);
+    // Progress updates streamed by the server (server-sent events), polling as a fallback
+    // (also when the server ends the stream with a 'timeout' event or the connection fails)
+    if (window.EventSource) {
+        let source = new EventSource("/jobs/" + job_id + "/events");
+        source.onmessage = function(event){
+            let job = JSON.parse(event.data);
+            show_progress(job);
+            if (job.status == "done" || job.status == "failed") {source.close(); window.location.reload();}
+        };
+        let polling = false;
+        let fallback = function(){ source.close(); if (!polling) {polling = true; poll_status(job_id);} };
+        source.addEventListener("timeout", fallback);
+        source.onerror = fallback;
+        return;
+    }
+    poll_status(job_id);
+}
+
+function poll_status(job_id){
+    window.setInterval(function(){
+        fetch("/jobs/" + job_id)
+            .then(function(response){ return response.json(); })
+            .then(function(job){
+                show_progress(job);
+                if (job.status == "done" || job.status == "failed") {window.location.reload();}
+            });
+    }, 2000);
+}
+
 let path = window.location.pathname.split('/').pop();
 if (path == "merge" | path == "detect") {
     window.onload = function() {
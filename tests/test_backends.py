@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+The Levenshtein backends (see metrics.set_backend) and the closed form of token_set_ratio give the same floats
+as the pure Python kernels, so the output files do not depend on the installed packages.
+Run from the repository root:  python -m pytest tests
+"""
+
+
+import random
+import string
+import pytest
+from fuzzyspreadsheets import metrics, detect_duplicates, merge_spreadsheets
+from fuzzyspreadsheets.generate import generate_spreadsheet, generate_spreadsheets
+
+
+requires_rapidfuzz = pytest.mark.skipif(metrics.Indel is None, reason="the rapidfuzz backend is not installed")
+
+ALPHABET = string.ascii_uppercase[:6] + "ÄÖÜß 0-/,."
+
+
+
+@pytest.fixture(autouse=True)
+def default_backend():
+    """Restores the default backend after each test"""
+    yield
+    metrics.set_backend()
+
+
+
+def random_pairs(n, seed=0):
+    rnd = random.Random(seed)
+    value = lambda: ''.join(rnd.choice(ALPHABET) for _ in range(rnd.randint(0, 12)))
+    return [(value(), value()) for _ in range(n)]
+
+
+
+@requires_rapidfuzz
+def test_levenshtein_backends():
+    pairs = random_pairs(2000)
+    results = dict()
+    for backend in metrics.BACKENDS:
+        assert metrics.set_backend(backend) == backend
+        ratios = [metrics.levenshtein_ratio(a, b) for (a, b) in pairs]
+        batched = [r for (a, _) in pairs[:100] for r in metrics.levenshtein_ratios(a, [b for (_, b) in pairs])]
+        results[backend] = (ratios, batched)
+    assert results["python"] == results["rapidfuzz"]
+    ratios, batched = results["python"]
+    assert batched == [metrics.levenshtein_ratio(a, b) for (a, _) in pairs[:100] for (_, b) in pairs]
+
+
+
+def one_hot_token_set_ratio(s1, s2):
+    """token_set_ratio with the cosine similarities of the one-hot vectors (the former implementation)"""
+    s1,s2 = ([s.strip() for s in s.strip().replace(',', ' ').upper().split(' ') if s] for s in (s1,s2))
+    s1,s2 = (s1,s2) if len(s1) <= len(s2) else (s2,s1)
+    vectors1,vectors2 = ([(ord(s[0])-33, len(s)) for s in st] for st in (s1,s2))
+    n = max(vectors1 + vectors2, key=lambda t: t[0])[0]
+    vectors1,vectors2 = ([(c2, *([0,]*c1+[1,]+[0,]*(n-c1))) for c1,c2 in vectors] for vectors in (vectors1,vectors2))
+    ll = [[metrics.cosine_similarity(v1,v2) for v2 in vectors2] for v1 in vectors1]
+    right_indeces = [t[0] for t in sorted([(i,max(l)) for i,l in enumerate(ll)], reverse=True, key=lambda t: t[-1])]
+    left_indeces = list(range(len(s2)))
+    fuzzy_set = list()
+    for right_ix in right_indeces:
+        left_ix = ll[right_ix].index(max(ll[right_ix]))
+        if left_ix not in left_indeces: continue
+        fuzzy_set.append((right_ix, left_ix))
+        left_indeces.remove(left_ix)
+    fuzzy_set = [(s1[ix_left], s2[ix_right]) for (ix_left, ix_right) in fuzzy_set]
+    return sum(metrics.levenshtein_ratio(a, b) for a, b in fuzzy_set) / len(fuzzy_set)
+
+
+
+def test_token_set_ratio_closed_form():
+    rnd = random.Random(1)
+    words = ["MAIER", "MEYER", "STR.", "STRASSE", "KONIG", "KÖNIG", "12A", "12", "LTD", "LIMITED", "TURBO", "OPTIMUS", "A", "ÄB"]
+    for _ in range(2000):
+        s1, s2 = (' '.join(rnd.choice(words) for _ in range(rnd.randint(1, 5))) for _ in range(2))
+        if s1 != s2:
+            assert metrics.token_set_ratio(s1, s2) == one_hot_token_set_ratio(s1, s2), (s1, s2)
+
+
+
+@requires_rapidfuzz
+def test_outputs_identical_under_both_backends(tmp_path):
+    duplicates = generate_spreadsheet(120, directory=str(tmp_path), filename="duplicates.csv")
+    spreadsheet1, spreadsheet2 = generate_spreadsheets(120, directory=str(tmp_path), filename1="spreadsheet1.csv", filename2="spreadsheet2.csv")
+    outputs = dict()
+    for backend in metrics.BACKENDS:
+        metrics.set_backend(backend)
+        directory = tmp_path / backend
+        directory.mkdir()
+        outputs[backend] = [open(path, mode='rb').read() for path in (
+            detect_duplicates(duplicates, directory=str(directory)),
+            detect_duplicates(duplicates, directory=str(directory), filename="clusters.csv", clustering=True, phonetic="cologne"),
+            merge_spreadsheets(spreadsheet1, spreadsheet2, directory=str(directory)),
+            merge_spreadsheets(spreadsheet1, spreadsheet2, directory=str(directory), filename="heap.csv", assignment="heap"))]
+    assert outputs["python"] == outputs["rapidfuzz"]
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+"""
+Merging against a reference index (see model.build_reference_index) uses the stored candidate index
+and the memory-mapped rows as they are: no index is built over the reference table on a merge.
+Run from the repository root:  python -m pytest tests
+"""
+
+
+from fuzzyspreadsheets import model, merge_spreadsheets, build_reference_index
+from fuzzyspreadsheets.reference import MappedRows
+from fuzzyspreadsheets.generate import generate_spreadsheets
+
+
+
+def test_merge_does_not_rebuild_the_reference_index(tmp_path, monkeypatch):
+    spreadsheet1, spreadsheet2 = generate_spreadsheets(80, directory=str(tmp_path), filename1="spreadsheet1.csv", filename2="spreadsheet2.csv")
+    index_file = build_reference_index(spreadsheet2, str(tmp_path / "reference.idx"))
+    expected = open(merge_spreadsheets(spreadsheet1, None, reference_index=index_file, directory=str(tmp_path),
+                                       filename="expected.csv"), mode='rb').read()
+
+    built = list()
+    def build_candidate_index(rows, *args, **kwargs):
+        built.append(rows)
+        return candidate_index(rows, *args, **kwargs)
+    def bigram_indexes(rows, *args, **kwargs):
+        raise AssertionError("bigram index built over the reference table")
+    candidate_index = model.build_candidate_index
+    monkeypatch.setattr(model, "build_candidate_index", build_candidate_index)
+    monkeypatch.setattr(model, "bigram_indexes", bigram_indexes)
+
+    for reference_index in (index_file, model.load_reference_index(index_file)):
+        output = merge_spreadsheets(spreadsheet1, None, reference_index=reference_index, directory=str(tmp_path), filename="reference.csv")
+        assert open(output, mode='rb').read() == expected
+    assert len(built) == 2 and not any(isinstance(rows, MappedRows) for rows in built)